@@ -0,0 +1,652 @@
+"""bench:
+
+Benchmarks for the build and search code. Run from the top of the repo:
+
+    python3 -m searchlib.bench generate [options] OUTFILE
+    python3 -m searchlib.bench run [options] [--output FILE]
+    python3 -m searchlib.bench compare OLD.json NEW.json
+
+"generate" writes a synthetic Master-Index.xml. The scale is set by
+--dirs, --files (per directory), --desc-words, --depth (of the directory
+tree), --parentdesc-depth (how many ancestor descriptions each entry
+carries), and --metadata (the fraction of entries with tuid and ifwiki
+metadata). The same options and --seed always give the same file.
+
+"run" generates a Master-Index.xml (or uses --masterindex) in a scratch
+directory and times three things:
+
+- parse: ifarchivexml.parse_callback(), with each backend
+- tree: ifarchivexml.parse() into the full object tree, from the XML
+  and from a snapshot, with the memory the tree takes up (as traced by
+  tracemalloc)
+- build: a full build_index() (what "search.wsgi build" does), then an
+  incremental one with nothing changed
+- search: a fixed mix of query types (plain, phrase, wildcard, date
+  range, tuid, dir), each run --repeat times, the way the app runs
+  them: search_window_timeout() for a window of --window-pages pages,
+  with the facet counts (unless --no-facets). The app caches windows;
+  this times the uncached fetch.
+- timelimit: broad one-word queries and narrow ones, run with no time
+  limit, with whoosh's cooperative TimeLimitCollector, and with our
+  DeadlineCollector, to show what the time limit costs
+
+One more phase only runs if you ask for it (--phases desctext):
+
+- desctext: parse_callback() over files with long descriptions, at
+  each of the --desc-lines sizes. The SAX parser hands text over in
+  many small chunks, and this compares collecting them in a list (as
+  IFAParser does) with concatenating strings (as it used to, which is
+  quadratic in the length of the text). The etree backend is timed too.
+  This uses its own generated files, not the main Master-Index.xml.
+
+Each phase runs in a fresh process, so its peak RSS is its own. The
+results are printed as JSON (latencies in seconds, with p50/p95/p99).
+"compare" lines up two such files and flags what got slower.
+"""
+
+import sys
+import os, os.path
+import time
+import json
+import random
+import argparse
+import platform
+import tempfile
+import shutil
+import multiprocessing
+from xml.sax.saxutils import escape
+
+from searchlib.util import peakrss
+
+# Bump this if the output format changes incompatibly.
+RESULT_VERSION = 1
+
+# Words for names and descriptions. The query mix below searches for
+# some of these, so don't change them casually.
+WORDS = (
+    'zork adventure interpreter inform tads glulx zcode games source '
+    'infocom text parser hugo alan puzzle magic wizard cave treasure '
+    'maze dragon spell competition ifcomp walkthrough solution hint '
+    'manual documentation library release version update port unix '
+    'mac windows dos amiga story fiction colossal map editor z-machine'
+).split()
+
+# Top-level directory names (under if-archive).
+TOPDIRS = [ 'games', 'infocom', 'programming', 'solutions', 'art', 'info', 'utilities', 'magazines' ]
+
+FILE_SUFFIXES = [ 'z5', 'z8', 'zip', 'txt', 'gblorb', 'ulx', 'tar.gz' ]
+
+# Dates run from 1992 to 2025.
+DATE_START = 694224000
+DATE_RANGE = 1041379200
+
+# The query mix for the search phase, as (kind, query) pairs. These are
+# meant to hit the generated data.
+QUERY_MIX = [
+    ('word', 'zork'),
+    ('word', 'interpreter'),
+    ('words', 'inform library'),
+    ('words', 'cave treasure maze'),
+    ('phrase', '"text adventure"'),
+    ('phrase', '"colossal cave"'),
+    ('wildcard', 'inter*'),
+    ('wildcard', 'z*'),
+    ('date', 'date:[2000 to 2010]'),
+    ('date', 'date:2015'),
+    ('tuid', 'tuid:t00042'),
+    ('tuid', 'tuid:t00007 OR tuid:t00099'),
+    ('dir', 'dir:games'),
+    ('dir', 'dir:solutions zork'),
+]
+
+def generate(fl, dirs=200, files=10, descwords=40, depth=4, parentdescdepth=1, metadata=0.1, seed=1):
+    """Write a synthetic Master-Index.xml to the file object fl.
+    Returns (dircount, filecount).
+
+    Each directory gets between zero and twice files files. Description
+    lengths vary up to twice descwords.
+    """
+    rand = random.Random(seed)
+    depth = max(1, depth)
+    tuidcount = max(100, (dirs * files) // 20)
+
+    def para(maxwords):
+        count = rand.randint(1, max(1, maxwords))
+        res = ' '.join(rand.choice(WORDS) for _ in range(count))
+        if rand.random() < 0.3:
+            # A Markdown link, which buildmddesc() strips.
+            res += ' [%s](https://ifdb.org/viewgame?id=%s)' % (rand.choice(WORDS), rand.randrange(100000),)
+        return res
+
+    def datestr(rawdate):
+        return time.strftime('%d-%b-%Y', time.gmtime(rawdate))
+
+    def writemetadata(indent):
+        fl.write('%s<metadata>\n' % (indent,))
+        fl.write('%s<item><key>tuid</key><value>t%05d</value></item>\n' % (indent, rand.randrange(tuidcount),))
+        if rand.random() < 0.5:
+            fl.write('%s<item><key>ifwiki</key><value>%s</value></item>\n' % (indent, escape(rand.choice(WORDS).title()+' '+rand.choice(WORDS).title()),))
+        fl.write('%s</metadata>\n' % (indent,))
+
+    def writeparentdescs(dirname, indent):
+        count = 0
+        while dirname and count < parentdescdepth:
+            desc = descs.get(dirname)
+            if desc:
+                fl.write('%s<parentdesc dir="%s">%s</parentdesc>\n' % (indent, escape(dirname, {'"':'&quot;'}), escape(desc),))
+                count += 1
+            dirname = dirname.rpartition('/')[0]
+
+    # Lay out the directory tree: the top-level dirs first, then the rest
+    # under random parents which aren't too deep.
+    dirnames = [ 'if-archive' ]
+    dirnames.extend('if-archive/'+val for val in TOPDIRS[ : max(1, dirs) ])
+    while len(dirnames) <= dirs:
+        parent = rand.choice(dirnames)
+        if parent.count('/') >= depth:
+            continue
+        name = '%s/%s%d' % (parent, rand.choice(WORDS), len(dirnames))
+        dirnames.append(name)
+    dirnames.sort()
+    descs = {}
+    for dirname in dirnames:
+        if rand.random() < 0.7:
+            descs[dirname] = para(descwords*2)
+
+    subdirs = {}
+    for dirname in dirnames[1:]:
+        subdirs.setdefault(dirname.rpartition('/')[0], []).append(dirname)
+
+    fl.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    fl.write('<ifarchive>\n')
+    filecount = 0
+    for dirname in dirnames:
+        dirfiles = [ '%s%d.%s' % (rand.choice(WORDS), ix, rand.choice(FILE_SUFFIXES)) for ix in range(rand.randint(0, 2*files)) ]
+        rawdate = DATE_START + rand.randrange(DATE_RANGE)
+        fl.write('<directory>\n')
+        fl.write('  <name>%s</name>\n' % (escape(dirname),))
+        if '/' in dirname:
+            fl.write('  <parent>%s</parent>\n' % (escape(dirname.rpartition('/')[0]),))
+        fl.write('  <subdircount>%d</subdircount>\n' % (len(subdirs.get(dirname, [])),))
+        fl.write('  <filecount>%d</filecount>\n' % (len(dirfiles),))
+        fl.write('  <date>%s</date>\n' % (datestr(rawdate),))
+        fl.write('  <rawdate>%d</rawdate>\n' % (rawdate,))
+        if dirname in descs:
+            fl.write('  <description>%s</description>\n' % (escape(descs[dirname]),))
+        writeparentdescs(dirname.rpartition('/')[0], '  ')
+        if rand.random() < metadata:
+            writemetadata('  ')
+        fl.write('</directory>\n')
+
+        for filename in dirfiles:
+            rawdate = DATE_START + rand.randrange(DATE_RANGE)
+            fl.write('<file>\n')
+            fl.write('  <name>%s</name>\n' % (escape(filename),))
+            fl.write('  <path>%s/%s</path>\n' % (escape(dirname), escape(filename),))
+            fl.write('  <directory>%s</directory>\n' % (escape(dirname),))
+            fl.write('  <size>%d</size>\n' % (rand.randint(100, 5000000),))
+            fl.write('  <date>%s</date>\n' % (datestr(rawdate),))
+            fl.write('  <rawdate>%d</rawdate>\n' % (rawdate,))
+            fl.write('  <md5>%032x</md5>\n' % (rand.getrandbits(128),))
+            fl.write('  <sha512>%0128x</sha512>\n' % (rand.getrandbits(512),))
+            if rand.random() < 0.8:
+                fl.write('  <description>%s</description>\n' % (escape(para(descwords*2)),))
+            writeparentdescs(dirname, '  ')
+            if rand.random() < metadata:
+                writemetadata('  ')
+            fl.write('</file>\n')
+            filecount += 1
+
+    fl.write('</ifarchive>\n')
+    return (len(dirnames), filecount)
+
+def percentiles(vals):
+    """Summarize a list of timings.
+    """
+    vals = sorted(vals)
+    if not vals:
+        return { 'count': 0 }
+    def pct(frac):
+        # Nearest-rank percentile.
+        ix = max(0, min(len(vals)-1, int(frac * len(vals) + 0.999999) - 1))
+        return vals[ix]
+    return {
+        'count': len(vals),
+        'min': vals[0],
+        'mean': sum(vals) / len(vals),
+        'p50': pct(0.50),
+        'p95': pct(0.95),
+        'p99': pct(0.99),
+        'max': vals[-1],
+    }
+
+def phase_parse(masterindexpath, repeat):
+    from searchlib import ifarchivexml
+    from searchlib.ifarchivexml import BACKENDS
+
+    res = {}
+    for backend in BACKENDS:
+        counts = [0, 0]
+        def dirfunc(dir):
+            counts[0] += 1
+        def filefunc(file):
+            counts[1] += 1
+        times = []
+        for _ in range(repeat):
+            counts[:] = [0, 0]
+            starttime = time.perf_counter()
+            ifarchivexml.parse_callback(masterindexpath, dirfunc=dirfunc, filefunc=filefunc, backend=backend)
+            times.append(time.perf_counter() - starttime)
+        res[backend] = percentiles(times)
+        res[backend]['dirs'] = counts[0]
+        res[backend]['files'] = counts[1]
+    res.update(peakrss())
+    return res
+
+def phase_tree(masterindexpath, snapshotpath, repeat):
+    import gc
+    import tracemalloc
+    from searchlib import ifarchivexml
+
+    # The first XML parse writes the snapshot.
+    ifarchivexml.parse(masterindexpath, snapshot=snapshotpath)
+    res = { 'snapshot_bytes': os.path.getsize(snapshotpath) }
+    for (form, snapshot) in (('xml', None), ('snapshot', snapshotpath)):
+        times = []
+        for _ in range(repeat):
+            starttime = time.perf_counter()
+            tree = ifarchivexml.parse(masterindexpath, snapshot=snapshot)
+            times.append(time.perf_counter() - starttime)
+            del tree
+        res[form] = percentiles(times)
+        # Measure the memory held by one tree once it's loaded, not the
+        # parse overhead. (tracemalloc slows the parse, so this is a
+        # separate run.)
+        gc.collect()
+        tracemalloc.start()
+        tree = ifarchivexml.parse(masterindexpath, snapshot=snapshot)
+        gc.collect()
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        res[form]['tree_kb'] = current // 1024
+        res[form]['parse_peak_kb'] = peak // 1024
+        del tree
+    res.update(peakrss())
+    return res
+
+def phase_build(masterindexpath, indexdir, jobs):
+    from searchlib.indexer import build_index
+
+    res = {}
+    starttime = time.perf_counter()
+    stats = build_index(masterindexpath, indexdir, create=True, jobs=jobs)
+    res['full'] = { 'seconds': time.perf_counter() - starttime, 'items': stats.itemcount, 'jobs': jobs }
+
+    starttime = time.perf_counter()
+    stats = build_index(masterindexpath, indexdir, incremental=True)
+    res['incremental'] = { 'seconds': time.perf_counter() - starttime, 'items': stats.itemcount }
+
+    res['index_bytes'] = sum(os.path.getsize(os.path.join(indexdir, name)) for name in os.listdir(indexdir))
+    res.update(peakrss())
+    return res
+
+def phase_search(indexdir, repeat, pagelen, timeout, windowpages=10, facets=True):
+    from whoosh.index import open_dir
+    from whoosh.searching import TimeLimit
+    from searchlib.indexer import create_queryparser, join_parentdescs, PARENTDESC_FIELD
+    from searchlib.util import search_window_timeout
+    from searchlib.facets import create_facets
+
+    index = open_dir(indexdir)
+    queryparser = create_queryparser(index.schema)
+    # As in SearchApp.getwindow().
+    groupedby = create_facets(index.schema) if facets else None
+    joined = (PARENTDESC_FIELD in index.schema)
+    limit = windowpages * pagelen
+
+    res = { 'queries': {} }
+    bykind = {}
+    alltimes = []
+    with index.searcher() as searcher:
+        for (kind, querystr) in QUERY_MIX:
+            query = queryparser.parse(querystr)
+            if joined:
+                query = join_parentdescs(searcher, query)
+            times = []
+            first = None
+            timeouts = 0
+            resultcount = 0
+            # One extra run first, which warms the searcher's caches. We
+            # report it separately.
+            for ix in range(repeat+1):
+                starttime = time.perf_counter()
+                try:
+                    window = search_window_timeout(searcher, query, limit, timeout=timeout, exactcount=(joined or groupedby is not None), groupedby=groupedby)
+                    resultcount = window.total
+                except TimeLimit:
+                    timeouts += 1
+                duration = time.perf_counter() - starttime
+                if ix == 0:
+                    first = duration
+                else:
+                    times.append(duration)
+            summary = percentiles(times)
+            summary['kind'] = kind
+            summary['first'] = first
+            summary['results'] = resultcount
+            summary['timeouts'] = timeouts
+            res['queries'][querystr] = summary
+            bykind.setdefault(kind, []).extend(times)
+            alltimes.extend(times)
+
+    res['kinds'] = { kind: percentiles(times) for (kind, times) in bykind.items() }
+    res['all'] = percentiles(alltimes)
+    res.update(peakrss())
+    return res
+
+# Queries for the timelimit phase. The broad ones match most of the
+# generated documents; the narrow ones match a handful.
+TIMELIMIT_QUERIES = [
+    ('broad', 'zork'),
+    ('broad', 'interpreter'),
+    ('broad', 'source'),
+    ('narrow', 'tuid:t00042'),
+    ('narrow', 'dir:solutions'),
+]
+
+def phase_timelimit(indexdir, repeat, pagelen, timeout):
+    from whoosh.index import open_dir
+    from whoosh.collectors import TimeLimitCollector
+    from searchlib.indexer import create_queryparser
+    from searchlib.deadline import DeadlineCollector
+
+    modes = [
+        ('none', lambda col: col),
+        ('whoosh', lambda col: TimeLimitCollector(col, timeout, use_alarm=False)),
+        ('deadline', lambda col: DeadlineCollector(col, timeout)),
+    ]
+
+    index = open_dir(indexdir)
+    queryparser = create_queryparser(index.schema)
+    times = {}
+    with index.searcher() as searcher:
+        for (kind, querystr) in TIMELIMIT_QUERIES:
+            query = queryparser.parse(querystr)
+            # Each mode gets a block of runs to itself. (Interleaving
+            # them would charge whoosh's exiting timer threads to
+            # whichever mode runs next.)
+            for (mode, wrap) in modes:
+                for ix in range(repeat+1):
+                    col = wrap(searcher.collector(limit=pagelen))
+                    starttime = time.perf_counter()
+                    searcher.search_with_collector(query, col)
+                    duration = time.perf_counter() - starttime
+                    if ix > 0:
+                        times.setdefault(kind, {}).setdefault(mode, []).append(duration)
+
+    res = {}
+    for (kind, modetimes) in times.items():
+        res[kind] = { mode: percentiles(vals) for (mode, vals) in modetimes.items() }
+    res.update(peakrss())
+    return res
+
+# Description lengths (in lines) for the desctext phase.
+DESC_LINES = [ 10, 100, 1000, 4000 ]
+
+def generate_longdescs(fl, lines, files=200, seed=1):
+    """Write a Master-Index.xml of one directory of files, each with a
+    description and a parentdesc of the given number of lines. Every
+    line contains an entity, so a SAX parser reports each line in
+    several chunks.
+    """
+    rand = random.Random(seed)
+    def longdesc():
+        return '\n'.join('%s &amp; %s %s' % (rand.choice(WORDS), rand.choice(WORDS), rand.choice(WORDS)) for _ in range(lines))
+    fl.write('<?xml version="1.0" encoding="UTF-8"?>\n<ifarchive>\n')
+    fl.write('<directory>\n  <name>if-archive</name>\n  <parent></parent>\n</directory>\n')
+    dirdesc = longdesc()
+    fl.write('<directory>\n  <name>if-archive/games</name>\n  <parent>if-archive</parent>\n  <description>%s</description>\n</directory>\n' % (dirdesc,))
+    for ix in range(files):
+        fl.write('<file>\n  <name>f%d.txt</name>\n  <path>if-archive/games/f%d.txt</path>\n  <directory>if-archive/games</directory>\n' % (ix, ix,))
+        fl.write('  <description>%s</description>\n' % (longdesc(),))
+        fl.write('  <parentdesc dir="if-archive/games">%s</parentdesc>\n' % (dirdesc,))
+        fl.write('</file>\n')
+    fl.write('</ifarchive>\n')
+
+def phase_desctext(workdir, desclines, repeat):
+    from searchlib import ifarchivexml
+
+    class ConcatParser(ifarchivexml.IFAParser):
+        """IFAParser with its original text handling: every chunk of
+        character data is concatenated onto the text so far.
+        """
+        def __init__(self, callbacks=None):
+            ifarchivexml.IFAParser.__init__(self, callbacks=callbacks)
+            self.grabbeddata = ''
+        def characters(self, data):
+            self.grabbeddata = (self.grabbeddata + data)
+        def grabdata_start(self, dict):
+            self.grabbeddata = ''
+        def grabdata(self):
+            dat = self.grabbeddata
+            self.grabbeddata = ''
+            return dat
+
+    def nop(obj):
+        pass
+    parsers = [
+        ('sax', lambda: ifarchivexml.IFAParser(callbacks=(nop, nop)), 'sax'),
+        ('sax_concat', lambda: ConcatParser(callbacks=(nop, nop)), 'sax'),
+        ('etree', lambda: ifarchivexml.IFAParser(callbacks=(nop, nop)), 'etree'),
+    ]
+
+    res = {}
+    for lines in desclines:
+        path = os.path.join(workdir, 'longdesc-%d.xml' % (lines,))
+        with open(path, 'w', encoding='utf-8') as fl:
+            generate_longdescs(fl, lines)
+        sizeres = { 'bytes': os.path.getsize(path) }
+        for (name, makeparser, backend) in parsers:
+            times = []
+            for _ in range(repeat):
+                parser = makeparser()
+                starttime = time.perf_counter()
+                ifarchivexml.run_parser(path, parser, backend=backend)
+                times.append(time.perf_counter() - starttime)
+            sizeres[name] = percentiles(times)
+        res['lines_%d' % (lines,)] = sizeres
+        os.remove(path)
+    res.update(peakrss())
+    return res
+
+def runphase(func, *args):
+    """Run one phase in a fresh process, so that its peak RSS (and its
+    import costs) are its own.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(func, args)
+
+PHASES = [ 'parse', 'tree', 'build', 'search', 'timelimit' ]
+# Phases which only run if named in --phases.
+EXTRA_PHASES = [ 'desctext' ]
+
+def cmd_generate(args):
+    with open(args.outfile, 'w', encoding='utf-8') as fl:
+        (dircount, filecount) = generate(fl, dirs=args.dirs, files=args.files, descwords=args.desc_words, depth=args.depth, parentdescdepth=args.parentdesc_depth, metadata=args.metadata, seed=args.seed)
+    print('Wrote %s: %d directories, %d files, %d bytes' % (args.outfile, dircount, filecount, os.path.getsize(args.outfile)), file=sys.stderr)
+
+def cmd_run(args):
+    phases = args.phases.split(',')
+    for phase in phases:
+        if phase not in PHASES and phase not in EXTRA_PHASES:
+            raise Exception('Unknown phase: ' + phase)
+    if ('search' in phases or 'timelimit' in phases) and 'build' not in phases:
+        raise Exception('The search and timelimit phases require the build phase')
+
+    workdir = tempfile.mkdtemp(prefix='searchbench-', dir=args.workdir)
+    try:
+        result = {
+            'version': RESULT_VERSION,
+            'label': args.label,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'env': envinfo(),
+        }
+
+        if args.masterindex:
+            masterindexpath = args.masterindex
+            result['scale'] = { 'masterindex': masterindexpath }
+        else:
+            masterindexpath = os.path.join(workdir, 'Master-Index.xml')
+            with open(masterindexpath, 'w', encoding='utf-8') as fl:
+                (dircount, filecount) = generate(fl, dirs=args.dirs, files=args.files, descwords=args.desc_words, depth=args.depth, parentdescdepth=args.parentdesc_depth, metadata=args.metadata, seed=args.seed)
+            result['scale'] = {
+                'dirs': args.dirs, 'files': args.files,
+                'desc_words': args.desc_words, 'depth': args.depth,
+                'parentdesc_depth': args.parentdesc_depth,
+                'metadata': args.metadata, 'seed': args.seed,
+                'generated_dirs': dircount, 'generated_files': filecount,
+            }
+        result['scale']['bytes'] = os.path.getsize(masterindexpath)
+
+        indexdir = os.path.join(workdir, 'index')
+        os.mkdir(indexdir)
+
+        if 'parse' in phases:
+            print('Timing parse...', file=sys.stderr)
+            result['parse'] = runphase(phase_parse, masterindexpath, args.parse_repeat)
+        if 'tree' in phases:
+            print('Timing tree...', file=sys.stderr)
+            result['tree'] = runphase(phase_tree, masterindexpath, os.path.join(workdir, 'Master-Index.snap'), args.parse_repeat)
+        if 'build' in phases:
+            print('Timing build...', file=sys.stderr)
+            result['build'] = runphase(phase_build, masterindexpath, indexdir, args.jobs)
+        if 'search' in phases:
+            print('Timing search...', file=sys.stderr)
+            result['search'] = runphase(phase_search, indexdir, args.repeat, args.pagelen, args.timeout, args.window_pages, not args.no_facets)
+        if 'timelimit' in phases:
+            print('Timing timelimit...', file=sys.stderr)
+            result['timelimit'] = runphase(phase_timelimit, indexdir, args.repeat, args.pagelen, args.timeout)
+        if 'desctext' in phases:
+            print('Timing desctext...', file=sys.stderr)
+            desclines = [ int(val) for val in args.desc_lines.split(',') ]
+            result['desctext'] = runphase(phase_desctext, workdir, desclines, args.parse_repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(result, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fl:
+            fl.write(text)
+            fl.write('\n')
+    else:
+        print(text)
+
+def envinfo():
+    import whoosh
+    return {
+        'python': platform.python_version(),
+        'whoosh': whoosh.versionstring(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+# Leaf keys which are timings (lower is better), for compare.
+TIMING_KEYS = set([ 'seconds', 'min', 'mean', 'p50', 'p95', 'p99', 'max', 'first' ])
+
+def flatten(obj, prefix=''):
+    """Flatten nested dicts into a {'a.b.c': value} map of the numeric
+    leaves.
+    """
+    res = {}
+    for (key, val) in obj.items():
+        name = prefix+key
+        if isinstance(val, dict):
+            res.update(flatten(val, name+'.'))
+        elif isinstance(val, (int, float)) and not isinstance(val, bool):
+            res[name] = val
+    return res
+
+def cmd_compare(args):
+    with open(args.old) as fl:
+        old = json.load(fl)
+    with open(args.new) as fl:
+        new = json.load(fl)
+    if old.get('scale') != new.get('scale'):
+        print('Warning: the runs were at different scales', file=sys.stderr)
+
+    oldvals = flatten(old)
+    newvals = flatten(new)
+    slower = 0
+    for key in sorted(oldvals):
+        if key not in newvals or key in ('version',):
+            continue
+        lastkey = key.rpartition('.')[2]
+        if lastkey not in TIMING_KEYS and not lastkey.endswith('_kb'):
+            continue
+        if args.summary and lastkey not in ('seconds', 'p50', 'p95', 'p99', 'peak_rss_kb', 'tree_kb'):
+            continue
+        oldval = oldvals[key]
+        newval = newvals[key]
+        ratio = (newval / oldval) if oldval else 0.0
+        flag = ''
+        if oldval and ratio > 1.0 + args.threshold:
+            flag = '  SLOWER' if lastkey in TIMING_KEYS else '  BIGGER'
+            slower += 1
+        elif oldval and ratio < 1.0 - args.threshold:
+            flag = '  faster' if lastkey in TIMING_KEYS else '  smaller'
+        print('%-60s %12.6g %12.6g  %5.2fx%s' % (key, oldval, newval, ratio, flag))
+    if slower:
+        print('%d measurements are more than %d%% worse' % (slower, int(args.threshold*100)))
+        sys.exit(1)
+
+def addscaleargs(popt):
+    popt.add_argument('--dirs', type=int, default=200, help='number of directories (default 200)')
+    popt.add_argument('--files', type=int, default=10, help='average files per directory (default 10)')
+    popt.add_argument('--desc-words', type=int, default=40, help='average description length in words (default 40)')
+    popt.add_argument('--depth', type=int, default=4, help='maximum directory depth (default 4)')
+    popt.add_argument('--parentdesc-depth', type=int, default=1, help='ancestor descriptions per entry (default 1)')
+    popt.add_argument('--metadata', type=float, default=0.1, help='fraction of entries with tuid/ifwiki metadata (default 0.1)')
+    popt.add_argument('--seed', type=int, default=1)
+
+def main():
+    popt = argparse.ArgumentParser(prog='python3 -m searchlib.bench')
+    subopt = popt.add_subparsers(dest='cmd', title='commands')
+
+    popt_generate = subopt.add_parser('generate', help='write a synthetic Master-Index.xml')
+    popt_generate.set_defaults(cmdfunc=cmd_generate)
+    addscaleargs(popt_generate)
+    popt_generate.add_argument('outfile')
+
+    popt_run = subopt.add_parser('run', help='run the benchmarks')
+    popt_run.set_defaults(cmdfunc=cmd_run)
+    addscaleargs(popt_run)
+    popt_run.add_argument('--masterindex', help='use this Master-Index.xml instead of generating one')
+    popt_run.add_argument('--phases', default=','.join(PHASES), help='comma-separated (default %s; also %s)' % (','.join(PHASES), ','.join(EXTRA_PHASES),))
+    popt_run.add_argument('--desc-lines', default=','.join(str(val) for val in DESC_LINES), help='description lengths for the desctext phase (default %s)' % (','.join(str(val) for val in DESC_LINES),))
+    popt_run.add_argument('--parse-repeat', type=int, default=3, help='parse runs per backend (default 3)')
+    popt_run.add_argument('--repeat', type=int, default=20, help='runs per query (default 20)')
+    popt_run.add_argument('--pagelen', type=int, default=10)
+    popt_run.add_argument('--timeout', type=float, default=10.0, help='query time limit (default 10 sec)')
+    popt_run.add_argument('--window-pages', type=int, default=10, help='pages per result window, as SearchWindowPages (default 10)')
+    popt_run.add_argument('--no-facets', action='store_true', help='search without facet counts, as Facets = false')
+    popt_run.add_argument('-j', '--jobs', type=int, default=1, help='build processes (default 1)')
+    popt_run.add_argument('--workdir', help='scratch directory parent (default system temp)')
+    popt_run.add_argument('--label', help='label to record in the output')
+    popt_run.add_argument('-o', '--output', help='write JSON here (default stdout)')
+
+    popt_compare = subopt.add_parser('compare', help='compare two benchmark results')
+    popt_compare.set_defaults(cmdfunc=cmd_compare)
+    popt_compare.add_argument('--threshold', type=float, default=0.1, help='fractional change to flag (default 0.1)')
+    popt_compare.add_argument('--summary', action='store_true', help='only show the headline numbers')
+    popt_compare.add_argument('old')
+    popt_compare.add_argument('new')
+
+    args = popt.parse_args()
+    if not args.cmd:
+        popt.print_help()
+        return
+    args.cmdfunc(args)
+
+if __name__ == '__main__':
+    main()
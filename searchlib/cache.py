@@ -0,0 +1,82 @@
+import time
+import threading
+import collections
+
+class LRUCache:
+    """A thread-safe in-memory cache with a size limit and an expiry time.
+
+    Entries are tied to an index generation. When setgeneration() sees a
+    new generation, the whole cache is dropped; nothing computed from
+    the old index can be served after a new one is committed. A search
+    which started on the old generation may finish after the switch, so
+    put() takes the generation the value was computed from, and drops
+    the value if that's no longer current. (Callers should also put the
+    generation in their keys, so that a lookup can never match a value
+    from another generation.)
+
+    The cache keeps hit and miss counts so that we can log them and
+    size it sensibly.
+    """
+
+    def __init__(self, maxsize=200, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Maps key to (value, expiretime). The most recently used entry
+        # is at the end.
+        self.map = collections.OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.map)
+
+    def setgeneration(self, generation):
+        """Note the current index generation. If it has changed, discard
+        everything.
+        """
+        with self.lock:
+            if generation != self.generation:
+                self.generation = generation
+                self.map.clear()
+
+    def get(self, key):
+        """Return the cached value for key, or None.
+        """
+        if self.maxsize <= 0:
+            return None
+        with self.lock:
+            ent = self.map.get(key)
+            if ent is not None and ent[1] < time.time():
+                del self.map[key]
+                ent = None
+            if ent is None:
+                self.misses += 1
+                return None
+            self.map.move_to_end(key)
+            self.hits += 1
+            return ent[0]
+
+    def put(self, key, value, generation=None):
+        """Store a value. The value must be treated as immutable from
+        now on, since other threads may see it.
+
+        If generation is given and isn't the current one (as last set by
+        setgeneration()), the value is stale and isn't stored.
+        """
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.map[key] = (value, time.time() + self.ttl)
+            self.map.move_to_end(key)
+            while len(self.map) > self.maxsize:
+                self.map.popitem(last=False)
+
+    def stats(self):
+        """Return (hits, misses, entries).
+        """
+        with self.lock:
+            return (self.hits, self.misses, len(self.map))
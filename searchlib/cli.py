@@ -1,16 +1,13 @@
+import sys
 import argparse
 import os, os.path
-import datetime
 import time
 import logging
 
-from searchlib.util import buildmddesc, buildtuids, buildwiki
-from searchlib.util import search_page_timeout
-
-from whoosh.searching import TimeLimit
-
-def run(appinstance):
+def run(config, getapp):
     """The entry point when search.wsgi is invoked on the command line.
+    The getapp argument is a function which creates the app instance;
+    we only call it if the command needs it.
     """
     popt = argparse.ArgumentParser(prog='search.wsgi')
     subopt = popt.add_subparsers(dest='cmd', title='commands')
@@ -18,12 +15,39 @@ def run(appinstance):
     popt_build = subopt.add_parser('build', help='build the search index')
     popt_build.set_defaults(cmdfunc=cmd_build)
     popt_build.add_argument('--create', action='store_true')
+    popt_build.add_argument('--incremental', action='store_true')
+    popt_build.add_argument('--parser', choices=('etree', 'sax'), default='etree')
+    popt_build.add_argument('-j', '--jobs', type=int, default=1)
+    popt_build.add_argument('--memory', type=int, metavar='MB', help='writer memory limit (default: BuildMemoryMB from the config)')
+    popt_build.add_argument('--flush', type=int, metavar='COUNT', help='write a segment every COUNT documents (default: BuildFlushCount from the config)')
+    popt_build.add_argument('--merge', choices=('small', 'optimize', 'none'), help='segment merge policy (default: BuildMergePolicy from the config)')
     
     popt_search = subopt.add_parser('search', help='perform a search')
     popt_search.set_defaults(cmdfunc=cmd_search)
     popt_search.add_argument('query')
     popt_search.add_argument('-l', '--limit', type=int, default=0)
     popt_search.add_argument('-p', '--page', type=int, default=1)
+    popt_search.add_argument('--sort', choices=('relevance', 'newest', 'oldest', 'largest'), default='relevance')
+    popt_search.add_argument('--socket', help='search daemon socket (default: SearchSocket from the config)')
+    popt_search.add_argument('--local', action='store_true', help='search in-process, even if the daemon is running')
+    popt_search.add_argument('--all', action='store_true', help='export every result, one per line (always in-process)')
+    popt_search.add_argument('--format', choices=('jsonl', 'tsv'), default='jsonl', help='export format, with --all')
+    popt_search.add_argument('--order', choices=('docnum', 'score'), default='docnum', help='export order, with --all')
+
+    popt_status = subopt.add_parser('index-status', help='report on the search index segments')
+    popt_status.set_defaults(cmdfunc=cmd_index_status)
+
+    popt_optimize = subopt.add_parser('optimize', help='merge the search index into one segment')
+    popt_optimize.set_defaults(cmdfunc=cmd_optimize)
+    popt_optimize.add_argument('--if-needed', action='store_true', help='only if MergeMaxSegments or MergeMaxDeletedRatio is exceeded')
+    popt_optimize.add_argument('--memory', type=int, metavar='MB', help='writer memory limit (default: BuildMemoryMB from the config)')
+
+    popt_serve = subopt.add_parser('serve', help='run the search daemon')
+    popt_serve.set_defaults(cmdfunc=cmd_serve)
+    popt_serve.add_argument('--socket', help='socket path (default: SearchSocket from the config)')
+
+    popt_startup = subopt.add_parser('startup', help='time app startup and warm-up')
+    popt_startup.set_defaults(cmdfunc=cmd_startup)
 
     args = popt.parse_args()
 
@@ -31,23 +55,61 @@ def run(appinstance):
         popt.print_help()
         return
 
-    args.cmdfunc(args, appinstance)
+    if args.cmd == 'search' and not args.local and not args.all:
+        socketpath = args.socket or config['Search'].get('SearchSocket')
+        if socketpath and search_daemon(args, socketpath):
+            return
+
+    args.cmdfunc(args, getapp())
 
 def cmd_build(args, app):
     """Build or rebuild the search index.
     This reads Master-Index.xml and rebuilds the search index. It
     cleans out and replaces all the existing entries.
+
+    Each build goes into a new generation directory, which becomes
+    current when the build is complete. The web app picks it up on the
+    next request; searches never see a partly-built index. Old
+    generations beyond KeepGenerations are deleted.
+
+    Use --parser sax to fall back to the original SAX parser for
+    Master-Index.xml. (The default etree parser is faster.)
+
+    Use --jobs N to spread the indexing work over N processes.
+
+    Each build saves a compact snapshot of Master-Index.xml (see
+    MasterIndexSnapshot). If Master-Index.xml hasn't changed since,
+    the next build reads the snapshot instead, which is much faster.
+
+    Each build also writes the list of the RecentCount newest items,
+    which the web app serves at AppRoot/recent.
+
+    Use --memory MB to cap the memory each index writer uses for its
+    buffers (beyond that, it spills to temporary files), and --flush
+    COUNT to write out a segment every COUNT documents. Use --merge to
+    choose what happens to the segments at the end: "small" merges
+    small segments on incremental builds, "optimize" merges everything
+    into one segment, and "none" leaves them alone. The defaults come
+    from the config file. The build reports its peak memory use and
+    the number of segments in the index.
+
+    Under the "small" policy, if the index winds up with more than
+    MergeMaxSegments segments or a MergeMaxDeletedRatio fraction of
+    deleted documents, the build merges it into one segment -- but
+    only during MergeHours, if that's set. Otherwise the merge is left
+    for the optimize command. (The merge happens before the new
+    generation goes live, so searches aren't held up.)
+
+    Use --incremental to update only the entries which have changed
+    since the last build. (If there's no record of the last build,
+    this does a full rebuild.)
     
     Use --create if you are creating a completely new search index.
-    You probably only need to do this if the schema changes. Restart
-    httpd after using this option.
+    You probably only need to do this if the schema changes. (There's
+    no need to restart httpd afterwards.)
     """
-    from searchlib import ifarchivexml
-    from whoosh.index import create_in, open_dir
-    from whoosh.fields import Schema, TEXT, ID, KEYWORD, DATETIME, NUMERIC, STORED
-    import whoosh.writing
-    from whoosh.analysis import StemmingAnalyzer, CharsetFilter
-    from whoosh.support.charset import accent_map
+    from searchlib.indexer import build_generation
+    from searchlib.util import peakrss
 
     if not os.path.exists(app.masterindexpath):
         print('Cannot find Master-Index file:', app.masterindexpath)
@@ -57,197 +119,285 @@ def cmd_build(args, app):
 
     if args.create:
         print('Creating index from scratch...')
-        analyzer = StemmingAnalyzer() | CharsetFilter(accent_map)
-    
-        # STORED fields are returned as part of the result object; they are not
-        #   indexed (not searchable).
-        # stored=True fields are returned as part of the result object, but
-        #   they *are* searchable.
-        # The unique=True flag on path will be useful if we do incremental
-        #   index updates. (It is not enforced as unique by whoosh, though.)
-        # KEYWORD fields are searchable lists.
-        # The "description" field gets fancy full-text searchability, including
-        #   stemming, accent-folding, etc.
-        
-        schema = Schema(
-            type=STORED,           # "file" or "dir"
-            description=TEXT(analyzer=analyzer),   # the primary search text
-            shortdesc=STORED,      # snippet of the description; displayed not indexed
-            name=ID,               # bare filename
-            path=ID(unique=True, stored=True),  # full path
-            dir=KEYWORD(commas=True, scorable=True),  # directory segments, comma-separated list
-            date=DATETIME(stored=True, sortable=True),
-            size=NUMERIC,          # in bytes
-            tuid=KEYWORD(scorable=True),          # tuids, space-separated list
-            wiki=KEYWORD(scorable=True, lowercase=True), # wiki pages, space-separated list (spaces in terms are replaced with underscores)
-        )
-        index = create_in(app.searchindexdir, schema)
+    elif args.incremental:
+        print('Updating index...')
     else:
         print('Rebuilding index...')
-        index = open_dir(app.searchindexdir)
 
-    SHORTDESC = 300
-    writer = index.writer()
+    limitmb = args.memory if args.memory is not None else app.buildmemorymb
+    flushcount = args.flush if args.flush is not None else app.buildflushcount
+    mergepolicy = args.merge or app.buildmergepolicy
 
-    itemcount = 0
-    dirdescmap = {}
-    # dirdescmap maps dir paths (including if-archive/...) to dir short descriptions
+    (stats, indexdir, removed) = build_generation(app.masterindexpath, app.searchindexdir, create=args.create, incremental=args.incremental, backend=args.parser, jobs=args.jobs, keep=app.keepgenerations, snapshot=app.masterindexsnapshot, parentdescmode=app.parentdescmode, recentcount=app.recentcount, limitmb=limitmb, flushcount=flushcount, mergepolicy=mergepolicy, automerge=merge_thresholds(app))
 
-    def dircallback(dir):
-        nonlocal itemcount
-        
-        if dir.name == 'if-archive':
-            # skip the root
-            return
-        assert dir.name.startswith('if-archive/')
-        dirname = dir.name[ 11 : ]
-        
-        date = None
-        if dir.rawdate is not None:
-            date = datetime.datetime.fromtimestamp(dir.rawdate)
-    
-        dirstr = None
-        dls = dirname.split('/')
-        if dls:
-            dirstr = ','.join(dls)
-    
-        _, _, name = dirname.rpartition('/')
-        alldesc = buildmddesc(dir)
-    
-        shortdesc = buildmddesc(dir, all=False)
-        if shortdesc:
-            shortdesc = shortdesc.strip()
-        if shortdesc:
-            dirdescmap[dir.name] = shortdesc
-            
-        tuids = buildtuids(dir)
-        wiki = buildwiki(dir)
-            
-        writer.add_document(
-            path = dirname,
-            name = name,
-            dir = dirstr,
-            type = 'dir',
-            description = alldesc,
-            shortdesc = shortdesc,
-            date = date,
-            tuid = tuids,
-            wiki = wiki,
-        )
-        itemcount += 1
-    
-    def filecallback(file):
-        nonlocal itemcount
-        
-        if file.symlink:
-            # skip symlinks
-            return
-        
-        assert file.path.startswith('if-archive/')
-        filepath = file.path[ 11 : ]
-        
-        date = None
-        if file.rawdate is not None:
-            date = datetime.datetime.fromtimestamp(file.rawdate)
-    
-        dirstr = None
-        dls = file.directory.split('/')
-        if dls and dls[0] == 'if-archive':
-            del dls[0]
-        if dls:
-            dirstr = ','.join(dls)
+    duration = time.time() - starttime
+    if stats.incremental:
+        print('Indexed %d items (%d added, %d updated, %d deleted) in %.01f sec' % (stats.itemcount, stats.added, stats.updated, stats.deleted, duration))
+    else:
+        print('Indexed %d items in %.01f sec' % (stats.itemcount, duration))
+    rss = peakrss()
+    if args.jobs > 1:
+        val = ' (workers %.1f MB)' % (rss['children_peak_rss_kb'] / 1024,)
+    else:
+        val = ''
+    print('Peak memory %.1f MB%s; %d segment%s' % (rss['peak_rss_kb'] / 1024, val, stats.segments, '' if stats.segments == 1 else 's'))
+    if stats.merged:
+        print('Merged segments (%s)' % (stats.merged,))
+    elif stats.mergedue:
+        print('Segments need merging (%s); outside MergeHours, so left for "optimize"' % (stats.mergedue,))
+    print('Current index:', indexdir)
+    if removed:
+        print('Removed old index files:', ', '.join(removed))
     
-        alldesc = buildmddesc(file)
-        
-        shortdesc = buildmddesc(file, all=False)
-        if shortdesc:
-            shortdesc = shortdesc.strip()
-        if shortdesc:
-            if len(shortdesc) > SHORTDESC:
-                shortdesc = shortdesc[ 0 : SHORTDESC ] + '...'
-        if not shortdesc:
-            # I suppose we could walk up the tree until we find a description.
-            shortdesc = dirdescmap.get(file.directory, None)
-            
-        tuids = buildtuids(file)
-        wiki = buildwiki(file)
+    if args.create:
+        val = 'create index'
+    elif stats.incremental:
+        val = 'update index (%d added, %d updated, %d deleted)' % (stats.added, stats.updated, stats.deleted)
+    else:
+        val = 'rebuild index'
+    logging.info('CLI: %s, indexed %d items in %.01f sec, peak RSS %d KB, %d segments', val, stats.itemcount, duration, rss['peak_rss_kb'], stats.segments)
     
-        writer.add_document(
-            path = filepath,
-            name = file.name,
-            dir = dirstr,
-            type = 'file',
-            description = alldesc,
-            shortdesc = shortdesc,
-            date = date,
-            size = file.size,
-            tuid = tuids,
-            wiki = wiki,
-        )
-        
-        itemcount += 1
-
-    ifarchivexml.parse_callback(app.masterindexpath, dirfunc=dircallback, filefunc=filecallback)
-
-    writer.commit(mergetype=whoosh.writing.CLEAR)
+def merge_thresholds(app):
+    """Return the MergeThresholds from the config.
+    """
+    from searchlib.segments import MergeThresholds, parse_hours
+    return MergeThresholds(maxsegments=app.mergemaxsegments, maxdeleted=app.mergemaxdeleted, hours=parse_hours(app.mergehours))
+
+def cmd_index_status(args, app):
+    """Report on the health of the current search index: its segments,
+    how many documents are deleted, how many terms each field has, its
+    size on disk, and whether it's due for a merge (see cmd_optimize).
+    Every search iterates over every segment, so as incremental builds
+    add segments and deletions, searches slow down.
+    """
+    from whoosh.index import open_dir, EmptyIndexError
+    from searchlib.generations import current_indexdir
+    from searchlib.segments import index_status
+
+    indexdir = current_indexdir(app.searchindexdir)
+    try:
+        index = open_dir(indexdir)
+    except EmptyIndexError:
+        print('The search index has not yet been built.')
+        return
+    status = index_status(index, indexdir)
+
+    print('Index:', indexdir)
+    print('Generation %d, %.1f MB on disk' % (status.generation, status.disksize / (1024*1024),))
+    print('%d documents, %d deleted (%.1f%%)' % (status.doccount, status.deleted, status.deletedratio()*100,))
+    print()
+    print('%d segment%s:' % (len(status.segments), '' if len(status.segments) == 1 else 's',))
+    for seg in status.segments:
+        print('  %s  %d documents, %d deleted' % (seg.name, seg.doccount, seg.deleted,))
+    print()
+    print('Terms by field:')
+    for name in sorted(status.fieldterms):
+        print('  %-12s %d' % (name, status.fieldterms[name],))
+    print()
+    reason = merge_thresholds(app).check(status)
+    if reason:
+        print('Merge due:', reason)
+    else:
+        print('No merge needed')
 
+def cmd_optimize(args, app):
+    """Merge the search index into a single segment, which also purges
+    deleted documents. This goes into a new generation, like a build,
+    so searches carry on with the old one until it's done.
+
+    Use --if-needed to merge only if the index has more than
+    MergeMaxSegments segments, or more than MergeMaxDeletedRatio of its
+    documents are deleted. That suits a cron job at an off-peak hour.
+    (Builds merge by themselves when the thresholds are exceeded, but
+    only during MergeHours, if that's set.)
+    """
+    from whoosh.index import EmptyIndexError
+    from searchlib.indexer import optimize_generation
+
+    thresholds = merge_thresholds(app) if args.if_needed else None
+    limitmb = args.memory if args.memory is not None else app.buildmemorymb
+    starttime = time.time()
+    try:
+        (before, after, indexdir, removed) = optimize_generation(app.searchindexdir, keep=app.keepgenerations, limitmb=limitmb, thresholds=thresholds)
+    except EmptyIndexError:
+        print('The search index has not yet been built.')
+        return
     duration = time.time() - starttime
-    print('Indexed %d items in %.01f sec' % (itemcount, duration))
-    
-    val = 'create index' if args.create else 'rebuild index'
-    logging.info('CLI: %s, indexed %d items in %.01f sec', val, itemcount, duration)
-    
+
+    if after is None:
+        print('No merge needed (%d segment%s, %.1f%% deleted)' % (len(before.segments), '' if len(before.segments) == 1 else 's', before.deletedratio()*100,))
+        return
+    print('Merged %d segments (%d deleted documents) into %d in %.01f sec' % (len(before.segments), before.deleted, len(after.segments), duration,))
+    print('Current index:', indexdir)
+    if removed:
+        print('Removed old index files:', ', '.join(removed))
+    logging.info('CLI: optimize index, %d segments to %d in %.01f sec', len(before.segments), len(after.segments), duration)
+
+def search_daemon(args, socketpath):
+    """Hand a search to the search daemon and display the result(s).
+    Returns False if the daemon isn't available, in which case the
+    caller should search in-process.
+    """
+    from searchlib.daemon import query_daemon
+
+    starttime = time.time()
+    try:
+        res = query_daemon(socketpath, args.query, page=args.page, limit=args.limit, sort=args.sort)
+    except (OSError, ValueError):
+        return False
+    duration = time.time() - starttime
+
+    if 'error' in res:
+        print(res.get('message', res['error']))
+        return True
+
+    show_results(res['query'], res['page'], res['pagelen'], res['resultcount'], res['results'], res['correction'], duration, facets=res.get('facets'), showsize=(args.sort == 'largest'))
+    return True
+
 def cmd_search(args, app):
     """Perform a search and display the result(s).
+
+    If the search daemon is running (see cmd_serve), the search is sent
+    to it. Otherwise, or with --local, we open the index and search
+    in-process.
+
+    Use --sort to list the results newest first, oldest first, or
+    largest first, rather than by relevance.
+
+    Use --all to export every result rather than a page, one per line,
+    as JSON (--format jsonl, the default) or tab-separated fields
+    (--format tsv). Results come in index order, unless you give
+    --order score. An export always runs in-process.
     """
+    from searchlib.searchapp import SearchError, jsonresult
+    from searchlib.facets import jsonfacets
+
+    if args.all:
+        cmd_export(args, app)
+        return
+
+    pagelen = args.limit or app.pagelen
+    starttime = time.time()
     try:
-        query = app.queryparser.parse(args.query)
-    except Exception as ex:
-        print('query parse failed (%s)' % (ex,))
+        res = app.search(args.query, args.page, pagelen, sort=args.sort)
+    except SearchError as ex:
+        print(ex.message)
+        logging.warning('CLI: search "%s" failed (%s)', args.query, ex.message)
         return
+    duration = time.time() - starttime
     
-    with app.getsearcher() as searcher:
-        pagelen = args.limit or app.pagelen
-        try:
-            results = search_page_timeout(searcher, query, args.page, pagelen=pagelen, timeout=app.querytimeout)
-        except TimeLimit as ex:
-            print('Query time limit (%.03f sec) exceeded' % (app.querytimeout,))
-            logging.warning('CLI: search "%s" timed out', args.query)
-            return
-            
-        resultcount = len(results)
-
-        pagecount = ((resultcount+pagelen-1) // pagelen)
-        showmin = (args.page-1) * pagelen + 1
-        showmax = min(showmin+pagelen-1, resultcount)
-
-        corrected = searcher.correct_query(query, args.query)
-        if corrected.query != query and corrected.string != args.query:
-            print('Did you mean: "%s"' % (corrected.string,))
-        
-        if not len(results):
-            print('No results')
-            return
+    logging.info('CLI: search "%s" %s', args.query, res.lognote())
 
-        if resultcount > pagelen:
-            val = 'page %d (%d-%d) of ' % (args.page, showmin, showmax,)
-        else:
-            val = ''
-        print('Showing %s%d results in %.04f sec:' % (val, len(results), results.results.runtime,))
-        print()
-        
-        pagestr = '' if (args.page == 1) else ('page %d, ' % (args.page,))
-        logging.info('CLI: search "%s" (%d results, %s%.04f sec)', args.query, len(results), pagestr, results.results.runtime)
-                
-        for res in results:
-            fields = res.fields()
-            if 'date' in fields:
-                val = '(%s: %s)' % (fields['type'], fields.get('date'),)
-            else:
-                val = '(%s)' % (fields['type'],)
-            print('* %s  %s' % (fields['path'], val,))
-            if 'shortdesc' in fields:
-                print(fields['shortdesc'].replace('\n', ' '))
-            print()
+    results = [ jsonresult(obj) for obj in res.results ]
+    show_results(args.query, args.page, pagelen, res.resultcount, results, res.correctstr, duration, facets=jsonfacets(res.facets), showsize=(args.sort == 'largest'))
+
+def cmd_export(args, app):
+    """Write every result of a search to stdout. (See cmd_search.)
+    """
+    from searchlib.searchapp import SearchError
+
+    starttime = time.time()
+    try:
+        lines = app.export(args.query, format=args.format, order=args.order)
+    except SearchError as ex:
+        print(ex.message)
+        logging.warning('CLI: export "%s" failed (%s)', args.query, ex.message)
+        return
+    count = 0
+    for line in lines:
+        sys.stdout.write(line)
+        count += 1
+    duration = time.time() - starttime
+    if args.format == 'tsv':
+        count -= 1
+    logging.info('CLI: export "%s" (%s, %s order), %d lines in %.03f sec', args.query, args.format, args.order, count, duration)
+
+def show_results(querystr, pagenum, pagelen, resultcount, results, correctstr, duration, facets=None, showsize=False):
+    """Print a page of search results. The results (and facets) are in
+    the JSON form (see searchapp.jsonresult() and facets.jsonfacets()),
+    so this works for both in-process and daemon searches. If showsize
+    is set, file sizes are shown too.
+    """
+    if correctstr:
+        print('Did you mean: "%s"' % (correctstr,))
     
+    if not resultcount:
+        print('No results')
+        return
+
+    pagecount = ((resultcount+pagelen-1) // pagelen)
+    pagenum = max(1, min(pagenum, pagecount))
+    showmin = (pagenum-1) * pagelen + 1
+    showmax = min(showmin+pagelen-1, resultcount)
+
+    if resultcount > pagelen:
+        val = 'page %d (%d-%d) of ' % (pagenum, showmin, showmax,)
+    else:
+        val = ''
+    print('Showing %s%d results in %.04f sec:' % (val, resultcount, duration,))
+    print()
     
+    for fields in results:
+        if 'date' in fields:
+            val = '(%s: %s)' % (fields['type'], fields['date'].replace('T', ' '),)
+        else:
+            val = '(%s)' % (fields['type'],)
+        if showsize and 'size' in fields:
+            val = '%s (%d bytes)' % (val, fields['size'],)
+        print('* %s  %s' % (fields['path'], val,))
+        if 'shortdesc' in fields:
+            print(fields['shortdesc'].replace('\n', ' '))
+        print()
+
+    if facets:
+        # Each refinement is the query plus one term; show the term.
+        print('Narrow the search with:')
+        for (name, values) in facets.items():
+            ls = [ '%s (%d)' % (val['query'][ len(querystr) : ].strip(), val['count'],) for val in values ]
+            print('  %s' % (', '.join(ls),))
+
+def cmd_serve(args, app):
+    """Run the search daemon. This keeps the search index open and
+    answers queries on a Unix-domain socket, so that "search.wsgi search"
+    doesn't have to start up the whole app each time.
+
+    The daemon picks up a rebuilt index automatically. Stop it with
+    SIGTERM or ^C.
+    """
+    from searchlib.daemon import serve, DaemonRunning
+
+    socketpath = args.socket or app.searchsocket
+    if not socketpath:
+        print('No socket path: use --socket or set SearchSocket in the config')
+        return
+    if not app.searchindex:
+        print('The search index has not yet been built.')
+        return
+
+    if app.warmupenabled:
+        app.warmup()
+
+    print('Listening on %s' % (socketpath,))
+    try:
+        serve(app, socketpath)
+    except DaemonRunning as ex:
+        print(ex)
+
+def cmd_startup(args, app):
+    """Report how long it took to create the app instance, then time a
+    warm-up (see SearchApp.warmup()), whether or not Warmup is set in
+    the config. This is the cold-start cost a new web app process pays.
+
+    For a breakdown of the import time by module, run:
+
+        python3 -X importtime search.wsgi startup
+    """
+    # The command line skips the warm-up stage, so that isn't reported.
+    for stage in ('import', 'init'):
+        val = app.startuptimes.get(stage, 0)
+        print('%s: %.3f sec' % (stage, val,))
+    starttime = time.perf_counter()
+    app.warmup()
+    print('warmup: %.3f sec' % (time.perf_counter() - starttime,))
+    if app.warmupqueries:
+        print('(including %d warmup queries)' % (len(app.warmupqueries),))
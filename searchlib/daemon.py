@@ -0,0 +1,183 @@
+"""daemon:
+
+The search daemon. "search.wsgi serve" keeps the search index open (with
+a pool of warm searchers and the result caches) and answers queries on
+a Unix-domain socket. "search.wsgi search" hands its query to the daemon
+if one is running, which saves the cost of starting up the whole app
+for every command-line lookup.
+
+The protocol is line-delimited JSON. The client sends one request per
+line:
+
+    {"query": "zork", "page": 1, "limit": 10, "sort": "newest"}
+
+("page", "limit", and "sort" are optional.) The daemon replies with one
+line:
+
+    {"query": "zork", "page": 1, "pagelen": 10, "pagecount": 3,
+     "sort": "newest", "resultcount": 25, "correction": null,
+     "runtime": 0.012, "cached": false, "results": [ ... ],
+     "facets": { ... }}
+
+or, if the search failed:
+
+    {"error": "timeout", "message": "..."}
+
+The error codes are "badrequest", "noindex", "parse", "sort", and
+"timeout".
+A connection can carry any number of requests.
+
+This module must not import Whoosh or Jinja at the top level; the client
+side is meant to be cheap.
+"""
+
+import os
+import json
+import socket
+import socketserver
+import logging
+
+# Longest request line we'll accept.
+MAX_REQUEST = 65536
+
+def query_daemon(socketpath, querystr, page=1, limit=0, sort=None, timeout=5.0):
+    """Send one search to the daemon and return the decoded reply (a
+    dict). Raises OSError if the daemon can't be reached or doesn't
+    answer in time; the caller should fall back to searching
+    in-process.
+    """
+    req = { 'query': querystr, 'page': page }
+    if limit:
+        req['limit'] = limit
+    if sort:
+        req['sort'] = sort
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(socketpath)
+        sock.sendall(json.dumps(req).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as fl:
+            line = fl.readline()
+    finally:
+        sock.close()
+    if not line.endswith(b'\n'):
+        raise ConnectionError('incomplete reply from search daemon')
+    return json.loads(line)
+
+class DaemonRunning(Exception):
+    """Raised if a daemon is already listening on the socket.
+    """
+    pass
+
+class SearchRequestHandler(socketserver.StreamRequestHandler):
+    """Handles one client connection, which may send several requests.
+    """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST)
+            if not line:
+                return
+            if not line.endswith(b'\n'):
+                self.reply({ 'error': 'badrequest', 'message': 'Request too long' })
+                return
+            if not line.strip():
+                continue
+            self.reply(self.server.respond(line))
+
+    def reply(self, obj):
+        self.wfile.write(json.dumps(obj).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+class SearchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """The daemon itself. Each connection gets a thread; the threads share
+    the app's searcher pool and caches, which are thread-safe.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socketpath, app):
+        self.app = app
+        self.socketpath = socketpath
+        self.bound = False
+        socketserver.UnixStreamServer.__init__(self, socketpath, SearchRequestHandler)
+
+    def server_bind(self):
+        # A socket file left over from a daemon which didn't shut down
+        # cleanly would make bind() fail. Remove it, but only if nothing
+        # is listening on it.
+        if os.path.exists(self.socketpath):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socketpath)
+            except OSError:
+                os.unlink(self.socketpath)
+            else:
+                raise DaemonRunning('Search daemon already running on ' + self.socketpath)
+            finally:
+                sock.close()
+        socketserver.UnixStreamServer.server_bind(self)
+        self.bound = True
+        # The search results are public, so anyone on the machine may
+        # connect. (The daemon never writes to the index.)
+        os.chmod(self.socketpath, 0o666)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        # Only remove the socket file if it's ours.
+        if self.bound:
+            self.bound = False
+            try:
+                os.unlink(self.socketpath)
+            except FileNotFoundError:
+                pass
+
+    def respond(self, line):
+        """Handle one request line. Returns the reply as a dict.
+        """
+        from searchlib.searchapp import SearchError
+        from searchlib.metrics import Timings
+        from searchlib.sortmodes import RELEVANCE
+
+        app = self.app
+        try:
+            req = json.loads(line)
+            querystr = req['query'].strip()
+            pagenum = max(1, int(req.get('page', 1)))
+            pagelen = int(req.get('limit', 0)) or app.pagelen
+            if pagelen < 0:
+                raise ValueError('negative limit')
+            sort = req.get('sort') or RELEVANCE
+        except Exception as ex:
+            return { 'error': 'badrequest', 'message': 'Bad request: %s' % (ex,) }
+
+        timings = Timings()
+        try:
+            res = app.search(querystr, pagenum, pagelen, timings=timings, sort=sort)
+        except SearchError as ex:
+            logging.warning('socket: search "%s" failed (%s)', querystr, ex.message)
+            app.recordtimings(None, 'socket', querystr, timings, ex.code)
+            return { 'error': ex.code, 'message': ex.message }
+
+        logging.info('socket: search "%s" %s', querystr, res.lognote())
+        app.recordtimings(None, 'socket', querystr, timings, res.outcome())
+        return res.tojson(runtime=timings.total())
+
+def serve(app, socketpath):
+    """Run the daemon until it's interrupted (SIGINT or SIGTERM).
+    """
+    import signal
+
+    def sigterm(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, sigterm)
+
+    server = SearchServer(socketpath, app)
+    logging.info('socket: daemon listening on %s', socketpath)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info('socket: daemon shut down')
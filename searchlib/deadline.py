@@ -0,0 +1,124 @@
+"""deadline:
+
+Query time limits without a thread per query.
+
+Whoosh's TimeLimitCollector (in its cooperative mode, which is the only
+one we can use under Apache -- SIGALRM is out) starts a threading.Timer
+for every search. Starting and cancelling that thread costs around a
+tenth of a millisecond, which is several times the cost of a typical
+narrow search.
+
+Instead, we keep one watchdog thread per process. A DeadlineCollector
+registers its deadline with the watchdog when the search starts; if the
+deadline passes before the search finishes, the watchdog sets the
+collector's timedout flag, and the collector raises TimeLimit at the
+next document, exactly as TimeLimitCollector does.
+"""
+
+import os
+import time
+import heapq
+import itertools
+import threading
+
+from whoosh.collectors import WrappingCollector
+from whoosh.searching import TimeLimit
+
+class Watchdog:
+    """A single thread which fires timeouts. Each registered collector
+    has its timedout attribute set to True when its deadline passes,
+    unless it's been cancelled first.
+
+    The thread is started on first use. A forked child starts over
+    with a fresh state (threads don't survive a fork, and the lock might
+    have been held at the time).
+    """
+
+    def __init__(self):
+        self.counter = itertools.count()
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.cond = threading.Condition()
+        # Heap of [deadline, seq, collector] entries. Cancelled entries
+        # have their collector set to None and are discarded when they
+        # reach the top.
+        self.heap = []
+        self.thread = None
+
+    def register(self, collector, timelimit):
+        """Start the clock on a collector. Returns a handle for
+        cancel().
+        """
+        entry = [ time.monotonic() + timelimit, next(self.counter), collector ]
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, args=(self.cond, self.heap), name='search-watchdog', daemon=True)
+                self.thread.start()
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                # New earliest deadline; the thread must recompute its wait.
+                self.cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        """Stop the clock. (Harmless if the deadline has already passed.)
+        """
+        # Storing into a list slot is atomic, so we don't need the lock.
+        # The entry stays in the heap until its deadline comes up.
+        entry[2] = None
+
+    def _run(self, cond, heap):
+        with cond:
+            while True:
+                while heap and heap[0][2] is None:
+                    heapq.heappop(heap)
+                if not heap:
+                    cond.wait()
+                    continue
+                delay = heap[0][0] - time.monotonic()
+                if delay > 0:
+                    cond.wait(delay)
+                    continue
+                entry = heapq.heappop(heap)
+                collector = entry[2]
+                if collector is not None:
+                    collector.timedout = True
+
+watchdog = Watchdog()
+
+class DeadlineCollector(WrappingCollector):
+    """A drop-in replacement for TimeLimitCollector(child, timelimit,
+    use_alarm=False), using the shared watchdog thread. Raises
+    whoosh.searching.TimeLimit if the search runs out of time.
+    """
+
+    def __init__(self, child, timelimit):
+        self.child = child
+        self.timelimit = timelimit
+        self.timedout = False
+        self.entry = None
+
+    def prepare(self, top_searcher, q, context):
+        self.child.prepare(top_searcher, q, context)
+        self.timedout = False
+        self.entry = watchdog.register(self, self.timelimit)
+
+    def collect_matches(self):
+        collect = self.child.collect
+        for sub_docnum in self.child.matches():
+            if self.timedout:
+                self._cancel()
+                raise TimeLimit
+            collect(sub_docnum)
+
+    def finish(self):
+        self._cancel()
+        self.child.finish()
+
+    def _cancel(self):
+        if self.entry is not None:
+            watchdog.cancel(self.entry)
+            self.entry = None
@@ -0,0 +1,126 @@
+"""export:
+
+Streaming export of complete result sets, for mirror operators and
+catalogue tools which want every match of a query like "dir:games",
+not just the first few pages.
+
+Nothing is materialized. In docnum order (the default), matches come
+straight from the matcher. In score order, we run the query in batches
+of EXPORT_BATCH: each pass keeps the top batch which ranks below the
+end of the previous one, in a bounded heap. Either way, memory use is
+constant; score order costs a pass over the matches per batch.
+
+Each match is written as one line: a JSON object ("jsonl"), or
+tab-separated fields after a header line ("tsv"). If the export runs
+past its time limit, it stops with a final error line (a JSON object
+with "error", or a TSV line starting with "#").
+"""
+
+import time
+import json
+
+from whoosh.collectors import TopCollector
+
+EXPORT_FORMATS = ('jsonl', 'tsv')
+EXPORT_ORDERS = ('docnum', 'score')
+
+# The stored fields which are exported, in TSV column order.
+EXPORT_FIELDS = [ 'path', 'type', 'date', 'size', 'shortdesc' ]
+
+# Matches per pass in score order.
+EXPORT_BATCH = 1000
+
+# How often (in matches) to check the time limit.
+CHECK_INTERVAL = 256
+
+class ExportTimeout(Exception):
+    pass
+
+class BelowCollector(TopCollector):
+    """A TopCollector which ignores documents that rank at or above a
+    bound: a (score, -docnum) pair, as in TopCollector's heap. The
+    block-quality optimizations are off, since they'd skip the very
+    documents we want.
+    """
+    def __init__(self, bound, limit):
+        TopCollector.__init__(self, limit=limit, usequality=False, replace=0)
+        self.bound = bound
+
+    def _collect(self, global_docnum, score):
+        if self.bound is not None and (score, 0 - global_docnum) >= self.bound:
+            return 0
+        return TopCollector._collect(self, global_docnum, score)
+
+def iter_scored(searcher, query, batch=EXPORT_BATCH):
+    """Yield (docnum, score) for every match of the query, best first.
+    """
+    bound = None
+    while True:
+        col = BelowCollector(bound, batch)
+        searcher.search_with_collector(query, col)
+        items = col.results().top_n
+        for (score, docnum) in items:
+            yield (docnum, score)
+        if len(items) < batch:
+            return
+        (score, docnum) = items[-1]
+        bound = (score, 0 - docnum)
+
+def iter_docnums(searcher, query):
+    """Yield (docnum, None) for every match of the query, in docnum
+    order.
+    """
+    for docnum in searcher.docs_for_query(query):
+        yield (docnum, None)
+
+def export_value(key, val):
+    if key == 'date' and val is not None:
+        return val.isoformat()
+    return val
+
+def export_lines(searcher, query, format='jsonl', order='docnum', timeout=60.0):
+    """Yield the export of a query, one line (with its newline) at a
+    time. The searcher must stay checked out until the generator is
+    finished or closed.
+    """
+    if order == 'score':
+        matches = iter_scored(searcher, query)
+    else:
+        matches = iter_docnums(searcher, query)
+    withscore = (order == 'score')
+    deadline = time.monotonic() + timeout
+
+    if format == 'tsv':
+        header = EXPORT_FIELDS + ([ 'score' ] if withscore else [])
+        yield '\t'.join(header) + '\n'
+
+    count = 0
+    try:
+        for (docnum, score) in matches:
+            count += 1
+            if count % CHECK_INTERVAL == 0 and time.monotonic() > deadline:
+                raise ExportTimeout()
+            fields = searcher.stored_fields(docnum)
+            if format == 'tsv':
+                ls = []
+                for key in EXPORT_FIELDS:
+                    val = export_value(key, fields.get(key))
+                    ls.append('' if val is None else ' '.join(str(val).split()))
+                if withscore:
+                    ls.append('%.4f' % (score,))
+                yield '\t'.join(ls) + '\n'
+            else:
+                obj = {}
+                for key in EXPORT_FIELDS:
+                    val = fields.get(key)
+                    if val is not None:
+                        obj[key] = export_value(key, val)
+                if withscore:
+                    obj['score'] = score
+                yield json.dumps(obj) + '\n'
+    except ExportTimeout:
+        message = 'Export time limit (%.0f sec) exceeded after %d results' % (timeout, count - 1,)
+        if format == 'tsv':
+            yield '# error: %s\n' % (message,)
+        else:
+            yield json.dumps({ 'error': 'timeout', 'message': message }) + '\n'
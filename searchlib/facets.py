@@ -0,0 +1,173 @@
+"""facets:
+
+Result counts by top-level directory, item type, and year, so that a
+search can offer one-click refinements: "games (120)", "2019 (14)".
+
+The counts are collected in the same pass as the search itself (a whoosh
+FacetCollector wraps the usual collector), from the sortable columns of
+the topdir, type, and date fields. They're kept in the result window,
+so they're cached per query and index generation along with the hits.
+
+An index built before the topdir and type columns existed has only the
+year facet. A full build fixes that.
+"""
+
+import datetime
+
+from whoosh import sorting
+
+# (name, field, label). The name is also the prefix of the refinement
+# query, except that years are refined with "date:".
+FACETS = [
+    ('topdir', 'topdir', 'Directory'),
+    ('type', 'type', 'Type'),
+    ('year', 'date', 'Year'),
+]
+REFINE_PREFIX = { 'year': 'date' }
+
+# Whoosh stores a DATETIME column value as microseconds since
+# datetime.min. Documents with no date get the column's default, which
+# is out of range.
+USEC_PER_DAY = 86400 * 1000000
+MAX_ORDINAL = datetime.date.max.toordinal()
+
+def create_facets(schema):
+    """Return a whoosh Facets object (suitable for the groupedby
+    argument of a search) for the facets which the schema supports, or
+    None if it supports none. The object can be shared between threads.
+    It caches column values by segment, so make a new one for each
+    index.
+    """
+    facets = sorting.Facets()
+    for (name, fieldname, label) in FACETS:
+        if fieldname not in schema or getattr(schema[fieldname], 'column_type', None) is None:
+            # Not sortable, so there's no column to count from.
+            continue
+        convert = date_year if name == 'year' else None
+        facets.add_facet(name, ColumnFacet(fieldname, convert))
+    if not facets.names():
+        return None
+    return facets
+
+def date_year(val):
+    """Convert a raw DATETIME column value to a year, or None if the
+    document has no date.
+    """
+    ordinal = val // USEC_PER_DAY + 1
+    if ordinal > MAX_ORDINAL:
+        return None
+    return datetime.date.fromordinal(ordinal).year
+
+class ColumnFacet(sorting.FacetType):
+    """Counts documents by the value of a sortable field, optionally
+    converted by a function of the raw column value.
+
+    Whoosh's FieldFacet looks up and translates the column value for
+    every matching document, which is the bulk of the cost of a broad
+    search. Instead, the first search to touch a segment reads the
+    whole column into a list, and later searches just index it.
+    (Segments never change once written.)
+    """
+    def __init__(self, fieldname, convert=None):
+        self.fieldname = fieldname
+        self.convert = convert
+        self.maptype = sorting.Count
+        # Maps segment IDs to lists of values.
+        self.columns = {}
+
+    def categorizer(self, global_searcher):
+        return ColumnFacetCategorizer(self)
+
+    def column_values(self, reader):
+        segment = reader.segment() if hasattr(reader, 'segment') else None
+        key = segment.segment_id() if segment is not None else None
+        values = self.columns.get(key) if key is not None else None
+        if values is None:
+            convert = self.convert
+            if convert is None:
+                creader = reader.column_reader(self.fieldname)
+                # Share equal strings between documents.
+                shared = {}
+                values = [ shared.setdefault(val, val) for val in creader ]
+            else:
+                creader = reader.column_reader(self.fieldname, translate=False)
+                values = [ convert(val) for val in creader ]
+            if key is not None:
+                self.columns[key] = values
+        return values
+
+class ColumnFacetCategorizer(sorting.Categorizer):
+    def __init__(self, facet):
+        self.facet = facet
+        self.values = None
+
+    def set_searcher(self, segment_searcher, docoffset):
+        self.values = self.facet.column_values(segment_searcher.reader())
+
+    def key_for(self, matcher, segment_docnum):
+        return self.values[segment_docnum]
+
+class Facet:
+    """One facet of a page of search results, for display: a name, a
+    label, and a list of FacetValues.
+    """
+    def __init__(self, name, label, values):
+        self.name = name
+        self.label = label
+        self.values = values
+
+class FacetValue:
+    """One value of a facet: its count, and the query string which
+    narrows the search to it.
+    """
+    __slots__ = ('value', 'count', 'query')
+
+    def __init__(self, value, count, query):
+        self.value = value
+        self.count = count
+        self.query = query
+
+def refine_query(querystr, name, value):
+    """Return the query string narrowed to one facet value.
+    """
+    prefix = REFINE_PREFIX.get(name, name)
+    val = str(value)
+    if not val.isalnum():
+        # Directory names may contain punctuation which the query
+        # parser would otherwise split on.
+        val = "'%s'" % (val,)
+    return '%s %s:%s' % (querystr, prefix, val)
+
+def build_facets(counts, querystr, resultcount, limit=10):
+    """Turn the facet counts of a search (a dict mapping facet names to
+    {value: count} dicts) into a list of Facets for display.
+
+    Values which wouldn't narrow the search (because every result has
+    them) are left out, as are documents with no value. Directories and
+    types are listed most common first, years newest first; each facet
+    is cut to limit values. Facets with no values left are dropped.
+    """
+    if not counts:
+        return []
+    res = []
+    for (name, fieldname, label) in FACETS:
+        groups = counts.get(name)
+        if not groups:
+            continue
+        ls = [ (value, count) for (value, count) in groups.items() if value not in (None, '') and count < resultcount ]
+        if name == 'year':
+            ls.sort(key=lambda tup: tup[0], reverse=True)
+        else:
+            ls.sort(key=lambda tup: (-tup[1], tup[0]))
+        if limit:
+            ls = ls[ : limit ]
+        if ls:
+            values = [ FacetValue(value, count, refine_query(querystr, name, value)) for (value, count) in ls ]
+            res.append(Facet(name, label, values))
+    return res
+
+def jsonfacets(facets):
+    """Return a list of Facets in JSON-ready form: a dict mapping facet
+    names to lists of {value, count, query} dicts.
+    """
+    return { facet.name: [ { 'value': val.value, 'count': val.count, 'query': val.query } for val in facet.values ] for facet in facets }
@@ -0,0 +1,142 @@
+"""generations:
+
+The layout of the search index directory.
+
+Each build writes a complete new index into its own subdirectory of
+SearchIndexDir (a "generation" directory, named gen-YYYYMMDD-HHMMSS).
+When it's finished, the build atomically replaces the "current" file,
+which contains the name of the generation to use. The web app checks
+that file on each request and switches to the new generation when it
+changes. So readers never see a half-written index, never contend with
+the writer for its lock, and a schema change doesn't need a restart.
+
+A few old generations are kept around (KeepGenerations in the config),
+because searches which started just before the switch may still be
+reading them. Older ones are deleted at the end of each build.
+
+If there's no "current" file, the index lives directly in SearchIndexDir.
+That's the layout from before generations existed; we can still read
+it, and the first generation build replaces it.
+"""
+
+import os, os.path
+import time
+import shutil
+
+CURRENT_FILE = 'current'
+GENERATION_PREFIX = 'gen-'
+
+# Files which whoosh (and the build) keep in an index directory. These
+# are what we clean out of a legacy SearchIndexDir.
+LEGACY_SUFFIXES = ( '.toc', '.seg', '_WRITELOCK', '_LOCK' )
+LEGACY_FILES = ( 'manifest.json', 'spelling.txt' )
+
+def read_current(searchindexdir):
+    """Return the name of the current generation, or None if there's no
+    "current" file (the legacy layout).
+    """
+    try:
+        with open(os.path.join(searchindexdir, CURRENT_FILE), encoding='utf-8') as fl:
+            name = fl.read().strip()
+    except FileNotFoundError:
+        return None
+    if not name.startswith(GENERATION_PREFIX) or '/' in name:
+        raise Exception('Bad generation name in %s: %r' % (CURRENT_FILE, name,))
+    return name
+
+def current_indexdir(searchindexdir):
+    """Return the directory containing the current index: the current
+    generation, or SearchIndexDir itself in the legacy layout.
+    """
+    name = read_current(searchindexdir)
+    if name is None:
+        return searchindexdir
+    return os.path.join(searchindexdir, name)
+
+def list_generations(searchindexdir):
+    """Return the names of all generation directories, oldest first.
+    """
+    ls = [ name for name in os.listdir(searchindexdir) if name.startswith(GENERATION_PREFIX) and os.path.isdir(os.path.join(searchindexdir, name)) ]
+    ls.sort()
+    return ls
+
+def new_generation(searchindexdir):
+    """Create a new, empty generation directory and return its path.
+    """
+    base = GENERATION_PREFIX + time.strftime('%Y%m%d-%H%M%S')
+    name = base
+    count = 1
+    while True:
+        path = os.path.join(searchindexdir, name)
+        try:
+            os.mkdir(path)
+            return path
+        except FileExistsError:
+            count += 1
+            name = '%s-%d' % (base, count)
+
+def clone_generation(srcdir, destdir):
+    """Fill destdir with the contents of srcdir, as hard links. Whoosh
+    never modifies a segment file once written, so the two indexes can
+    share them; an incremental build then adds new segments and a new
+    TOC to destdir without touching srcdir. (Our own files, the manifest
+    and word list, are replaced rather than rewritten.) Lock files are
+    not copied.
+    """
+    for name in os.listdir(srcdir):
+        if name.endswith('LOCK') or name == CURRENT_FILE:
+            continue
+        srcpath = os.path.join(srcdir, name)
+        if not os.path.isfile(srcpath):
+            continue
+        destpath = os.path.join(destdir, name)
+        try:
+            os.link(srcpath, destpath)
+        except OSError:
+            shutil.copy2(srcpath, destpath)
+
+def switch_current(searchindexdir, indexdir):
+    """Make indexdir (a generation directory) the current one. This is
+    atomic: readers see either the old generation or the new one.
+    """
+    name = os.path.basename(indexdir)
+    path = os.path.join(searchindexdir, CURRENT_FILE)
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w', encoding='utf-8') as fl:
+        fl.write(name + '\n')
+        fl.flush()
+        os.fsync(fl.fileno())
+    os.replace(tmppath, path)
+
+def collect_garbage(searchindexdir, keep=2):
+    """Delete old generations, keeping the current one and the most
+    recent ones up to a total of keep. Once there are enough generations,
+    a leftover legacy index in SearchIndexDir itself is deleted too.
+    Returns a list of what was deleted.
+    """
+    current = read_current(searchindexdir)
+    if current is None:
+        return []
+    keep = max(1, keep)
+    names = list_generations(searchindexdir)
+    keepset = set([ current ])
+    for name in reversed(names):
+        if len(keepset) >= keep:
+            break
+        keepset.add(name)
+
+    removed = []
+    for name in names:
+        if name not in keepset:
+            shutil.rmtree(os.path.join(searchindexdir, name), ignore_errors=True)
+            removed.append(name)
+
+    # The legacy index counts as older than any generation.
+    if len(names) >= keep:
+        for name in os.listdir(searchindexdir):
+            if name.endswith(LEGACY_SUFFIXES) or name in LEGACY_FILES:
+                path = os.path.join(searchindexdir, name)
+                if os.path.isfile(path):
+                    os.remove(path)
+                    removed.append(name)
+    return removed
@@ -1,5 +1,6 @@
 import xml.sax
 import xml.sax.handler
+import xml.etree.ElementTree
 
 """ifarchivexml:
 
@@ -28,9 +29,24 @@ directory-tree order, so your callbacks will encounter parents before
 children. In this mode, the parentobj and directoryobj fields of IFDir and
 IFFile will not be set.
 
+Both forms also accept a snapshot argument, which is the path of a
+compact binary copy of the parsed file (see snapshot.py). If the
+snapshot is current (it records the size and mtime of the XML file),
+it's loaded instead of parsing the XML, which is much faster.
+Otherwise the XML is parsed as usual and the snapshot is rewritten.
+
+Both forms accept a backend argument. The default, 'etree', uses
+ElementTree.iterparse() and builds each IFDir or IFFile from its
+completed element. 'sax' is the original xml.sax handler. They produce
+identical results, but the etree backend does most of its work in C
+and is considerably faster.
+
 Dec 2019: Updated to Python 3; added sha512 and metadata fields.
 Apr 2025: Added parentdesc field; support date and metadata fields for
   directories; removed xdir field. Added the parse_callback() form.
+Oct 2026: Added the etree backend. IFDir and IFFile use __slots__.
+  Added snapshots. In the tree form, directory names and parentdesc
+  strings are shared between objects.
 """
 
 CONTEXT_NONE = 0
@@ -42,11 +58,23 @@ CONTEXT_METADATA = 5
 CONTEXT_METAITEM = 5
 
 class IFDir:
-    description = None
-    date = None
-    rawdate = None
-    metadata = None
+    __slots__ = (
+        'name', 'parent', 'parentobj', 'subdircount', 'filecount',
+        'description', 'date', 'rawdate', 'metadata',
+        'subdirs', 'files', 'parentdescs',
+    )
     def __init__(self):
+        # Every slot gets a value, since any element but <name> may be
+        # missing from Master-Index.xml.
+        self.name = None
+        self.parent = None
+        self.parentobj = None
+        self.subdircount = None
+        self.filecount = None
+        self.description = None
+        self.date = None
+        self.rawdate = None
+        self.metadata = None
         self.subdirs = []
         self.files = []
         self.parentdescs = {}
@@ -75,15 +103,29 @@ class IFDir:
             print(' ', str(file))
 
 class IFFile:
-    size = None
-    date = None
-    md5 = None
-    sha512 = None
-    rawdate = None
-    symlink = None
-    metadata = None
-    description = None
+    __slots__ = (
+        'name', 'path', 'directory', 'directoryobj', 'orderindex',
+        'size', 'date', 'rawdate', 'md5', 'sha512',
+        'symlink', 'symlinkname', 'symlinkpath',
+        'metadata', 'description', 'parentdescs',
+    )
     def __init__(self):
+        # As with IFDir, every slot gets a value.
+        self.name = None
+        self.path = None
+        self.directory = None
+        self.directoryobj = None
+        self.orderindex = None
+        self.size = None
+        self.date = None
+        self.md5 = None
+        self.sha512 = None
+        self.rawdate = None
+        self.symlink = None
+        self.symlinkname = None
+        self.symlinkpath = None
+        self.metadata = None
+        self.description = None
         self.parentdescs = {}
     def __repr__(self):
         return '<IFFile \'' + self.path + '\'>'
@@ -127,7 +169,16 @@ class IFAParser(xml.sax.handler.ContentHandler):
             self.filecallback = callbacks[1]
             self.directories = None
             self.files = None
-        self.grabbeddata = ''
+        # In the tree form, maps strings to a shared copy of themselves.
+        # See share().
+        self.shared = None if self.callbackmode else {}
+        # A SnapshotWriter, if we're writing a snapshot of the parse.
+        self.snapshotwriter = None
+        # Text chunks are collected in a list and joined at the end of
+        # the element. We only collect while grabbing is set, which is
+        # to say inside an element whose text we want.
+        self.grabbeddata = []
+        self.grabbing = False
         self.curdir = None
         self.curfile = None
         self.curitem = None
@@ -158,7 +209,8 @@ class IFAParser(xml.sax.handler.ContentHandler):
         }
         
     def characters(self, data):
-        self.grabbeddata = (self.grabbeddata + data)
+        if self.grabbing:
+            self.grabbeddata.append(data)
 
     def startElement(self, name, attrs):
         if (name not in self.elements):
@@ -171,6 +223,10 @@ class IFAParser(xml.sax.handler.ContentHandler):
             return
         (startfunc, endfunc) = self.elements.get(name)
         endfunc()
+        if self.grabbing:
+            # The end handler didn't want the text (a <path> in a
+            # directory, say). Drop it and stop collecting.
+            self.grabdata()
 
     def ignore_start(self, dict):
         pass
@@ -178,10 +234,12 @@ class IFAParser(xml.sax.handler.ContentHandler):
         pass
 
     def grabdata_start(self, dict):
-        self.grabbeddata = ''
+        self.grabbeddata = []
+        self.grabbing = True
     def grabdata(self):
-        dat = self.grabbeddata
-        self.grabbeddata = ''
+        dat = ''.join(self.grabbeddata)
+        self.grabbeddata = []
+        self.grabbing = False
         return dat
 
     def directory_start(self, dict):
@@ -191,13 +249,42 @@ class IFAParser(xml.sax.handler.ContentHandler):
         elif (self.context == CONTEXT_FILE):
             self.grabdata_start(None)
 
+    def share(self, obj):
+        """Replace the object's directory name and parentdesc strings
+        with shared copies. Every file in a directory carries the same
+        ones, so in the tree form this saves a lot of memory.
+        """
+        shared = self.shared
+        if isinstance(obj, IFFile):
+            obj.directory = shared.setdefault(obj.directory, obj.directory)
+        else:
+            obj.parent = shared.setdefault(obj.parent, obj.parent)
+        if obj.parentdescs:
+            obj.parentdescs = { shared.setdefault(key, key): shared.setdefault(val, val) for (key, val) in obj.parentdescs.items() }
+
+    def adddir(self, dir):
+        if self.snapshotwriter is not None:
+            self.snapshotwriter.adddir(dir)
+        if self.callbackmode:
+            self.dircallback(dir)
+        else:
+            self.share(dir)
+            self.directories[dir.name] = dir
+
+    def addfile(self, file):
+        file.orderindex = self.orderindex
+        self.orderindex = self.orderindex+1
+        if self.snapshotwriter is not None:
+            self.snapshotwriter.addfile(file)
+        if self.callbackmode:
+            self.filecallback(file)
+        else:
+            self.share(file)
+            self.files[file.path] = file
+
     def directory_end(self):
         if (self.context == CONTEXT_DIR):
-            name = self.curdir.name
-            if self.callbackmode:
-                self.dircallback(self.curdir)
-            else:
-                self.directories[name] = self.curdir
+            self.adddir(self.curdir)
             self.curdir = None
             self.context = CONTEXT_NONE
         elif (self.context == CONTEXT_FILE):
@@ -212,13 +299,7 @@ class IFAParser(xml.sax.handler.ContentHandler):
 
     def file_end(self):
         if (self.context == CONTEXT_FILE):
-            path = self.curfile.path
-            self.curfile.orderindex = self.orderindex
-            self.orderindex = self.orderindex+1
-            if self.callbackmode:
-                self.filecallback(self.curfile)
-            else:
-                self.files[path] = self.curfile
+            self.addfile(self.curfile)
             self.curfile = None
             self.context = CONTEXT_NONE
 
@@ -363,7 +444,7 @@ class IFAParser(xml.sax.handler.ContentHandler):
 
     def parentdesc_start(self, dict):
         if (self.context == CONTEXT_DIR or self.context == CONTEXT_FILE):
-            self.grabbeddata = ''
+            self.grabdata_start(None)
             self.curitem = dict['dir']
         
     def parentdesc_end(self):
@@ -392,7 +473,7 @@ class IFAParser(xml.sax.handler.ContentHandler):
         if not self.callbackmode:
             for dir in self.directories.values():
                 parent = dir.parent
-                if (parent == ''):
+                if not parent:
                     dir.parentobj = None
                 else:
                     dir.parentobj = self.directories[parent]
@@ -402,18 +483,192 @@ class IFAParser(xml.sax.handler.ContentHandler):
                 file.directoryobj = self.directories[parent]
                 file.directoryobj.files.append(file)
 
-def parse(filename):
+def eltext(el):
+    """The text content of an element, as the SAX handler would grab it.
+    """
+    if not len(el):
+        return el.text or ''
+    return ''.join(el.itertext())
+
+def elmetadata(el):
+    """Build a metadata dict from a <metadata> element.
+    """
+    metadata = {}
+    for itemel in el:
+        if itemel.tag != 'item':
+            continue
+        key = None
+        values = []
+        for subel in itemel:
+            if subel.tag == 'key':
+                key = eltext(subel)
+            elif subel.tag == 'value':
+                values.append(eltext(subel))
+        if key and values:
+            metadata[key] = values
+    return metadata
+
+def elsymlink(el, file):
+    """Fill in the symlink fields of an IFFile from a <symlink> element.
+    """
+    if el.get('type') == 'dir':
+        file.symlink = 'dir'
+        for subel in el:
+            if subel.tag == 'name':
+                file.symlinkname = eltext(subel)
+    else:
+        file.symlink = 'file'
+        for subel in el:
+            if subel.tag == 'path':
+                file.symlinkpath = eltext(subel)
+
+def elfile(el):
+    """Build an IFFile from a complete <file> element.
+    """
+    file = IFFile()
+    for subel in el:
+        tag = subel.tag
+        if tag == 'name':
+            file.name = eltext(subel)
+        elif tag == 'path':
+            file.path = eltext(subel)
+        elif tag == 'directory':
+            file.directory = eltext(subel)
+        elif tag == 'size':
+            file.size = int(eltext(subel))
+        elif tag == 'date':
+            file.date = eltext(subel)
+        elif tag == 'rawdate':
+            file.rawdate = int(eltext(subel))
+        elif tag == 'md5':
+            file.md5 = eltext(subel)
+        elif tag == 'sha512':
+            file.sha512 = eltext(subel)
+        elif tag == 'description':
+            file.description = eltext(subel)
+        elif tag == 'parentdesc':
+            file.parentdescs[subel.get('dir')] = eltext(subel)
+        elif tag == 'metadata':
+            file.metadata = elmetadata(subel)
+        elif tag == 'symlink':
+            elsymlink(subel, file)
+    return file
+
+def eldir(el):
+    """Build an IFDir from a complete <directory> element.
+    """
+    dir = IFDir()
+    for subel in el:
+        tag = subel.tag
+        if tag == 'name':
+            dir.name = eltext(subel)
+        elif tag == 'parent':
+            dir.parent = eltext(subel)
+        elif tag == 'subdircount':
+            dir.subdircount = int(eltext(subel))
+        elif tag == 'filecount':
+            dir.filecount = int(eltext(subel))
+        elif tag == 'date':
+            dir.date = eltext(subel)
+        elif tag == 'rawdate':
+            dir.rawdate = int(eltext(subel))
+        elif tag == 'description':
+            dir.description = eltext(subel)
+        elif tag == 'parentdesc':
+            dir.parentdescs[subel.get('dir')] = eltext(subel)
+        elif tag == 'metadata':
+            dir.metadata = elmetadata(subel)
+    return dir
+
+BACKENDS = ('etree', 'sax')
+
+def run_parser(filename, parser, backend='etree', snapshot=None):
+    """Feed the file through an IFAParser, using the given backend.
+    If snapshot is given, load that instead if it's current; if not,
+    write it.
+    """
+    if snapshot:
+        from searchlib.snapshot import read_snapshot, SnapshotWriter
+        if read_snapshot(snapshot, filename, parser):
+            return
+        parser.snapshotwriter = SnapshotWriter(snapshot, filename)
+        try:
+            run_parser(filename, parser, backend=backend)
+            parser.snapshotwriter.finish()
+        finally:
+            parser.snapshotwriter = None
+        return
+    
+    if backend == 'sax':
+        fl = open(filename, 'r')
+        xml.sax.parse(fl, parser)
+        fl.close()
+        return
+
+    if backend != 'etree':
+        raise ValueError('Unknown parser backend: %s' % (backend,))
+
+    # We work on "end" events, when an element is complete; the only
+    # "start" event we need is the first, to get hold of the root.
+    # A <directory> element with no children is the directory field of
+    # a <file>, not a top-level directory. Once we've built an object,
+    # we detach its element from the root (clearing it alone would
+    # leave an empty shell behind for every entry), so memory use stays
+    # flat however big the file is.
+    root = None
+    for (event, el) in xml.etree.ElementTree.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = el
+            continue
+        tag = el.tag
+        if tag == 'file':
+            parser.addfile(elfile(el))
+            root.clear()
+        elif tag == 'directory' and len(el):
+            parser.adddir(eldir(el))
+            root.clear()
+        elif tag == 'ifarchive':
+            parser.ifarchive_end()
+
+def count_entries(filename, snapshot=None):
+    """Return roughly how many directories and files the file lists,
+    without parsing it. If snapshot is given and current, its count is
+    exact. Otherwise we count <name> tags in the XML: every entry has
+    one (and so does a directory symlink, so this may run a little
+    high). That's a fast scan, even for the full Master-Index.xml.
+    """
+    if snapshot:
+        from searchlib.snapshot import snapshot_count
+        count = snapshot_count(snapshot, filename)
+        if count is not None:
+            return count
+
+    tag = b'<name>'
+    count = 0
+    tail = b''
+    with open(filename, 'rb') as fl:
+        while True:
+            dat = fl.read(1 << 20)
+            if not dat:
+                break
+            # A tag may straddle two blocks; no complete tag fits in
+            # the carried-over tail, so none is counted twice.
+            dat = tail + dat
+            count += dat.count(tag)
+            tail = dat[ -(len(tag)-1) : ]
+    return count
+
+def parse(filename, backend='etree', snapshot=None):
     parser = IFAParser()
 
-    fl = open(filename, 'r')
-    xml.sax.parse(fl, parser)
-    fl.close()
+    run_parser(filename, parser, backend=backend, snapshot=snapshot)
 
     rootdir = parser.directories['if-archive']
     result = (rootdir, parser.directories, parser.files)
     return result
 
-def parse_callback(filename, dirfunc=None, filefunc=None):
+def parse_callback(filename, dirfunc=None, filefunc=None, backend='etree', snapshot=None):
     if not dirfunc:
         dirfunc = lambda obj: None
     if not filefunc:
@@ -421,7 +676,4 @@ def parse_callback(filename, dirfunc=None, filefunc=None):
         
     parser = IFAParser(callbacks=(dirfunc, filefunc))
 
-    fl = open(filename, 'r')
-    xml.sax.parse(fl, parser)
-    fl.close()
-
+    run_parser(filename, parser, backend=backend, snapshot=snapshot)
@@ -0,0 +1,779 @@
+"""indexer:
+
+The code which turns the contents of Master-Index.xml into a Whoosh
+search index. The CLI "build" command is a thin wrapper around
+build_generation(), which runs build_index() in a new generation
+directory (see generations.py) and then switches to it.
+
+A build can be full (every document is re-added and the old contents
+are cleared) or incremental. Full builds can spread the indexing work
+over several processes. For incremental builds we keep a manifest
+file in the index directory, mapping each path to a hash of the
+document we indexed for it. Only documents whose hash has changed are
+rewritten, and paths which have vanished from Master-Index.xml are
+deleted.
+
+A build's memory use is bounded by the writer's buffer (limitmb, which
+whoosh spills to temporary files when it's full) and, optionally, by
+flushing a segment every flushcount documents. The merge policy says
+what happens to the segments when the build commits; see
+MERGE_POLICIES. Under the default policy, a build also merges the whole
+index when it's in poor health (see segments.py), and optimize_generation()
+does the same on demand.
+"""
+
+import os, os.path
+import shutil
+import datetime
+import json
+import collections
+
+# The web app imports this module for the query parser, so build-only
+# modules (hashlib, multiprocessing, and most of whoosh) are imported
+# where they're used.
+
+from searchlib.util import buildmddesc, stripparentdesc, buildtuids, buildwiki, DescBreakFilter, DESC_BREAK
+from searchlib.spelling import write_wordlist
+from searchlib.recent import RecentCollector, write_recent, restamp_recent, RECENT_FILE
+from searchlib import generations
+
+# How a build merges index segments when it commits:
+# - small: an incremental build merges small segments into larger ones
+#   (whoosh's usual policy). A full build keeps the segments it wrote.
+#   Either way, if the build was given MergeThresholds and they're
+#   exceeded, it merges the whole index into one segment.
+# - optimize: every build merges the whole index into one segment. This
+#   is the smallest and fastest index, but the merge takes time and
+#   memory.
+# - none: never merge. Incremental builds pile up segments until the
+#   next full build.
+MERGE_POLICIES = ('small', 'optimize', 'none')
+
+# Maximum length of the shortdesc field.
+SHORTDESC = 300
+
+# How directory descriptions inherited by files and subdirectories
+# (parentdescs) are indexed. "inline" appends them to each item's own
+# description. "directory" indexes each one once, in a document of its
+# own, and each item lists the directories it inherits from; searches
+# join the two (see join_parentdescs()).
+PARENTDESC_MODES = ('inline', 'directory')
+# In "directory" mode: the field holding the inherited text, the field
+# listing the directories an item inherits from, and the path prefix of
+# the per-directory documents.
+PARENTDESC_FIELD = 'pdesc'
+INHERITS_FIELD = 'inherits'
+PARENTDESC_PREFIX = 'parentdesc:'
+
+# Manifest filename (within the index directory). Whoosh ignores files
+# in its directory that it didn't create.
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+
+def create_schema(parentdescmode='inline'):
+    """Create the Whoosh schema for a new search index.
+    """
+    from whoosh.fields import Schema, TEXT, ID, KEYWORD, DATETIME, NUMERIC, STORED
+    from whoosh.analysis import RegexTokenizer, LowercaseFilter, StopFilter, StemFilter, CharsetFilter
+    from whoosh.support.charset import accent_map
+
+    # This is whoosh's StemmingAnalyzer, with the DescBreakFilter (see
+    # util.py) added after its StopFilter.
+    analyzer = RegexTokenizer() | LowercaseFilter() | StopFilter() | DescBreakFilter() | StemFilter() | CharsetFilter(accent_map)
+
+    # STORED fields are returned as part of the result object; they are not
+    #   indexed (not searchable).
+    # stored=True fields are returned as part of the result object, but
+    #   they *are* searchable.
+    # The unique=True flag on path is what lets incremental builds use
+    #   update_document(). (It is not enforced as unique by whoosh, though.)
+    # KEYWORD fields are searchable lists.
+    # sortable=True fields keep a per-document column, which is what
+    #   the search facets count from.
+    # The "description" field gets fancy full-text searchability, including
+    #   stemming, accent-folding, etc.
+
+    schema = Schema(
+        type=ID(stored=True, sortable=True),  # "file" or "dir"
+        description=TEXT(analyzer=analyzer),   # the primary search text
+        shortdesc=STORED,      # snippet of the description; displayed not indexed
+        name=ID,               # bare filename
+        path=ID(unique=True, stored=True),  # full path
+        dir=KEYWORD(commas=True, scorable=True),  # directory segments, comma-separated list
+        topdir=ID(sortable=True),  # first directory segment
+        date=DATETIME(stored=True, sortable=True),
+        size=NUMERIC(bits=64, stored=True, sortable=True),  # in bytes
+        tuid=KEYWORD(scorable=True),          # tuids, space-separated list
+        wiki=KEYWORD(scorable=True, lowercase=True), # wiki pages, space-separated list (spaces in terms are replaced with underscores)
+    )
+    if parentdescmode == 'directory':
+        # The per-directory parentdesc documents have doctype
+        # "parentdesc", so that searches can mask them out.
+        schema.add(PARENTDESC_FIELD, TEXT(analyzer=analyzer))
+        schema.add(INHERITS_FIELD, KEYWORD(commas=True))
+        schema.add('doctype', ID)
+    elif parentdescmode != 'inline':
+        raise ValueError('Unknown ParentDescMode: %s' % (parentdescmode,))
+    return schema
+
+def schema_parentdescmode(schema):
+    """Return the parentdesc mode that an index was built with.
+    """
+    return 'directory' if PARENTDESC_FIELD in schema else 'inline'
+
+def schema_outdated(schema):
+    """Return true if an index was built before the fields which the
+    facets and sort modes need existed, or before the description
+    analyzer had a DescBreakFilter. Documents for the current schema
+    can't be added to it, so it needs a full build.
+    """
+    if 'topdir' not in schema:
+        return True
+    if getattr(schema['size'], 'column_type', None) is None:
+        return True
+    items = getattr(schema['description'].analyzer, 'items', ())
+    return not any(isinstance(item, DescBreakFilter) for item in items)
+
+def join_parentdescs(searcher, query):
+    """Rewrite a query for a "directory" mode index. Each part of the
+    query which looks at the description field also matches items which
+    inherit a matching parentdesc. So the query finds the same items as
+    it would on an "inline" index. (The scores differ.)
+
+    This runs each such part against the parentdesc documents, which
+    are few. The result excludes the parentdesc documents themselves.
+    (That's part of the query, rather than a search mask, because whoosh
+    ignores the mask when counting a limited search's results.)
+    """
+    from whoosh.query import Or, Term, AndNot
+
+    def expand(subq):
+        if not subq.is_leaf():
+            return subq.apply(expand)
+        if getattr(subq, 'fieldname', None) != 'description':
+            return subq
+        pquery = subq.copy()
+        pquery.fieldname = PARENTDESC_FIELD
+        dirs = []
+        for docnum in searcher.docs_for_query(pquery):
+            path = searcher.stored_fields(docnum)['path']
+            dirs.append(path[ len(PARENTDESC_PREFIX) : ])
+        if not dirs:
+            return subq
+        inherited = Or([ Term(INHERITS_FIELD, dir) for dir in dirs ])
+        # There may be hundreds of these. Whoosh's default is a tree of
+        # union matchers, which is very slow at that size; the array
+        # matcher reads all the postings up front instead.
+        inherited.matcher_type = Or.ARRAY_MATCHER
+        return Or([ subq, inherited ])
+
+    return AndNot(expand(query), Term('doctype', 'parentdesc'))
+
+def create_queryparser(schema):
+    """Create the query parser used for searches. Free text searches
+    the description field; "date:" queries accept natural-language
+    dates.
+    """
+    from whoosh.qparser import QueryParser
+    from whoosh.qparser.dateparse import DateParserPlugin
+
+    queryparser = QueryParser('description', schema)
+    queryparser.add_plugin(DateParserPlugin(free=True))
+    return queryparser
+
+class DocBuilder:
+    """Converts IFDir and IFFile objects into Whoosh document dicts
+    (the keyword arguments to writer.add_document()).
+
+    This must see objects in Master-Index.xml order, because a file
+    with no description borrows its directory's shortdesc.
+
+    In "directory" parentdesc mode, the builder also produces a document
+    for each directory whose parentdesc is inherited, the first time it
+    sees it. Collect those with extradocs() after each dirdoc() or
+    filedoc() call.
+    """
+
+    def __init__(self, parentdescmode='inline'):
+        if parentdescmode not in PARENTDESC_MODES:
+            raise ValueError('Unknown ParentDescMode: %s' % (parentdescmode,))
+        self.parentdescmode = parentdescmode
+        # dirdescmap maps dir paths (including if-archive/...) to dir
+        # short descriptions. It only holds the current directory and
+        # its ancestors; see prunedirdescs().
+        self.dirdescmap = {}
+        # Link-stripped parentdescs; see buildmddesc().
+        self.parentdesccache = {}
+        # In "directory" mode, the parentdesc documents made so far (by
+        # directory), and those not yet collected.
+        self.parentdocs = set()
+        self.pending = []
+
+    def description(self, obj):
+        """Return the searchable description of an IFDir or IFFile.
+        """
+        inline = (self.parentdescmode == 'inline')
+        return buildmddesc(obj, inherit=inline, cache=self.parentdesccache, sep='\n%s\n' % (DESC_BREAK,))
+
+    def shortdesc(self, obj):
+        return buildmddesc(obj, all=False, cache=self.parentdesccache)
+
+    def inherits(self, doc, obj):
+        """In "directory" mode, add the list of directories whose
+        parentdescs obj inherits to doc. Queue up a document for each
+        one we haven't seen before.
+        """
+        if self.parentdescmode != 'directory':
+            return
+        dirs = []
+        for (key, desc) in obj.parentdescs.items():
+            if not desc:
+                continue
+            dirs.append(key)
+            if key not in self.parentdocs:
+                # We assume that a directory's parentdesc is the same
+                # wherever it turns up.
+                self.parentdocs.add(key)
+                self.pending.append(dict(
+                    path = PARENTDESC_PREFIX + key,
+                    type = 'parentdesc',
+                    doctype = 'parentdesc',
+                    pdesc = stripparentdesc(key, desc, self.parentdesccache),
+                ))
+        if dirs:
+            doc[INHERITS_FIELD] = ','.join(dirs)
+
+    def extradocs(self):
+        """Return (and forget) the parentdesc documents queued up by the
+        last dirdoc() or filedoc() call.
+        """
+        res = self.pending
+        self.pending = []
+        return res
+
+    def prunedirdescs(self, dirname):
+        """Forget the short descriptions of every directory except
+        dirname's ancestors. Master-Index.xml is in tree order, so once
+        we've reached a directory, we're done with the files of any
+        directory which isn't above it. This keeps dirdescmap as small
+        as the tree is deep.
+        """
+        prefix = dirname + '/'
+        for key in [ key for key in self.dirdescmap if not prefix.startswith(key + '/') ]:
+            del self.dirdescmap[key]
+
+    def dirdoc(self, dir):
+        """Return the document for an IFDir, or None if it should not
+        be indexed.
+        """
+        self.prunedirdescs(dir.name)
+        if dir.name == 'if-archive':
+            # skip the root
+            return None
+        assert dir.name.startswith('if-archive/')
+        dirname = dir.name[ 11 : ]
+
+        date = None
+        if dir.rawdate is not None:
+            date = datetime.datetime.fromtimestamp(dir.rawdate)
+
+        dirstr = None
+        topdir = None
+        dls = dirname.split('/')
+        if dls:
+            dirstr = ','.join(dls)
+            topdir = dls[0]
+
+        _, _, name = dirname.rpartition('/')
+        alldesc = self.description(dir)
+
+        shortdesc = self.shortdesc(dir)
+        if shortdesc:
+            shortdesc = shortdesc.strip()
+        if shortdesc:
+            self.dirdescmap[dir.name] = shortdesc
+
+        tuids = buildtuids(dir)
+        wiki = buildwiki(dir)
+
+        doc = dict(
+            path = dirname,
+            name = name,
+            dir = dirstr,
+            topdir = topdir,
+            type = 'dir',
+            description = alldesc,
+            shortdesc = shortdesc,
+            date = date,
+            tuid = tuids,
+            wiki = wiki,
+        )
+        self.inherits(doc, dir)
+        return doc
+
+    def filedoc(self, file):
+        """Return the document for an IFFile, or None if it should not
+        be indexed.
+        """
+        if file.symlink:
+            # skip symlinks
+            return None
+
+        assert file.path.startswith('if-archive/')
+        filepath = file.path[ 11 : ]
+
+        date = None
+        if file.rawdate is not None:
+            date = datetime.datetime.fromtimestamp(file.rawdate)
+
+        dirstr = None
+        topdir = None
+        dls = file.directory.split('/')
+        if dls and dls[0] == 'if-archive':
+            del dls[0]
+        if dls:
+            dirstr = ','.join(dls)
+            topdir = dls[0]
+
+        alldesc = self.description(file)
+
+        shortdesc = self.shortdesc(file)
+        if shortdesc:
+            shortdesc = shortdesc.strip()
+        if shortdesc:
+            if len(shortdesc) > SHORTDESC:
+                shortdesc = shortdesc[ 0 : SHORTDESC ] + '...'
+        if not shortdesc:
+            # I suppose we could walk up the tree until we find a description.
+            shortdesc = self.dirdescmap.get(file.directory, None)
+
+        tuids = buildtuids(file)
+        wiki = buildwiki(file)
+
+        doc = dict(
+            path = filepath,
+            name = file.name,
+            dir = dirstr,
+            topdir = topdir,
+            type = 'file',
+            description = alldesc,
+            shortdesc = shortdesc,
+            date = date,
+            size = file.size,
+            tuid = tuids,
+            wiki = wiki,
+        )
+        self.inherits(doc, file)
+        return doc
+
+def dochash(doc):
+    """Return a hash of a document dict. If this changes between builds,
+    the document must be rewritten.
+    (We hash the finished document rather than the IFDir/IFFile, so this
+    covers everything derived from Master-Index.xml -- dates, sizes,
+    descriptions, parentdescs, metadata -- and ignores the fields we don't
+    index, like md5 and sha512.)
+    """
+    import hashlib
+    dat = json.dumps(doc, sort_keys=True, default=str)
+    return hashlib.sha1(dat.encode()).hexdigest()
+
+def read_manifest(indexdir):
+    """Read the manifest of the index in indexdir. Returns a dict mapping
+    paths to document hashes, or None if there is no usable manifest.
+    """
+    path = os.path.join(indexdir, MANIFEST_FILE)
+    try:
+        with open(path, encoding='utf-8') as fl:
+            dat = json.load(fl)
+    except (OSError, ValueError):
+        return None
+    if dat.get('version') != MANIFEST_VERSION:
+        return None
+    return dat.get('items')
+
+def write_manifest(indexdir, items):
+    """Write the manifest for the index in indexdir. We write a temporary
+    file and then rename it into place, so that a failed build can't
+    leave a truncated manifest.
+    """
+    path = os.path.join(indexdir, MANIFEST_FILE)
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w', encoding='utf-8') as fl:
+        json.dump({ 'version':MANIFEST_VERSION, 'items':items }, fl)
+    os.replace(tmppath, path)
+
+def index_segment(indexdir, docs, limitmb=128):
+    """Worker process for parallel builds: index a list of documents
+    into a new segment and return the Segment object. The segment is not
+    part of the index until the parent process commits it.
+
+    (This is what whoosh's MpWriter does in multisegment mode. We do it
+    ourselves so that each segment holds a contiguous run of documents,
+    in Master-Index.xml order. That makes the finished index identical
+    to a serial build, right down to the document numbers.)
+    """
+    from whoosh.index import open_dir
+    from whoosh.writing import SegmentWriter
+
+    index = open_dir(indexdir)
+    # _lk=False because the parent process holds the write lock.
+    writer = SegmentWriter(index, _lk=False, limitmb=limitmb)
+    for doc in docs:
+        writer.add_document(**doc)
+    return writer._finalize_segment()
+
+class ParallelIndexer:
+    """Collects documents into chunks and hands each chunk to a worker
+    process, which turns it into a segment. Use add_document() like a
+    writer, then finish() to get the list of segments, in order.
+    """
+
+    def __init__(self, indexdir, jobs, chunksize, limitmb=128):
+        self.indexdir = indexdir
+        self.jobs = jobs
+        self.chunksize = chunksize
+        self.limitmb = limitmb
+        import multiprocessing
+        self.pool = multiprocessing.Pool(jobs)
+        self.chunk = []
+        self.pending = collections.deque()
+        self.segments = []
+
+    def add_document(self, **doc):
+        self.chunk.append(doc)
+        if len(self.chunk) >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            res = self.pool.apply_async(index_segment, (self.indexdir, self.chunk, self.limitmb))
+            self.pending.append(res)
+            self.chunk = []
+        # Don't let the parser run too far ahead of the workers.
+        while len(self.pending) > self.jobs:
+            self.segments.append(self.pending.popleft().get())
+
+    def finish(self):
+        self.flush()
+        while self.pending:
+            self.segments.append(self.pending.popleft().get())
+        self.pool.close()
+        self.pool.join()
+        return self.segments
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+def build_generation(masterindexpath, searchindexdir, create=False, incremental=False, backend='etree', jobs=1, keep=2, snapshot=None, parentdescmode='inline', recentcount=100, limitmb=128, flushcount=0, mergepolicy='small', automerge=None):
+    """Build a new index generation under searchindexdir, make it
+    current, and delete old generations (keeping keep of them,
+    including the new one).
+
+    A full build (or create) starts a fresh index, with the current
+    schema. An incremental build starts from a hard-linked copy of the
+    current generation and updates it. If an incremental build finds
+    nothing to change, the current generation stays as it is. If the
+    current generation has an outdated schema, the build is full.
+
+    The snapshot, parentdescmode, recentcount, limitmb, flushcount,
+    mergepolicy, and automerge arguments are passed along to
+    build_index(). An incremental build can't change the parentdesc
+    mode; that takes a full build.
+
+    Returns (stats, indexdir, removed), where indexdir is the current
+    generation directory after the build and removed lists the old
+    generations that were deleted.
+    """
+    if generations.read_current(searchindexdir) is None and not os.path.exists(searchindexdir):
+        os.makedirs(searchindexdir)
+    olddir = generations.current_indexdir(searchindexdir)
+    # Is there an index to start from?
+    haveold = any(name.endswith('.toc') for name in os.listdir(olddir))
+    
+    if incremental and not create and haveold:
+        from whoosh.index import open_dir
+        if schema_outdated(open_dir(olddir).schema):
+            # The old index lacks fields we now write; start afresh.
+            incremental = False
+    
+    newdir = generations.new_generation(searchindexdir)
+    try:
+        if incremental and not create and haveold:
+            generations.clone_generation(olddir, newdir)
+            stats = build_index(masterindexpath, newdir, incremental=True, backend=backend, jobs=jobs, snapshot=snapshot, parentdescmode=parentdescmode, recentcount=recentcount, limitmb=limitmb, flushcount=flushcount, mergepolicy=mergepolicy, automerge=automerge)
+            uptodate = os.path.exists(os.path.join(olddir, RECENT_FILE))
+            if uptodate and not (stats.added or stats.updated or stats.deleted):
+                # Nothing changed; don't bother switching. (Unless the
+                # old generation predates the recent list.)
+                shutil.rmtree(newdir)
+                return (stats, olddir, [])
+        else:
+            stats = build_index(masterindexpath, newdir, create=True, backend=backend, jobs=jobs, snapshot=snapshot, parentdescmode=parentdescmode, recentcount=recentcount, limitmb=limitmb, flushcount=flushcount, mergepolicy=mergepolicy, automerge=automerge)
+    except:
+        shutil.rmtree(newdir, ignore_errors=True)
+        raise
+
+    generations.switch_current(searchindexdir, newdir)
+    removed = generations.collect_garbage(searchindexdir, keep=keep)
+    return (stats, newdir, removed)
+
+def optimize_generation(searchindexdir, keep=2, limitmb=128, thresholds=None):
+    """Merge the current index into a single segment (purging deleted
+    documents), in a new generation, and make that current. Readers
+    carry on with the old generation until the switch.
+
+    If thresholds (a MergeThresholds) is given, only merge if they say
+    the index needs it. (Their off-peak hours don't apply; this is run
+    on demand.)
+
+    Returns (before, after, indexdir, removed): IndexStatus objects from
+    before and after the merge (after is None if there was no merge),
+    the current generation directory, and the old generations that were
+    deleted.
+    """
+    from whoosh.index import open_dir
+    import whoosh.writing
+    from searchlib.segments import index_status
+
+    olddir = generations.current_indexdir(searchindexdir)
+    before = index_status(open_dir(olddir), olddir, terms=False)
+    if thresholds is not None and not thresholds.check(before):
+        return (before, None, olddir, [])
+
+    newdir = generations.new_generation(searchindexdir)
+    try:
+        generations.clone_generation(olddir, newdir)
+        index = open_dir(newdir)
+        oldgeneration = index.latest_generation()
+        index.writer(limitmb=limitmb).commit(mergetype=whoosh.writing.OPTIMIZE)
+        # The word list and recent list are stamped with the whoosh
+        # generation, which the commit bumped.
+        write_wordlist(index, newdir)
+        restamp_recent(newdir, oldgeneration, index.latest_generation())
+        after = index_status(index, newdir, terms=False)
+    except:
+        shutil.rmtree(newdir, ignore_errors=True)
+        raise
+
+    generations.switch_current(searchindexdir, newdir)
+    removed = generations.collect_garbage(searchindexdir, keep=keep)
+    return (before, after, newdir, removed)
+
+def commit_segments(writer, segments, mergetype=None):
+    """Commit a writer, adding the segments built by worker processes
+    to the index after the writer's own. (Compare MpWriter._commit().)
+    """
+    finalsegments = writer._merge_segments(mergetype, None, None)
+    finalsegments.extend(segments)
+    if writer._added:
+        finalsegments.append(writer._finalize_segment())
+    else:
+        writer._close_segment()
+    writer._commit_toc(finalsegments)
+    writer._finish()
+
+class BuildStats:
+    """Counts of what a build did.
+    """
+    def __init__(self, incremental=False):
+        self.incremental = incremental
+        self.itemcount = 0
+        self.added = 0
+        self.updated = 0
+        self.deleted = 0
+        self.unchanged = 0
+        # Segments in the index when the build finished.
+        self.segments = 0
+        # Why the build merged the index, if it did.
+        self.merged = None
+        # Why the index needs merging, if the build left that for later.
+        self.mergedue = None
+
+def build_index(masterindexpath, indexdir, create=False, incremental=False, backend='etree', jobs=1, snapshot=None, parentdescmode='inline', recentcount=100, limitmb=128, flushcount=0, mergepolicy='small', automerge=None):
+    """Read Master-Index.xml and write its contents into the search index
+    in indexdir.
+
+    If create is true, this creates a new index (wiping any existing one).
+    Otherwise the index must already exist, and have been built with the
+    same parentdescmode.
+
+    If incremental is true (and there's a manifest from a previous build),
+    only documents which have changed are written. Otherwise all documents
+    are re-added and the previous contents are cleared.
+
+    The backend argument selects the Master-Index.xml parser; see
+    ifarchivexml.parse_callback(). If snapshot is given, it's the path of
+    a Master-Index snapshot (see snapshot.py), which is used if it's
+    current and rewritten if not.
+
+    The build also writes the recent additions list (see recent.py):
+    the newest recentcount items.
+
+    Each writer buffers up to limitmb megabytes of postings before
+    spilling to temporary files. If flushcount is nonzero, the build
+    writes a new segment every flushcount documents (in a parallel
+    build, each chunk is at most that size). The mergepolicy is one of
+    MERGE_POLICIES. Under the "small" policy, if automerge (a
+    MergeThresholds) is given, the build checks the index after
+    committing and merges it if the thresholds are exceeded, provided
+    it's off-peak.
+
+    If jobs is more than 1, a full build hands the indexing off to that
+    many worker processes. The parsing and document preparation stay in
+    this process: they're cheap, and the shortdesc fallback and the
+    manifest both depend on seeing items in order. (Incremental builds
+    are always serial; they don't do enough work to be worth it.)
+
+    Returns a BuildStats object.
+    """
+    from searchlib import ifarchivexml
+    from whoosh.index import create_in, open_dir
+    import whoosh.writing
+
+    if mergepolicy not in MERGE_POLICIES:
+        raise ValueError('Unknown merge policy: %s' % (mergepolicy,))
+    if mergepolicy == 'optimize':
+        finalmerge = whoosh.writing.OPTIMIZE
+    elif mergepolicy == 'none':
+        finalmerge = whoosh.writing.NO_MERGE
+    else:
+        finalmerge = whoosh.writing.MERGE_SMALL
+
+    if create:
+        index = create_in(indexdir, create_schema(parentdescmode))
+    else:
+        index = open_dir(indexdir)
+        oldmode = schema_parentdescmode(index.schema)
+        if oldmode != parentdescmode:
+            raise Exception('The index was built with ParentDescMode %s; a full build is needed to change it' % (oldmode,))
+
+    oldmanifest = None
+    if incremental and not create:
+        oldmanifest = read_manifest(indexdir)
+    stats = BuildStats(incremental=(oldmanifest is not None))
+
+    manifest = {}
+    recent = RecentCollector(recentcount)
+    builder = DocBuilder(parentdescmode)
+    writer = index.writer(limitmb=limitmb)
+    # Documents given to the current writer.
+    written = 0
+    # Whether a full build has committed (and so cleared out the old
+    # contents) yet.
+    cleared = False
+
+    parallel = None
+    if jobs > 1 and oldmanifest is None:
+        # Aim for one segment per job. Counting the entries is much
+        # quicker than parsing them.
+        estimate = ifarchivexml.count_entries(masterindexpath, snapshot=snapshot)
+        chunksize = max(100, (estimate + jobs - 1) // jobs)
+        if flushcount:
+            chunksize = min(chunksize, flushcount)
+        parallel = ParallelIndexer(indexdir, jobs, chunksize, limitmb=limitmb)
+
+    def flush():
+        # Commit what we have as a segment and start a new writer.
+        # Nothing is merged until the end of the build.
+        nonlocal writer, written, cleared
+        if oldmanifest is None and not cleared:
+            writer.commit(mergetype=whoosh.writing.CLEAR)
+            cleared = True
+        else:
+            writer.commit(mergetype=whoosh.writing.NO_MERGE)
+        writer = index.writer(limitmb=limitmb)
+        written = 0
+
+    def adddoc(doc):
+        nonlocal written
+        if doc is None:
+            return
+        path = doc['path']
+        dhash = dochash(doc)
+        manifest[path] = dhash
+        recent.add(doc)
+        stats.itemcount += 1
+        if parallel is not None:
+            parallel.add_document(**doc)
+            return
+        if oldmanifest is None:
+            writer.add_document(**doc)
+            written += 1
+            if flushcount and written >= flushcount:
+                flush()
+            return
+        oldhash = oldmanifest.get(path)
+        if oldhash == dhash:
+            stats.unchanged += 1
+            return
+        # We use update_document() even for new paths. That way, if a
+        # previous build committed but failed to write its manifest, we
+        # don't wind up with duplicates.
+        writer.update_document(**doc)
+        if oldhash is None:
+            stats.added += 1
+        else:
+            stats.updated += 1
+        written += 1
+        if flushcount and written >= flushcount:
+            flush()
+
+    def dircallback(dir):
+        adddoc(builder.dirdoc(dir))
+        for doc in builder.extradocs():
+            adddoc(doc)
+
+    def filecallback(file):
+        adddoc(builder.filedoc(file))
+        for doc in builder.extradocs():
+            adddoc(doc)
+
+    try:
+        ifarchivexml.parse_callback(masterindexpath, dirfunc=dircallback, filefunc=filecallback, backend=backend, snapshot=snapshot)
+
+        if parallel is not None:
+            stats.added = stats.itemcount
+            segments = parallel.finish()
+            commit_segments(writer, segments, mergetype=whoosh.writing.CLEAR)
+            if mergepolicy == 'optimize':
+                index.writer(limitmb=limitmb).commit(mergetype=finalmerge)
+        elif oldmanifest is None:
+            stats.added = stats.itemcount
+            if not cleared:
+                writer.commit(mergetype=whoosh.writing.CLEAR)
+            elif mergepolicy == 'optimize':
+                writer.commit(mergetype=finalmerge)
+            else:
+                writer.commit(mergetype=whoosh.writing.NO_MERGE)
+        else:
+            for path in oldmanifest:
+                if path not in manifest:
+                    writer.delete_by_term('path', path)
+                    stats.deleted += 1
+            if stats.added or stats.updated or stats.deleted:
+                writer.commit(mergetype=finalmerge)
+            else:
+                writer.cancel()
+    except:
+        if parallel is not None:
+            parallel.terminate()
+        writer.cancel()
+        raise
+
+    changed = (oldmanifest is None or stats.added or stats.updated or stats.deleted)
+    if automerge is not None and mergepolicy == 'small' and changed:
+        from searchlib.segments import index_status
+        reason = automerge.check(index_status(index, indexdir, terms=False))
+        if reason and automerge.offpeak():
+            index.writer(limitmb=limitmb).commit(mergetype=whoosh.writing.OPTIMIZE)
+            stats.merged = reason
+        elif reason:
+            stats.mergedue = reason
+
+    write_manifest(indexdir, manifest)
+    write_wordlist(index, indexdir)
+    write_recent(indexdir, index.latest_generation(), recent.items())
+    stats.segments = len(index._segments())
+    return stats
@@ -0,0 +1,153 @@
+"""metrics:
+
+In-process timing statistics for search requests.
+
+Each request carries a Timings object, which records how long each
+stage took (query parsing, searcher checkout, search, spelling, page
+rendering, and so on). When the request finishes, its timings go into
+a Metrics object, which keeps a histogram per stage and counts
+requests by handler and outcome. The "/stats" handler renders all of
+that in the Prometheus text format.
+
+Everything here is cheap: a span is two perf_counter() calls, and a
+histogram observation is a bisect under a lock.
+"""
+
+import time
+import threading
+import contextlib
+from bisect import bisect_left
+
+# Histogram bucket upper bounds, in seconds. (Plus the implicit +Inf.)
+BUCKETS = [ 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0 ]
+
+class Timings:
+    """The stage timings for one request. Use it like this:
+
+        with timings.span('parse'):
+            ...
+
+    Spans with the same name add up. The total is the time since the
+    Timings object was created.
+    """
+
+    def __init__(self):
+        self.starttime = time.perf_counter()
+        self.endtime = None
+        # Maps stage name to seconds, in the order the stages began.
+        self.spans = {}
+
+    @contextlib.contextmanager
+    def span(self, name):
+        starttime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + (time.perf_counter() - starttime)
+
+    def finish(self):
+        """Stop the clock. (Further spans are still recorded, but don't
+        count toward the total.)
+        """
+        if self.endtime is None:
+            self.endtime = time.perf_counter()
+
+    def total(self):
+        endtime = self.endtime if self.endtime is not None else time.perf_counter()
+        return endtime - self.starttime
+
+    def lognote(self):
+        """A summary for log lines: "parse 0.0001, search 0.0123, ..."
+        """
+        return ', '.join('%s %.04f' % (name, val) for (name, val) in self.spans.items())
+
+class Histogram:
+    """A cumulative histogram of durations, with the fixed BUCKETS.
+    Not thread-safe by itself; Metrics holds the lock.
+    """
+
+    def __init__(self):
+        self.counts = [ 0 ] * (len(BUCKETS)+1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, val):
+        self.counts[bisect_left(BUCKETS, val)] += 1
+        self.sum += val
+        self.count += 1
+
+class Metrics:
+    """Aggregated request timings for the whole process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.starttime = time.time()
+        # Maps handler name to the Histogram of total request times.
+        self.requests = {}
+        # Maps (handler, stage) to a Histogram.
+        self.stages = {}
+        # Maps (handler, outcome) to a count.
+        self.outcomes = {}
+
+    def record(self, handler, timings, outcome='ok'):
+        """Add a finished request's timings. The handler is a short name
+        ("html", "json", ...); the outcome is "ok", "cached", or an
+        error code.
+        """
+        timings.finish()
+        with self.lock:
+            hist = self.requests.get(handler)
+            if hist is None:
+                hist = self.requests[handler] = Histogram()
+            hist.observe(timings.total())
+            for (stage, val) in timings.spans.items():
+                key = (handler, stage)
+                hist = self.stages.get(key)
+                if hist is None:
+                    hist = self.stages[key] = Histogram()
+                hist.observe(val)
+            key = (handler, outcome)
+            self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+    def render(self, extra=None):
+        """Return the metrics in the Prometheus text exposition format.
+        The extra argument is a list of (name, type, help, value) for
+        additional counters and gauges (cache statistics and so on).
+        """
+        lines = []
+        with self.lock:
+            lines.append('# HELP search_requests_total Search requests by handler and outcome.')
+            lines.append('# TYPE search_requests_total counter')
+            for ((handler, outcome), count) in sorted(self.outcomes.items()):
+                lines.append('search_requests_total{handler="%s",outcome="%s"} %d' % (handler, outcome, count))
+
+            lines.append('# HELP search_request_seconds Total time per search request.')
+            lines.append('# TYPE search_request_seconds histogram')
+            for (handler, hist) in sorted(self.requests.items()):
+                renderhist(lines, 'search_request_seconds', 'handler="%s"' % (handler,), hist)
+
+            lines.append('# HELP search_stage_seconds Time per stage of a search request.')
+            lines.append('# TYPE search_stage_seconds histogram')
+            for ((handler, stage), hist) in sorted(self.stages.items()):
+                renderhist(lines, 'search_stage_seconds', 'handler="%s",stage="%s"' % (handler, stage), hist)
+
+        for (name, mtype, help, val) in (extra or []):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, mtype))
+            lines.append('%s %s' % (name, val))
+
+        lines.append('# HELP search_uptime_seconds Time since the process started.')
+        lines.append('# TYPE search_uptime_seconds gauge')
+        lines.append('search_uptime_seconds %.03f' % (time.time() - self.starttime,))
+        lines.append('')
+        return '\n'.join(lines)
+
+def renderhist(lines, name, labels, hist):
+    total = 0
+    for (bound, count) in zip(BUCKETS, hist.counts):
+        total += count
+        lines.append('%s_bucket{%s,le="%g"} %d' % (name, labels, bound, total))
+    lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, hist.count))
+    lines.append('%s_sum{%s} %.06f' % (name, labels, hist.sum))
+    lines.append('%s_count{%s} %d' % (name, labels, hist.count))
@@ -0,0 +1,123 @@
+import time
+import threading
+import contextlib
+
+class SearcherPool:
+    """A pool of open Whoosh searchers, shared among threads.
+
+    Opening a searcher means opening all the segment files, and the
+    searcher accumulates cached data as it's used. So we'd like to keep
+    them around between requests. But they are not thread-safe, so each
+    searcher is checked out by one thread at a time.
+
+    When a searcher is checked out, we refresh() it. This is cheap if
+    the index hasn't changed; if it has, we get a searcher for the new
+    generation (reusing any segments which are still current).
+
+    Searchers which sit in the pool unused for idletimeout seconds are
+    closed. (We check this whenever a searcher is checked out or
+    returned, so a completely idle process may hang onto its searchers
+    a little longer.)
+    """
+
+    def __init__(self, index, idletimeout=300):
+        self.index = index
+        self.idletimeout = idletimeout
+
+        self.lock = threading.Lock()
+        # Stack of (searcher, lastused) pairs. The most recently used
+        # searcher is on top, so the ones on the bottom are the ones
+        # that expire.
+        self.idle = []
+        # Number of searchers currently checked out.
+        self.inuse = 0
+        # Set when the pool is shut down for good.
+        self.closed = False
+
+    @contextlib.contextmanager
+    def searcher(self):
+        """Check out a searcher for the duration of a "with" block:
+
+            with pool.searcher() as searcher:
+                ...
+
+        The searcher goes back into the pool when the block exits. The
+        caller must not close it.
+        """
+        searcher = self.acquire()
+        try:
+            yield searcher
+        finally:
+            self.release(searcher)
+
+    def acquire(self):
+        """Check out a searcher. You must release() it when done.
+        """
+        searcher = None
+        with self.lock:
+            expired = self._expire(time.time())
+            if self.idle:
+                searcher, _ = self.idle.pop()
+            self.inuse += 1
+        for oldsearcher in expired:
+            oldsearcher.close()
+
+        try:
+            if searcher is None:
+                searcher = self.index.searcher()
+            else:
+                searcher = searcher.refresh()
+        except:
+            with self.lock:
+                self.inuse -= 1
+            raise
+        return searcher
+
+    def release(self, searcher):
+        """Return a searcher to the pool.
+        """
+        now = time.time()
+        with self.lock:
+            self.inuse -= 1
+            if self.closed:
+                expired = [ searcher ]
+            else:
+                self.idle.append((searcher, now))
+                expired = self._expire(now)
+        for oldsearcher in expired:
+            oldsearcher.close()
+
+    def stats(self):
+        """Return (idle, inuse) searcher counts.
+        """
+        with self.lock:
+            return (len(self.idle), self.inuse)
+
+    def close(self, final=False):
+        """Close all the idle searchers. (Searchers which are checked
+        out are not affected; they'll go into the pool when released.)
+        If final is true, the pool is being discarded, and checked-out
+        searchers will be closed when released.
+        """
+        with self.lock:
+            if final:
+                self.closed = True
+            expired = [ searcher for (searcher, _) in self.idle ]
+            self.idle.clear()
+        for oldsearcher in expired:
+            oldsearcher.close()
+
+    def _expire(self, now):
+        """Remove the expired searchers from the pool and return them.
+        (The caller closes them, after releasing the lock.)
+        Must be called with the lock held.
+        """
+        limit = now - self.idletimeout
+        count = 0
+        while count < len(self.idle) and self.idle[count][1] < limit:
+            count += 1
+        if not count:
+            return []
+        expired = [ searcher for (searcher, _) in self.idle[ : count ] ]
+        del self.idle[ : count ]
+        return expired
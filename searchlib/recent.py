@@ -0,0 +1,98 @@
+"""recent:
+
+The "recent additions" list: the most recently dated items in the
+index, newest first.
+
+Polling for new files with a "date:" search scores the whole date range
+on every poll. Instead, the build picks out the newest RecentCount items
+as it goes (it sees every document anyway) and writes them to a small
+JSON file in the index directory. The web app loads that once per index
+generation and serves it as HTML, JSON, and Atom, so a poll costs about
+as much as a static file.
+
+As with the spelling word list, the file records the whoosh generation
+it was written for, and is ignored if that doesn't match.
+"""
+
+import os, os.path
+import json
+import heapq
+import datetime
+
+RECENT_FILE = 'recent.json'
+
+class RecentCollector:
+    """Keeps the newest count documents (by date) of those passed to
+    add(), in a bounded heap. Documents with no date are ignored.
+    """
+
+    def __init__(self, count=100):
+        self.count = count
+        # (date, path, item) tuples; the oldest is at the top.
+        self.heap = []
+
+    def add(self, doc):
+        date = doc.get('date')
+        if date is None or self.count <= 0:
+            return
+        key = (date, doc['path'])
+        if len(self.heap) >= self.count and key <= self.heap[0][ : 2 ]:
+            return
+        item = {
+            'path': doc['path'],
+            'type': doc.get('type'),
+            'date': date.isoformat(),
+            'size': doc.get('size'),
+            'shortdesc': doc.get('shortdesc'),
+        }
+        if len(self.heap) < self.count:
+            heapq.heappush(self.heap, (date, doc['path'], item))
+        else:
+            heapq.heapreplace(self.heap, (date, doc['path'], item))
+
+    def items(self):
+        """Return the collected items, newest first.
+        """
+        return [ item for (date, path, item) in sorted(self.heap, reverse=True) ]
+
+def write_recent(indexdir, generation, items):
+    """Write the recent list for the given index generation.
+    """
+    path = os.path.join(indexdir, RECENT_FILE)
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w', encoding='utf-8') as fl:
+        json.dump({ 'generation': generation, 'items': items }, fl)
+    os.replace(tmppath, path)
+
+def read_recent(indexdir, generation):
+    """Load the recent list and return it as a list of dicts (with the
+    dates converted back to datetimes), or None if it's missing or was
+    written for a different generation.
+    """
+    path = os.path.join(indexdir, RECENT_FILE)
+    try:
+        with open(path, encoding='utf-8') as fl:
+            dat = json.load(fl)
+        if dat.get('generation') != generation:
+            return None
+        items = dat['items']
+        for item in items:
+            item['date'] = datetime.datetime.fromisoformat(item['date'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return items
+
+def restamp_recent(indexdir, oldgeneration, generation):
+    """Mark the recent list, written for oldgeneration, as belonging to
+    a new generation with the same documents (after a merge). Does
+    nothing if the list is missing or was already stale.
+    """
+    path = os.path.join(indexdir, RECENT_FILE)
+    try:
+        with open(path, encoding='utf-8') as fl:
+            dat = json.load(fl)
+    except (OSError, ValueError):
+        return
+    if dat.get('generation') != oldgeneration:
+        return
+    write_recent(indexdir, generation, dat.get('items', []))
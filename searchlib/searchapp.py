@@ -1,14 +1,30 @@
+import os.path
+import time
+import json
+import datetime
 import threading
+import contextlib
+import functools
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape
 from whoosh.index import open_dir
-from whoosh.qparser import QueryParser
-from whoosh.qparser.dateparse import DateParserPlugin
+from whoosh.searching import TimeLimit
 
 from tinyapp.app import TinyApp, TinyRequest
 from tinyapp.handler import ReqHandler
 import tinyapp.auth
 
+from searchlib.indexer import create_queryparser, PARENTDESC_FIELD, join_parentdescs
+from searchlib.pool import SearcherPool
+from searchlib.cache import LRUCache
+from searchlib.metrics import Metrics, Timings
+from searchlib.util import search_window_timeout, filehash
+from searchlib.spelling import read_wordlist, WORDLIST_FIELD
+from searchlib.generations import current_indexdir
+from searchlib.facets import create_facets, build_facets, jsonfacets
+from searchlib.sortmodes import SortKeys, RELEVANCE
+from searchlib.recent import read_recent
+from searchlib.export import export_lines
+
 
 class SearchApp(TinyApp):
     """SearchApp: The TinyApp class.
@@ -22,52 +38,484 @@ class SearchApp(TinyApp):
         self.searchindexdir = config['Search']['SearchIndexDir']
         self.approot = config['Search']['AppRoot']
         self.template_path = config['Search']['TemplateDir']
+        self.templatecachedir = config['Search'].get('TemplateCacheDir')
+        self.templateautoreload = config['Search'].getboolean('TemplateAutoReload', True)
+        self.warmupenabled = config['Search'].getboolean('Warmup', False)
+        self.warmupqueries = [ val.strip() for val in config['Search'].get('WarmupQueries', '').splitlines() if val.strip() ]
         self.pagelen = int(config['Search']['ResultsPerPage'])
         self.querytimeout = float(config['Search']['QueryTimeout'])
+        self.exporttimeout = config['Search'].getfloat('ExportTimeout', 60.0)
+        self.searcheridletimeout = config['Search'].getfloat('SearcherIdleTimeout', 300.0)
+        self.keepgenerations = config['Search'].getint('KeepGenerations', 2)
+        self.parentdescmode = config['Search'].get('ParentDescMode', 'inline')
+        self.masterindexsnapshot = config['Search'].get('MasterIndexSnapshot', os.path.join(self.searchindexdir, 'Master-Index.snap'))
+        self.resultcachesize = config['Search'].getint('ResultCacheSize', 200)
+        self.resultcachettl = config['Search'].getfloat('ResultCacheTTL', 600.0)
+        self.cachestatsinterval = config['Search'].getint('CacheStatsInterval', 100)
+        self.windowpages = config['Search'].getint('SearchWindowPages', 10)
+        self.windowcachesize = config['Search'].getint('WindowCacheSize', 100)
+        self.spellmaxresults = config['Search'].getint('SpellCheckMaxResults', 0)
+        self.searchsocket = config['Search'].get('SearchSocket')
+        self.slowquerythreshold = config['Search'].getfloat('SlowQueryThreshold', 0.0)
+        self.statsenabled = config['Search'].getboolean('EnableStats', False)
+        self.recentcount = config['Search'].getint('RecentCount', 100)
+        self.buildmemorymb = config['Search'].getint('BuildMemoryMB', 128)
+        self.buildflushcount = config['Search'].getint('BuildFlushCount', 0)
+        self.buildmergepolicy = config['Search'].get('BuildMergePolicy', 'small')
+        self.mergemaxsegments = config['Search'].getint('MergeMaxSegments', 10)
+        self.mergemaxdeleted = config['Search'].getfloat('MergeMaxDeletedRatio', 0.2)
+        self.mergehours = config['Search'].get('MergeHours', '')
+        self.facetsenabled = config['Search'].getboolean('Facets', True)
+        self.facetlimit = config['Search'].getint('FacetLimit', 10)
+
+        # Finished result pages, keyed by (generation, query, sort,
+        # pagenum, pagelen).
+        self.resultcache = LRUCache(maxsize=self.resultcachesize, ttl=self.resultcachettl)
+        # Scored hit lists (ResultWindow objects), keyed by
+        # (generation, query, sort).
+        self.windowcache = LRUCache(maxsize=self.windowcachesize, ttl=self.resultcachettl)
+        # Request timing histograms; see recordtimings().
+        self.metrics = Metrics()
 
-        # Thread-local storage for various things which are not thread-safe.
-        self.threadcache = threading.local()
+        # The jinja environment, shared by all threads; see getjenv().
+        self.jenv = None
+        self.jenvlock = threading.Lock()
+        # The rendered help page, as (template, page); see helppage().
+        self.helpcache = (None, None)
+        # How long startup took, by stage; filled in by search.wsgi.
+        self.startuptimes = {}
 
+        # The open index generation (an OpenIndex), or None. See
+        # currentindex().
+        self.openindex = None
+        self.openindexlock = threading.Lock()
+        # The index directory we last tried to open, successfully or not.
+        self.openindexdir = None
+        
         # This will fail if there's no search index at all.
-        # Allow that for the moment.
+        # Allow that for the moment; we'll pick it up when a build
+        # creates a generation.
+        self.currentindex()
+
+    @property
+    def searchindex(self):
+        return self.openindex.index if self.openindex else None
+
+    @property
+    def queryparser(self):
+        return self.openindex.queryparser if self.openindex else None
+
+    @property
+    def searcherpool(self):
+        return self.openindex.pool if self.openindex else None
+
+    def currentindex(self):
+        """Return the OpenIndex for the current index generation, or None
+        if there is no index.
+
+        We read the "current" pointer file every time (it's tiny). If a
+        build has switched to a new generation, we open that and close
+        down the old one. Searches already running on the old generation
+        finish there; their searchers are closed when returned.
+        """
         try:
-            self.searchindex = open_dir(self.searchindexdir)
-            self.queryparser = QueryParser('description', self.searchindex.schema)
-            self.queryparser.add_plugin(DateParserPlugin(free=True))
+            indexdir = current_indexdir(self.searchindexdir)
         except Exception as ex:
-            self.logwarning(None, 'Unable to open search index: %s', ex)
-            self.searchindex = None
-            self.queryparser = None
+            self.logwarning(None, 'Unable to read current index generation: %s', ex)
+            return self.openindex
+        if indexdir == self.openindexdir:
+            return self.openindex
+        
+        with self.openindexlock:
+            if indexdir == self.openindexdir:
+                # Another thread got here first.
+                return self.openindex
+            self.openindexdir = indexdir
+            try:
+                newindex = OpenIndex(indexdir, idletimeout=self.searcheridletimeout)
+            except Exception as ex:
+                # Keep using the old one, if any.
+                self.logwarning(None, 'Unable to open search index %s: %s', indexdir, ex)
+                return self.openindex
+            oldindex = self.openindex
+            self.openindex = newindex
+        if oldindex is not None:
+            self.loginfo(None, 'Switched to search index %s', indexdir)
+            oldindex.close()
+        return newindex
 
     def getjenv(self):
-        """Get or create a jinja template environment. These are
-        cached per-thread.
+        """Get or create the jinja template environment. There's one,
+        shared between threads. (Rendering is thread-safe, and this way
+        each template is compiled once per process.)
+
+        If TemplateCacheDir is set, compiled templates are cached there
+        as bytecode, so a new process doesn't have to compile them at
+        all. If TemplateAutoReload is false, template files aren't
+        checked for changes once loaded.
         """
-        jenv = getattr(self.threadcache, 'jenv', None)
-        if jenv is None:
+        jenv = self.jenv
+        if jenv is not None:
+            return jenv
+        with self.jenvlock:
+            if self.jenv is not None:
+                return self.jenv
+            # Jinja is imported here, since command-line use doesn't
+            # need it.
+            from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape
+            bytecode_cache = None
+            if self.templatecachedir:
+                try:
+                    os.makedirs(self.templatecachedir, exist_ok=True)
+                    bytecode_cache = FileSystemBytecodeCache(self.templatecachedir)
+                except Exception as ex:
+                    self.logwarning(None, 'Unable to use template cache %s: %s', self.templatecachedir, ex)
             jenv = Environment(
                 loader = FileSystemLoader(self.template_path),
                 extensions = [
                 ],
                 autoescape = select_autoescape(),
                 keep_trailing_newline = True,
+                auto_reload = self.templateautoreload,
+                bytecode_cache = bytecode_cache,
             )
             jenv.globals['approot'] = self.approot
             jenv.globals['resultsdomain'] = self.resultsdomain
             #jenv.globals['appcssuri'] = self.app_css_uri
-            self.threadcache.jenv = jenv
+            self.jenv = jenv
         return jenv
 
-    def getsearcher(self):
-        """Create and return a Whoosh searcher.
-        I could cache these (per thread), but they hold both cached data
-        and open file handles. I wouldn't want to keep them alive indefinitely.
-        Maybe if there was a timeout to close and discard them?
-        (Note: if we go down this road, adjust the caller to *not* close
-        the searcher after use.)
+    def helppage(self):
+        """Return the help page, with no search string or message. This
+        is the same every time, so we render it once. (If the template
+        is reloaded, we render it again.)
+        """
+        tem = self.getjenv().get_template('help.html')
+        (cachedtem, page) = self.helpcache
+        if cachedtem is not tem:
+            page = tem.render(approot=self.approot)
+            self.helpcache = (tem, page)
+        return page
+
+    def warmup(self):
+        """Get the process ready to serve requests quickly: open the
+        index, read through the description lexicon (so the term files
+        are in the OS cache), load the spelling word list, compile the
+        templates, and run the WarmupQueries (which also fills the
+        result cache).
+        """
+        openindex = self.currentindex()
+        if openindex is not None:
+            with self.getsearcher(openindex=openindex) as searcher:
+                for _ in searcher.reader().lexicon('description'):
+                    pass
+                openindex.getcorrectors(searcher)
+
+        jenv = self.getjenv()
+        for name in jenv.list_templates(extensions=['html', 'xml']):
+            jenv.get_template(name)
+        self.helppage()
+
+        for querystr in self.warmupqueries:
+            try:
+                self.search(querystr, 1, self.pagelen)
+            except SearchError as ex:
+                self.logwarning(None, 'Warmup query "%s" failed (%s)', querystr, ex.message)
+
+    @contextlib.contextmanager
+    def getsearcher(self, timings=None, openindex=None):
+        """Check out a Whoosh searcher from the pool. Use this in a
+        "with" statement:
+
+            with app.getsearcher() as searcher:
+                ...
+
+        The searcher is returned to the pool (not closed) at the end of
+        the block. Pooled searchers are refreshed when the index changes,
+        and closed after SearcherIdleTimeout seconds of disuse.
+
+        If timings is given, the checkout is recorded as the "searcher"
+        stage. The searcher comes from openindex if given, otherwise from
+        the current index.
         """
-        searcher = self.searchindex.searcher()
-        return searcher
+        if openindex is None:
+            openindex = self.currentindex()
+        pool = openindex.pool
+        if timings is None:
+            searcher = pool.acquire()
+        else:
+            with timings.span('searcher'):
+                searcher = pool.acquire()
+        try:
+            yield searcher
+        finally:
+            pool.release(searcher)
+
+    def getwindow(self, searcher, generation, query, pagenum, pagelen, facets=None, sort=RELEVANCE, sortkeys=None):
+        """Return a ResultWindow which includes the given page of results
+        for the query. If we've recently run the query (on the current
+        index generation), this comes from the cache. Otherwise we run it,
+        fetching SearchWindowPages pages' worth of hits (or more, if the
+        requested page is past that).
+
+        The generation is the searcher's OpenIndex.generation(). If facets
+        (the OpenIndex's facets) is given, the window includes the facet
+        counts. A sort mode other than relevance needs the OpenIndex's
+        sortkeys.
+
+        Returns (window, fetched), where fetched is true if we had to run
+        the query. Raises whoosh.searching.TimeLimit.
+        """
+        cache = self.windowcache
+        cache.setgeneration(generation)
+        cachekey = (generation, repr(query), sort)
+        window = cache.get(cachekey)
+        if window is not None and window.covers(pagenum, pagelen):
+            return (window, False)
+
+        joined = (PARENTDESC_FIELD in searcher.schema)
+        if joined:
+            # The index keeps inherited descriptions in separate
+            # documents.
+            query = join_parentdescs(searcher, query)
+        pages = max(self.windowpages, pagenum)
+        limit = pages * pagelen
+        collector = None
+        if sort != RELEVANCE:
+            collector = sortkeys.collector(sort, limit)
+        # Facet counts cover every match, so they need an exact count
+        # too.
+        exactcount = joined or (facets is not None)
+        window = search_window_timeout(searcher, query, limit, timeout=self.querytimeout, exactcount=exactcount, collector=collector, groupedby=facets)
+        cache.put(cachekey, window, generation)
+        return (window, True)
+
+    def search(self, querystr, pagenum, pagelen, timings=None, sort=RELEVANCE):
+        """Parse a query string and run it with runsearch(). Raises
+        SearchError if there's no index, the query can't be parsed, the
+        index can't be sorted in the given mode, or the search times out.
+
+        If timings (a Timings object) is given, the stages of the search
+        are recorded in it.
+        """
+        if timings is None:
+            timings = Timings()
+        openindex = self.currentindex()
+        if openindex is None:
+            raise SearchError('noindex', 'The search index has not yet been built.')
+        if not openindex.sortkeys.supports(sort):
+            raise SearchError('sort', 'Results cannot be sorted by "%s"' % (sort,))
+        try:
+            with timings.span('parse'):
+                query = openindex.queryparser.parse(querystr)
+        except Exception as ex:
+            raise SearchError('parse', 'Query parse failed (%s)' % (ex,))
+        try:
+            return self.runsearch(query, querystr, pagenum, pagelen, timings=timings, openindex=openindex, sort=sort)
+        except TimeLimit:
+            raise SearchError('timeout', 'Query time limit (%.03f sec) exceeded' % (self.querytimeout,))
+
+    def export(self, querystr, format='jsonl', order='docnum'):
+        """Parse a query string and return a generator which yields the
+        export of every match, a line at a time (see searchlib.export).
+        Raises SearchError if there's no index or the query can't be
+        parsed.
+
+        The export has ExportTimeout seconds, rather than the usual
+        query time limit. The generator holds a searcher until it's
+        finished or closed.
+        """
+        openindex = self.currentindex()
+        if openindex is None:
+            raise SearchError('noindex', 'The search index has not yet been built.')
+        try:
+            query = openindex.queryparser.parse(querystr)
+        except Exception as ex:
+            raise SearchError('parse', 'Query parse failed (%s)' % (ex,))
+        return self.exportlines(openindex, query, format, order)
+
+    def exportlines(self, openindex, query, format, order):
+        with self.getsearcher(openindex=openindex) as searcher:
+            if PARENTDESC_FIELD in searcher.schema:
+                query = join_parentdescs(searcher, query)
+            yield from export_lines(searcher, query, format=format, order=order, timeout=self.exporttimeout)
+
+    def runsearch(self, query, querystr, pagenum, pagelen, timings=None, openindex=None, sort=RELEVANCE):
+        """Run a parsed query and return one page of results as a
+        SearchResults object. This handles the result cache, the result
+        window, and spelling correction; it's shared by the web handler,
+        the command line, and the search daemon.
+
+        The sort is a mode from searchlib.sortmodes, which the index
+        must support.
+
+        The stages are recorded in timings (a Timings object), if given.
+        The search runs on openindex if given, otherwise on the current
+        index.
+
+        Raises whoosh.searching.TimeLimit.
+        """
+        if timings is None:
+            timings = Timings()
+        if openindex is None:
+            openindex = self.currentindex()
+        with self.getsearcher(timings, openindex) as searcher:
+            # Results are cached by the parsed query (which folds
+            # together searches that differ only in case or spacing),
+            # the sort mode, the page, and the index generation.
+            with timings.span('cache'):
+                generation = openindex.generation(searcher)
+                cache = self.resultcache
+                cache.setgeneration(generation)
+                cachekey = (generation, repr(query), sort, pagenum, pagelen)
+                cached = cache.get(cachekey)
+            if cached is not None:
+                (resultcount, resultobjs, correctstr, facetcounts) = cached
+                facets = build_facets(facetcounts, querystr, resultcount, self.facetlimit)
+                return SearchResults(querystr, pagenum, pagelen, resultcount, resultobjs, correctstr, generation=generation, cached=True, facets=facets, sort=sort)
+
+            with timings.span('search'):
+                facets = openindex.facets if self.facetsenabled else None
+                (window, fetched) = self.getwindow(searcher, generation, query, pagenum, pagelen, facets=facets, sort=sort, sortkeys=openindex.sortkeys)
+            with timings.span('results'):
+                resultcount = len(window)
+                resultobjs = [ ResultItem(searcher.stored_fields(docnum), score) for (docnum, score) in window.page(pagenum, pagelen) ]
+
+            starttime = time.perf_counter()
+            with timings.span('spelling'):
+                correctstr = self.correctquery(searcher, query, querystr, resultcount, openindex)
+            correcttime = time.perf_counter() - starttime
+
+            cache.put(cachekey, (resultcount, resultobjs, correctstr, window.facets), generation)
+            
+        # The refinement links depend on the query string, which may
+        # differ between searches that share a cache entry.
+        facets = build_facets(window.facets, querystr, resultcount, self.facetlimit)
+        return SearchResults(querystr, pagenum, pagelen, resultcount, resultobjs, correctstr, generation=generation, runtime=(window.runtime if fetched else None), correcttime=correcttime, facets=facets, sort=sort)
+
+    def indexversion(self):
+        """Return (generation, mtime) for the current search index. The
+        generation is as for OpenIndex.generation(). The mtime is that of
+        the index's TOC file, which is written when the index is
+        committed. Returns (None, None) if there's no index.
+
+        This is cheap; it's the same check the searcher pool makes to see
+        if its searchers are current.
+        """
+        openindex = self.currentindex()
+        if openindex is None:
+            return (None, None)
+        with self.getsearcher(openindex=openindex) as searcher:
+            generation = openindex.generation(searcher)
+            mtime = openindex.tocmtime(searcher)
+        return (generation, mtime)
+
+    def recentpage(self, format):
+        """Return (generation, mtime, page) for the recent additions list
+        of the current index (see searchlib.recent), rendered as "html",
+        "json", or "atom". The generation and mtime are as for
+        indexversion(). The page is None if there's no index, or the
+        build didn't write a list.
+
+        The list only changes when the index does, so each rendering is
+        cached for the index generation.
+        """
+        openindex = self.currentindex()
+        if openindex is None:
+            return (None, None, None)
+        with self.getsearcher(openindex=openindex) as searcher:
+            generation = openindex.generation(searcher)
+            mtime = openindex.tocmtime(searcher)
+            items = openindex.getrecent(searcher)
+        if items is None:
+            return (generation, mtime, None)
+
+        tem = None
+        if format != 'json':
+            tem = self.getjenv().get_template('recent.xml' if format == 'atom' else 'recent.html')
+        (cachedgen, cachedtem, page) = openindex.recentpages.get(format, (None, None, None))
+        if cachedgen == generation and cachedtem is tem:
+            return (generation, mtime, page)
+
+        if mtime is not None:
+            updated = datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc)
+        elif items:
+            updated = items[0].date.astimezone()
+        else:
+            updated = datetime.datetime.now(datetime.timezone.utc)
+        if format == 'json':
+            page = json.dumps({
+                'updated': updated.isoformat(),
+                'results': [ jsonresult(obj) for obj in items ],
+            })
+        else:
+            page = tem.render(results=items, updated=updated)
+        openindex.recentpages[format] = (generation, tem, page)
+        return (generation, mtime, page)
+
+    def correctquery(self, searcher, query, querystr, resultcount, openindex=None):
+        """Return a "Did you mean" string for the query, or None.
+
+        Whoosh only corrects words which are missing from the index, so
+        if every word is present we can skip the whole business. We also
+        skip it if the search found at least SpellCheckMaxResults results
+        (if that's set).
+        """
+        if self.spellmaxresults and resultcount >= self.spellmaxresults:
+            return None
+        reader = searcher.reader()
+        schema = searcher.schema
+        terms = []
+        for token in query.all_tokens():
+            if token.fieldname in schema and (token.fieldname, token.text) not in reader:
+                terms.append((token.fieldname, token.text))
+        if not terms:
+            return None
+
+        if openindex is None:
+            openindex = self.currentindex()
+        correctors = openindex.getcorrectors(searcher)
+        corrected = searcher.correct_query(query, querystr, correctors=correctors, terms=terms)
+        if corrected.query != query and corrected.string != querystr:
+            return corrected.string
+        return None
+
+    def recordtimings(self, req, handler, querystr, timings, outcome='ok'):
+        """Finish off a search request: add its timings to the metrics,
+        and log it as a slow query if it took at least SlowQueryThreshold
+        seconds. (req may be None, for the search daemon.)
+        """
+        self.metrics.record(handler, timings, outcome)
+        if self.slowquerythreshold > 0:
+            total = timings.total()
+            if total >= self.slowquerythreshold:
+                self.logwarning(req, 'slow search "%s" (%s, %.04f sec: %s)', querystr, handler, total, timings.lognote())
+
+    def rendermetrics(self):
+        """Return the metrics (see searchlib.metrics) in Prometheus text
+        format, including the cache and searcher pool statistics.
+        """
+        extra = []
+        for (name, cache) in [ ('result', self.resultcache), ('window', self.windowcache) ]:
+            (hits, misses, entries) = cache.stats()
+            extra.append(('search_%s_cache_hits_total' % (name,), 'counter', 'Hits in the %s cache.' % (name,), hits))
+            extra.append(('search_%s_cache_misses_total' % (name,), 'counter', 'Misses in the %s cache.' % (name,), misses))
+            extra.append(('search_%s_cache_entries' % (name,), 'gauge', 'Entries in the %s cache.' % (name,), entries))
+        if self.searcherpool:
+            (idle, inuse) = self.searcherpool.stats()
+            extra.append(('search_searchers_idle', 'gauge', 'Idle searchers in the pool.', idle))
+            extra.append(('search_searchers_inuse', 'gauge', 'Searchers checked out of the pool.', inuse))
+        return self.metrics.render(extra)
+
+    def logcachestats(self, req):
+        """Every CacheStatsInterval lookups, log the result cache's hit
+        and miss counts.
+        """
+        if self.cachestatsinterval <= 0:
+            return
+        (hits, misses, entries) = self.resultcache.stats()
+        if (hits + misses) % self.cachestatsinterval == 0:
+            req.loginfo('result cache: %d hits, %d misses, %d entries', hits, misses, entries)
 
     def create_request(self, environ):
         """Create a request object.
@@ -76,6 +524,227 @@ class SearchApp(TinyApp):
         return SearchRequest(self, environ)
 
 
+class OpenIndex:
+    """One open index generation: the whoosh index, a query parser for
+    its schema, and a pool of searchers. Each generation directory gets
+    its own, so a new generation can have a new schema.
+    """
+
+    def __init__(self, indexdir, idletimeout=300):
+        self.indexdir = indexdir
+        self.name = os.path.basename(indexdir)
+        self.index = open_dir(indexdir)
+        self.queryparser = create_queryparser(self.index.schema)
+        self.pool = SearcherPool(self.index, idletimeout=idletimeout)
+        # The search facets this index's schema supports, or None.
+        self.facets = create_facets(self.index.schema)
+        # Sort keys for the non-relevance sort modes.
+        self.sortkeys = SortKeys(self.index.schema)
+        # The recent additions list for the current whoosh generation,
+        # and its rendered pages by format; see getrecent() and
+        # SearchApp.recentpage().
+        self.recent = (None, None)
+        self.recentlock = threading.Lock()
+        self.recentpages = {}
+        # Spelling correctors for the current whoosh generation; see
+        # getcorrectors().
+        self.spelling = (None, None)
+        self.spellinglock = threading.Lock()
+
+    def generation(self, searcher):
+        """Return a key for the searcher's view of the index. Whoosh
+        generation numbers start over in each new directory, so this is
+        a (dirname, generation) pair.
+        """
+        return (self.name, searcher.reader().generation())
+
+    def tocmtime(self, searcher):
+        """Return the mtime of the searcher's TOC file, or None.
+        """
+        # Whoosh's TOC file name for the default index name.
+        tocpath = os.path.join(self.indexdir, '_MAIN_%d.toc' % (searcher.reader().generation(),))
+        try:
+            return os.path.getmtime(tocpath)
+        except OSError:
+            return None
+
+    def getcorrectors(self, searcher):
+        """Return a dict of spelling correctors for the searcher's index
+        generation, suitable for passing to correct_query(). This uses
+        the word list written by the build, loaded once per generation.
+        Returns None if there's no current word list (whoosh will then
+        use the term dictionary).
+        """
+        generation = searcher.reader().generation()
+        with self.spellinglock:
+            (gen, correctors) = self.spelling
+            if gen != generation:
+                corrector = read_wordlist(self.indexdir, generation)
+                correctors = { WORDLIST_FIELD: corrector } if corrector else None
+                self.spelling = (generation, correctors)
+        return correctors
+
+    def getrecent(self, searcher):
+        """Return the recent additions list for the searcher's index
+        generation, as a list of ResultItems (newest first), or None if
+        the build didn't write a current one. It's loaded once per
+        generation.
+        """
+        generation = searcher.reader().generation()
+        with self.recentlock:
+            (gen, items) = self.recent
+            if gen != generation:
+                ls = read_recent(self.indexdir, generation)
+                items = [ ResultItem(fields) for fields in ls ] if ls is not None else None
+                self.recent = (generation, items)
+        return items
+
+    def close(self):
+        """Close the pooled searchers. Searchers still checked out are
+        closed when they're returned.
+        """
+        self.pool.close(final=True)
+
+class SearchError(Exception):
+    """Raised by SearchApp.search() when a search can't be done. The
+    code is "noindex", "parse", "sort", or "timeout"; the message is
+    readable.
+    """
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+class SearchResults:
+    """One page of search results, as returned by SearchApp.runsearch().
+    The results are ResultItems. The generation is that of the index
+    which was searched. If the page came from the result cache, cached
+    is true; if it came from a cached result window, runtime is None.
+    The facets are a list of searchlib.facets.Facet objects. The sort
+    is the sort mode; results sorted other than by relevance have no
+    scores.
+    """
+    
+    def __init__(self, querystr, pagenum, pagelen, resultcount, results, correctstr, generation=None, cached=False, runtime=None, correcttime=0.0, facets=None, sort=RELEVANCE):
+        self.querystr = querystr
+        self.pagenum = pagenum
+        self.pagelen = pagelen
+        self.resultcount = resultcount
+        self.results = results
+        self.correctstr = correctstr
+        self.generation = generation
+        self.cached = cached
+        self.runtime = runtime
+        self.correcttime = correcttime
+        self.facets = facets if facets is not None else []
+        self.sort = sort
+
+    def pagecount(self):
+        return (self.resultcount + self.pagelen - 1) // self.pagelen
+
+    def lognote(self):
+        """The parenthetical part of a search log line.
+        """
+        pagestr = '' if (self.pagenum == 1) else ('page %d, ' % (self.pagenum,))
+        if self.sort != RELEVANCE:
+            pagestr = '%s first, %s' % (self.sort, pagestr,)
+        if self.cached:
+            return '(%d results, %scached)' % (self.resultcount, pagestr,)
+        if self.runtime is None:
+            return '(%d results, %sfrom window, spelling %.04f sec)' % (self.resultcount, pagestr, self.correcttime,)
+        return '(%d results, %s%.04f sec, spelling %.04f sec)' % (self.resultcount, pagestr, self.runtime, self.correcttime,)
+
+    def outcome(self):
+        """The outcome label for metrics: "cached" or "ok".
+        """
+        return 'cached' if self.cached else 'ok'
+
+    def tojson(self, runtime=None):
+        """Return the results as a dict which can be passed to
+        json.dumps(). The caller supplies the runtime (the wall-clock
+        time of the whole search, including cache lookups).
+        """
+        return {
+            'query': self.querystr,
+            'page': self.pagenum,
+            'pagelen': self.pagelen,
+            'pagecount': self.pagecount(),
+            'sort': self.sort,
+            'resultcount': self.resultcount,
+            'correction': self.correctstr,
+            'runtime': runtime,
+            'cached': self.cached,
+            'results': [ jsonresult(obj) for obj in self.results ],
+            'facets': jsonfacets(self.facets),
+        }
+
+# How many result paths to keep display fields for; see pathdisplay().
+PATH_DISPLAY_CACHE = 4096
+
+@functools.lru_cache(maxsize=PATH_DISPLAY_CACHE)
+def pathdisplay(path, isdir):
+    """Return (pathhead, pathtail, url, urlfrag) for a result path. A
+    path's display fields never change, and popular results turn up
+    again and again, so this is memoized.
+    """
+    pathhead, _, pathtail = path.rpartition('/')
+    # We don't include the server for annoying urlencode reasons
+    if isdir:
+        return (pathhead, pathtail, 'indexes/if-archive/'+path, None)
+    return (pathhead, pathtail, 'indexes/if-archive/'+pathhead, filehash(pathtail))
+
+@functools.lru_cache(maxsize=PATH_DISPLAY_CACHE)
+def datestring(day):
+    """Format a date for display. (strftime is slow enough to be worth
+    memoizing; there are only so many days.)
+    """
+    return day.strftime('%Y-%b-%d')
+
+class ResultItem:
+    """One search result, for display: a document's stored fields, the
+    search score, and the display-only fields that the templates use.
+    These are shared between threads (via the result cache), so treat
+    them as immutable.
+    """
+    __slots__ = (
+        'path', 'type', 'date', 'size', 'shortdesc', 'score',
+        'isdir', 'datestr', 'pathhead', 'pathtail', 'url', 'urlfrag',
+    )
+
+    def __init__(self, fields, score=None):
+        self.path = fields.get('path')
+        self.type = fields.get('type')
+        self.date = fields.get('date')
+        self.size = fields.get('size')
+        self.shortdesc = fields.get('shortdesc')
+        self.score = score
+        self.isdir = (self.type == 'dir')
+        self.datestr = None
+        if self.date is not None:
+            self.datestr = datestring(self.date.date())
+        if self.path is not None:
+            (self.pathhead, self.pathtail, self.url, self.urlfrag) = pathdisplay(self.path, self.isdir)
+        else:
+            self.pathhead = self.pathtail = self.url = self.urlfrag = None
+
+# Result object keys which are exported in JSON.
+JSON_RESULT_KEYS = [ 'path', 'type', 'date', 'datestr', 'size', 'shortdesc', 'url', 'urlfrag', 'score' ]
+
+def jsonresult(obj):
+    """Convert a ResultItem to a JSON-friendly dict. The date becomes
+    an ISO string.
+    """
+    res = {}
+    for key in JSON_RESULT_KEYS:
+        val = getattr(obj, key)
+        if val is None:
+            continue
+        if key == 'date':
+            val = val.isoformat()
+        res[key] = val
+    return res
+
+
 class SearchRequest(TinyRequest):
 
     def lognote(self):
@@ -0,0 +1,135 @@
+"""segments:
+
+Segment health for the search index.
+
+Whoosh writes each build (and each flush of a build; see indexer.py)
+as a new segment, and an incremental build marks replaced documents as
+deleted rather than removing them. Every search iterates over every
+segment and skips the deleted documents, so as updates pile up, queries
+slow down until the segments are merged.
+
+index_status() reports on an index: its segments, how many of their
+documents are deleted, how many terms each field has, and its size on
+disk. MergeThresholds decides when a merge is due: too many segments,
+or too many deleted documents. A build checks after it commits (see
+build_index()), and "search.wsgi optimize" merges on demand. Either way
+the merge happens in a generation which readers aren't using yet (see
+generations.py), so searches carry on undisturbed.
+"""
+
+import os, os.path
+import time
+
+class SegmentStatus:
+    """One segment: its name, its document count (including deleted
+    documents), and how many are deleted.
+    """
+    def __init__(self, name, doccount, deleted):
+        self.name = name
+        self.doccount = doccount
+        self.deleted = deleted
+
+class IndexStatus:
+    """The health of an index. The fieldterms dict maps field names to
+    term counts; it's None if they weren't counted.
+    """
+    def __init__(self, indexdir, generation, segments, fieldterms, disksize):
+        self.indexdir = indexdir
+        self.generation = generation
+        self.segments = segments
+        self.fieldterms = fieldterms
+        self.disksize = disksize
+        self.doccount = sum([ seg.doccount for seg in segments ])
+        self.deleted = sum([ seg.deleted for seg in segments ])
+
+    def deletedratio(self):
+        if not self.doccount:
+            return 0.0
+        return self.deleted / self.doccount
+
+def index_status(index, indexdir, terms=True):
+    """Return an IndexStatus for a whoosh index. Counting terms means
+    reading every field's lexicon, so pass terms=False if you don't
+    need them.
+    """
+    segments = []
+    for seg in index._segments():
+        segments.append(SegmentStatus(seg.segment_id(), seg.doc_count_all(), seg.deleted_count()))
+
+    fieldterms = None
+    if terms:
+        fieldterms = {}
+        reader = index.reader()
+        try:
+            for (name, fieldobj) in index.schema.items():
+                if fieldobj.indexed:
+                    fieldterms[name] = sum(1 for _ in reader.lexicon(name))
+        finally:
+            reader.close()
+
+    disksize = 0
+    for name in os.listdir(indexdir):
+        path = os.path.join(indexdir, name)
+        if os.path.isfile(path):
+            disksize += os.path.getsize(path)
+
+    return IndexStatus(indexdir, index.latest_generation(), segments, fieldterms, disksize)
+
+def parse_hours(val):
+    """Parse an hour range like "2-6" (from 02:00 to 05:59) into a pair
+    of hours. The range may wrap past midnight ("22-4"). An empty value
+    means any time, and returns None.
+    """
+    val = val.strip()
+    if not val:
+        return None
+    try:
+        (start, _, end) = val.partition('-')
+        start = int(start)
+        end = int(end)
+    except ValueError:
+        raise ValueError('Bad hour range: %r' % (val,))
+    if not (0 <= start <= 24 and 0 <= end <= 24):
+        raise ValueError('Bad hour range: %r' % (val,))
+    return (start % 24, end % 24)
+
+class MergeThresholds:
+    """When to merge an index: when it has more than maxsegments
+    segments, or more than maxdeleted (a fraction) of its documents are
+    deleted. Either check is off if its limit is zero.
+
+    The hours argument (see parse_hours()) is the off-peak window in
+    which automatic merges may run. Merging is heavy on CPU and disk,
+    so outside it, a build leaves the merge for later.
+    """
+    def __init__(self, maxsegments=10, maxdeleted=0.2, hours=None):
+        self.maxsegments = maxsegments
+        self.maxdeleted = maxdeleted
+        self.hours = hours
+
+    def check(self, status):
+        """Return the reason the index described by an IndexStatus
+        needs merging, or None if it doesn't.
+        """
+        if self.maxsegments and len(status.segments) > self.maxsegments:
+            return '%d segments, more than %d' % (len(status.segments), self.maxsegments,)
+        ratio = status.deletedratio()
+        if self.maxdeleted and ratio > self.maxdeleted:
+            return '%.1f%% deleted documents, more than %.1f%%' % (ratio*100, self.maxdeleted*100,)
+        return None
+
+    def offpeak(self, now=None):
+        """Whether automatic merges may run now.
+        """
+        if self.hours is None:
+            return True
+        if now is None:
+            now = time.time()
+        hour = time.localtime(now).tm_hour
+        (start, end) = self.hours
+        if start == end:
+            # "0-24"
+            return True
+        if start < end:
+            return (start <= hour < end)
+        return (hour >= start or hour < end)
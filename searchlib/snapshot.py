@@ -0,0 +1,349 @@
+"""snapshot:
+
+A compact binary copy of Master-Index.xml, for fast re-reading.
+
+Parsing the XML is the slowest part of reading Master-Index.xml. After
+a parse, ifarchivexml can write the same IFDir and IFFile objects into a
+snapshot file; the next parse of the same (unchanged) XML file loads
+the snapshot instead, which takes a fraction of the time. The snapshot
+records the size and mtime of the XML file it came from, and is ignored
+if they don't match.
+
+The file is laid out so that it can be mmapped and read without
+parsing:
+
+- a header (magic, byte-order check, source size and mtime, counts)
+- the string table offsets (uint32, one more than the string count)
+- the records (int64, RECORD_LEN per directory or file, in
+  Master-Index.xml order)
+- the extras (int64; metadata and parentdescs, as flattened lists)
+- the string table itself (UTF-8)
+
+Every string is stored once. On loading, each string is decoded once
+and shared between all the objects which use it, so a directory's name
+and its parentdesc text are not repeated for every file in it.
+"""
+
+import os, os.path
+import mmap
+import struct
+import logging
+from array import array
+
+from searchlib.ifarchivexml import IFDir, IFFile
+
+MAGIC = b'IFASNAP1'
+BYTEORDER_CHECK = 0x01020304
+# magic, byte-order check, source size, source mtime_ns, string count,
+# record count, extras count, string table length
+HEADER = struct.Struct('=8sIqqIIIQ')
+
+# A missing value (None) in a record or the extras.
+NONE = -2**63
+
+KIND_DIR = 1
+KIND_FILE = 2
+
+SYMLINK_KINDS = { None: 0, 'dir': 1, 'file': 2 }
+SYMLINK_NAMES = { val: key for (key, val) in SYMLINK_KINDS.items() }
+
+# Record slots. The first four, and description/metadata/parentdescs,
+# are shared by both kinds.
+RECORD_LEN = 14
+(R_KIND, R_NAME, R_PARENT, R_DATE, R_RAWDATE, R_DESC, R_METADATA, R_PARENTDESCS,
+ R_SUBDIRCOUNT, R_FILECOUNT) = range(10)
+# File records use the same slots for (kind, name, directory, date, ...)
+# and then:
+(R_PATH, R_SIZE, R_MD5, R_SHA512, R_SYMLINK, R_SYMLINKTARGET) = (8, 9, 10, 11, 12, 13)
+
+def source_stat(filename):
+    """Return the (size, mtime_ns) of the source file, which must
+    match for a snapshot to be used.
+    """
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns)
+
+class SnapshotWriter:
+    """Collects IFDir and IFFile objects (in Master-Index.xml order) and
+    writes them out when finish() is called.
+    """
+
+    def __init__(self, path, sourcefile):
+        self.path = path
+        self.sourcestat = source_stat(sourcefile)
+        # Maps each string to its index in the string table.
+        self.strings = {}
+        self.records = array('q')
+        self.extras = array('q')
+
+    def string(self, val):
+        if val is None:
+            return NONE
+        index = self.strings.get(val)
+        if index is None:
+            index = self.strings[val] = len(self.strings)
+        return index
+
+    def number(self, val):
+        return NONE if val is None else val
+
+    def metadata(self, metadata):
+        if metadata is None:
+            return NONE
+        pos = len(self.extras)
+        self.extras.append(len(metadata))
+        for (key, valls) in metadata.items():
+            self.extras.append(self.string(key))
+            self.extras.append(len(valls))
+            self.extras.extend(self.string(val) for val in valls)
+        return pos
+
+    def parentdescs(self, parentdescs):
+        if not parentdescs:
+            return NONE
+        pos = len(self.extras)
+        self.extras.append(len(parentdescs))
+        for (key, val) in parentdescs.items():
+            self.extras.append(self.string(key))
+            self.extras.append(self.string(val))
+        return pos
+
+    def adddir(self, dir):
+        rec = [ NONE ] * RECORD_LEN
+        rec[R_KIND] = KIND_DIR
+        rec[R_NAME] = self.string(dir.name)
+        rec[R_PARENT] = self.string(dir.parent)
+        rec[R_DATE] = self.string(dir.date)
+        rec[R_RAWDATE] = self.number(dir.rawdate)
+        rec[R_DESC] = self.string(dir.description)
+        rec[R_METADATA] = self.metadata(dir.metadata)
+        rec[R_PARENTDESCS] = self.parentdescs(dir.parentdescs)
+        rec[R_SUBDIRCOUNT] = self.number(dir.subdircount)
+        rec[R_FILECOUNT] = self.number(dir.filecount)
+        self.records.extend(rec)
+
+    def addfile(self, file):
+        rec = [ NONE ] * RECORD_LEN
+        rec[R_KIND] = KIND_FILE
+        rec[R_NAME] = self.string(file.name)
+        rec[R_PARENT] = self.string(file.directory)
+        rec[R_DATE] = self.string(file.date)
+        rec[R_RAWDATE] = self.number(file.rawdate)
+        rec[R_DESC] = self.string(file.description)
+        rec[R_METADATA] = self.metadata(file.metadata)
+        rec[R_PARENTDESCS] = self.parentdescs(file.parentdescs)
+        rec[R_PATH] = self.string(file.path)
+        rec[R_SIZE] = self.number(file.size)
+        rec[R_MD5] = self.string(file.md5)
+        rec[R_SHA512] = self.string(file.sha512)
+        rec[R_SYMLINK] = SYMLINK_KINDS[file.symlink]
+        if file.symlink == 'dir':
+            rec[R_SYMLINKTARGET] = self.string(file.symlinkname)
+        elif file.symlink == 'file':
+            rec[R_SYMLINKTARGET] = self.string(file.symlinkpath)
+        self.records.extend(rec)
+
+    def finish(self):
+        """Write the snapshot. We write a temporary file and rename it
+        into place. A failure is logged, not raised; the snapshot is
+        only an optimization.
+        """
+        offsets = array('I', [ 0 ])
+        chunks = []
+        pos = 0
+        # The dict preserves insertion order, which is index order.
+        for val in self.strings:
+            dat = val.encode('utf-8', 'surrogatepass')
+            chunks.append(dat)
+            pos += len(dat)
+            offsets.append(pos)
+        blob = b''.join(chunks)
+        if len(offsets) % 2:
+            # Keep the int64 arrays 8-byte aligned.
+            offsets.append(pos)
+        (size, mtime) = self.sourcestat
+        header = HEADER.pack(MAGIC, BYTEORDER_CHECK, size, mtime, len(self.strings), len(self.records) // RECORD_LEN, len(self.extras), len(blob))
+
+        tmppath = self.path + '.tmp'
+        try:
+            with open(tmppath, 'wb') as fl:
+                fl.write(header)
+                offsets.tofile(fl)
+                self.records.tofile(fl)
+                self.extras.tofile(fl)
+                fl.write(blob)
+            os.replace(tmppath, self.path)
+        except OSError as ex:
+            logging.warning('snapshot: unable to write %s: %s', self.path, ex)
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+
+class SnapshotReader:
+    """Reads a snapshot file through a read-only mmap. Use read() to
+    feed the objects to an IFAParser, then close().
+    """
+
+    def __init__(self, path):
+        self.fl = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.fl.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self.fl.close()
+            raise
+        self.view = None
+        try:
+            self.header = HEADER.unpack_from(self.map, 0)
+        except struct.error:
+            self.header = None
+
+    def matches(self, sourcefile):
+        """Check that this is a usable snapshot of sourcefile as it is
+        now.
+        """
+        if self.header is None:
+            return False
+        (magic, check, size, mtime, nstrings, nrecords, nextras, bloblen) = self.header
+        if magic != MAGIC or check != BYTEORDER_CHECK:
+            return False
+        if (size, mtime) != source_stat(sourcefile):
+            return False
+        noffsets = nstrings + 1 + ((nstrings + 1) % 2)
+        expected = HEADER.size + 4*noffsets + 8*(RECORD_LEN*nrecords + nextras) + bloblen
+        return len(self.map) == expected
+
+    def read(self, parser):
+        """Pass every directory and file to parser.adddir() and
+        parser.addfile(), in order, then call parser.ifarchive_end().
+        """
+        (magic, check, size, mtime, nstrings, nrecords, nextras, bloblen) = self.header
+        noffsets = nstrings + 1 + ((nstrings + 1) % 2)
+        self.view = memoryview(self.map)
+        pos = HEADER.size
+        offsets = self.view[ pos : pos+4*noffsets ].cast('I')
+        pos += 4*noffsets
+        records = self.view[ pos : pos+8*RECORD_LEN*nrecords ].cast('q')
+        pos += 8*RECORD_LEN*nrecords
+        extras = self.view[ pos : pos+8*nextras ].cast('q')
+        pos += 8*nextras
+        blob = self.view[ pos : pos+bloblen ]
+
+        # Strings are decoded on first use and then shared.
+        strings = [ None ] * nstrings
+        def string(index):
+            if index == NONE:
+                return None
+            val = strings[index]
+            if val is None:
+                val = strings[index] = str(blob[ offsets[index] : offsets[index+1] ], 'utf-8', 'surrogatepass')
+            return val
+
+        def number(val):
+            return None if val == NONE else val
+
+        def metadata(pos):
+            if pos == NONE:
+                return None
+            res = {}
+            count = extras[pos]
+            pos += 1
+            for _ in range(count):
+                key = string(extras[pos])
+                nvals = extras[pos+1]
+                res[key] = [ string(val) for val in extras[ pos+2 : pos+2+nvals ] ]
+                pos += 2 + nvals
+            return res
+
+        def parentdescs(pos):
+            if pos == NONE:
+                return {}
+            res = {}
+            count = extras[pos]
+            for ix in range(pos+1, pos+1+2*count, 2):
+                res[string(extras[ix])] = string(extras[ix+1])
+            return res
+
+        try:
+            # Converting the records in one go is much faster than
+            # slicing the view for each one.
+            allrecs = records.tolist()
+            for base in range(0, RECORD_LEN*nrecords, RECORD_LEN):
+                rec = allrecs[ base : base+RECORD_LEN ]
+                if rec[R_KIND] == KIND_DIR:
+                    dir = IFDir()
+                    dir.name = string(rec[R_NAME])
+                    dir.parent = string(rec[R_PARENT])
+                    dir.date = string(rec[R_DATE])
+                    dir.rawdate = number(rec[R_RAWDATE])
+                    dir.description = string(rec[R_DESC])
+                    dir.metadata = metadata(rec[R_METADATA])
+                    dir.parentdescs = parentdescs(rec[R_PARENTDESCS])
+                    dir.subdircount = number(rec[R_SUBDIRCOUNT])
+                    dir.filecount = number(rec[R_FILECOUNT])
+                    parser.adddir(dir)
+                else:
+                    file = IFFile()
+                    file.name = string(rec[R_NAME])
+                    file.directory = string(rec[R_PARENT])
+                    file.date = string(rec[R_DATE])
+                    file.rawdate = number(rec[R_RAWDATE])
+                    file.description = string(rec[R_DESC])
+                    file.metadata = metadata(rec[R_METADATA])
+                    file.parentdescs = parentdescs(rec[R_PARENTDESCS])
+                    file.path = string(rec[R_PATH])
+                    file.size = number(rec[R_SIZE])
+                    file.md5 = string(rec[R_MD5])
+                    file.sha512 = string(rec[R_SHA512])
+                    file.symlink = SYMLINK_NAMES[rec[R_SYMLINK]]
+                    if file.symlink == 'dir':
+                        file.symlinkname = string(rec[R_SYMLINKTARGET])
+                    elif file.symlink == 'file':
+                        file.symlinkpath = string(rec[R_SYMLINKTARGET])
+                    parser.addfile(file)
+        finally:
+            # The mmap can't be closed while these views exist.
+            for view in (offsets, records, extras, blob):
+                view.release()
+        parser.ifarchive_end()
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        self.map.close()
+        self.fl.close()
+
+def snapshot_count(path, sourcefile):
+    """If path is a current snapshot of sourcefile, return how many
+    directories and files it holds. Otherwise return None.
+    """
+    try:
+        reader = SnapshotReader(path)
+    except (OSError, ValueError):
+        return None
+    try:
+        if not reader.matches(sourcefile):
+            return None
+        (magic, check, size, mtime, nstrings, nrecords, nextras, bloblen) = reader.header
+        return nrecords
+    finally:
+        reader.close()
+
+def read_snapshot(path, sourcefile, parser):
+    """If path is a current snapshot of sourcefile, feed its contents
+    to the parser (as ifarchivexml.run_parser() does) and return True.
+    Otherwise return False.
+    """
+    try:
+        reader = SnapshotReader(path)
+    except (OSError, ValueError):
+        # Missing, or empty (which mmap refuses).
+        return False
+    try:
+        if not reader.matches(sourcefile):
+            return False
+        reader.read(parser)
+        return True
+    finally:
+        reader.close()
@@ -0,0 +1,121 @@
+"""sortmodes:
+
+Result orders other than relevance: newest first, oldest first, and
+largest first.
+
+Whoosh can sort by a field (its SortingCollector), but it collects and
+sorts every match, and looks up each document's value through a
+translating column reader. For a broad search that's most of the cost,
+and we only ever want the first few pages.
+
+Instead, for each index segment we read the date or size column once
+into a compact array of sort keys (cached for the life of the index
+generation; segments never change). SortedTopCollector then keeps the
+top N documents by key in a heap, just as whoosh's TopCollector does
+for scores. No scores are computed. Documents with no value (a file
+with no date, or a directory, which has no size) sort last.
+"""
+
+from array import array
+
+from whoosh.collectors import TopCollector
+
+RELEVANCE = 'relevance'
+
+# Maps each sort mode to (field, descending).
+SORT_MODES = {
+    'newest': ('date', True),
+    'oldest': ('date', False),
+    'largest': ('size', True),
+}
+# The modes in display order, with labels.
+SORT_MODE_LABELS = [
+    (RELEVANCE, 'Relevance'),
+    ('newest', 'Newest first'),
+    ('oldest', 'Oldest first'),
+    ('largest', 'Largest first'),
+]
+SORT_MODE_NAMES = [ mode for (mode, label) in SORT_MODE_LABELS ]
+
+# Raw (untranslated) column values of sortable numeric and date fields
+# are unsigned 64-bit, in the same order as the values themselves. A
+# document with no value gets the maximum.
+RAW_OFFSET = 2**63
+RAW_MISSING = 2**64 - 1
+# The key of a document with no value.
+KEY_LAST = -2**63
+
+class SortKeys:
+    """The per-segment sort keys for one open index. Create one per
+    index generation and share it between threads. (Two threads may
+    race to build the same segment's keys; that's harmless.)
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        # Maps (segment ID, mode) to an array of keys, by document.
+        self.keys = {}
+
+    def supports(self, mode):
+        """Whether the index can be sorted in the given mode. (An index
+        built before size was sortable can't be sorted by size.)
+        """
+        if mode == RELEVANCE:
+            return True
+        if mode not in SORT_MODES:
+            return False
+        (fieldname, descending) = SORT_MODES[mode]
+        return (fieldname in self.schema and getattr(self.schema[fieldname], 'column_type', None) is not None)
+
+    def segment_keys(self, reader, mode):
+        """Return the array of sort keys for a segment reader's
+        documents. A higher key sorts first.
+        """
+        segment = reader.segment() if hasattr(reader, 'segment') else None
+        cachekey = (segment.segment_id(), mode) if segment is not None else None
+        keys = self.keys.get(cachekey) if cachekey is not None else None
+        if keys is not None:
+            return keys
+
+        (fieldname, descending) = SORT_MODES[mode]
+        creader = reader.column_reader(fieldname, translate=False)
+        if descending:
+            keys = array('q', ( (KEY_LAST if val == RAW_MISSING else val - RAW_OFFSET) for val in creader ))
+        else:
+            keys = array('q', ( (KEY_LAST if val == RAW_MISSING else RAW_OFFSET - 1 - val) for val in creader ))
+        if cachekey is not None:
+            self.keys[cachekey] = keys
+        return keys
+
+    def collector(self, mode, limit):
+        """Return a collector for the top limit matches in the given
+        sort mode.
+        """
+        return SortedTopCollector(self, mode, limit)
+
+class SortedTopCollector(TopCollector):
+    """Like whoosh's TopCollector, but ranks documents by a precomputed
+    sort key instead of their score. The results have no scores (they're
+    None). Every match is counted.
+    """
+
+    def __init__(self, sortkeys, mode, limit=10):
+        # The block-quality and matcher-replacement optimizations rely
+        # on scores, so they're off.
+        TopCollector.__init__(self, limit=limit, usequality=False, replace=0)
+        self.sortkeys = sortkeys
+        self.mode = mode
+        self.segkeys = None
+
+    def set_subsearcher(self, subsearcher, offset):
+        TopCollector.set_subsearcher(self, subsearcher, offset)
+        self.segkeys = self.sortkeys.segment_keys(subsearcher.reader(), self.mode)
+
+    def collect(self, sub_docnum):
+        return self._collect(self.offset + sub_docnum, self.segkeys[sub_docnum])
+
+    def results(self):
+        items = self.items
+        items.sort(reverse=True)
+        items = [ (None, 0 - docnum) for (key, docnum) in items ]
+        return self._results(items)
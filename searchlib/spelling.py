@@ -0,0 +1,102 @@
+"""spelling:
+
+Support for "Did you mean" suggestions.
+
+Whoosh's correct_query() only tries to correct words which don't appear
+in the index. For each one, it walks the field's term dictionary with a
+Levenshtein automaton and ranks the candidates by frequency. On a
+multi-segment index the walk falls back to checking every term.
+
+To make that cheaper, the build writes out a word list for the
+description field (every term with its frequency) and the web app
+loads it once per index generation. WordListCorrector runs the same
+automaton walk and the same ranking over that list, so the suggestions
+match what whoosh's ReaderCorrector would give.
+"""
+
+import os, os.path
+from bisect import bisect_left
+
+from whoosh.spelling import Corrector
+
+WORDLIST_FILE = 'spelling.txt'
+
+# The field we precompute. Queries on other fields (rare) use whoosh's
+# default corrector.
+WORDLIST_FIELD = 'description'
+
+def write_wordlist(index, indexdir):
+    """Write the word list for the index's current generation. The first
+    line records the generation, so that a reader can tell whether the
+    list is current.
+    """
+    reader = index.reader()
+    try:
+        fieldobj = index.schema[WORDLIST_FIELD]
+        path = os.path.join(indexdir, WORDLIST_FILE)
+        tmppath = path + '.tmp'
+        with open(tmppath, 'w', encoding='utf-8') as fl:
+            fl.write('generation\t%d\n' % (reader.generation(),))
+            # The lexicon is in sorted order, which is what we want.
+            for (btext, terminfo) in reader.iter_field(WORDLIST_FIELD):
+                word = fieldobj.from_bytes(btext)
+                fl.write('%s\t%d\n' % (word, terminfo.weight()))
+        os.replace(tmppath, path)
+    finally:
+        reader.close()
+
+def read_wordlist(indexdir, generation):
+    """Load the word list and return a WordListCorrector, or None if the
+    list is missing or was written for a different generation.
+    """
+    path = os.path.join(indexdir, WORDLIST_FILE)
+    try:
+        with open(path, encoding='utf-8') as fl:
+            line = fl.readline()
+            key, _, val = line.rstrip('\n').partition('\t')
+            if key != 'generation' or int(val) != generation:
+                return None
+            words = []
+            freqs = {}
+            for line in fl:
+                word, _, val = line.rstrip('\n').rpartition('\t')
+                words.append(word)
+                freqs[word] = int(val)
+    except (OSError, ValueError):
+        return None
+    return WordListCorrector(words, freqs)
+
+class WordListCorrector(Corrector):
+    """Suggests corrections from a sorted word list with frequencies.
+    This is whoosh's ReaderCorrector, with the term dictionary swapped
+    for an in-memory list.
+    """
+
+    def __init__(self, words, freqs):
+        self.words = words
+        self.freqs = freqs
+
+    def _suggestions(self, text, maxdist, prefix):
+        from whoosh.automata.lev import levenshtein_automaton
+
+        words = self.words
+        freqs = self.freqs
+        if not words:
+            return
+
+        # This is the loop in whoosh's Automata.find_matches(), with
+        # bisect standing in for the term cursor.
+        dfa = levenshtein_automaton(text, maxdist, prefix).to_dfa()
+        match = dfa.next_valid_string(words[0])
+        while match:
+            pos = bisect_left(words, match)
+            if pos >= len(words):
+                return
+            term = words[pos]
+            if match == term:
+                # Higher scores are better; this is the same formula
+                # ReaderCorrector uses.
+                f = freqs.get(term) or 1
+                yield (0 - (maxdist + (1.0 / f * 0.5)), term)
+                term += '\0'
+            match = dfa.next_valid_string(term)
@@ -1,7 +1,9 @@
 import re
 
 from whoosh.searching import ResultsPage
-from whoosh.collectors import TimeLimitCollector
+from whoosh.collectors import FacetCollector
+from whoosh.analysis import Filter
+from searchlib.deadline import DeadlineCollector
 
 filehash_pattern = re.compile('([^a-zA-Z0-9_.,;:()@/-])')
 filehash_escaper = lambda match: '=%02X=' % (ord(match.group(1)),)
@@ -19,7 +21,35 @@ def filehash(val):
     return filehash_pattern.sub(filehash_escaper, val)
     
 pat_markdownlink = re.compile('\\[([^\\]]*)\\]\\([^)]*\\)')
-def buildmddesc(obj, all=True):
+def stripmdlinks(val):
+    """Replace Markdown links with their bare text.
+    """
+    return pat_markdownlink.sub('\\1', val)
+
+# In "inline" mode, an item's description and the parentdescs it
+# inherits are indexed as one text, with this word between the parts.
+# DescBreakFilter drops it and leaves a gap in the token positions, so
+# that a phrase can't match across two parts. (In "directory" mode the
+# parts are in separate documents, so it can't there either.)
+DESC_BREAK = 'zzdescbreakzz'
+DESC_BREAK_GAP = 100
+
+class DescBreakFilter(Filter):
+    """Remove DESC_BREAK words from the token stream, and add
+    DESC_BREAK_GAP to the position of every token after each one. This
+    must come after the StopFilter, which renumbers positions.
+    """
+    def __call__(self, tokens):
+        offset = 0
+        for t in tokens:
+            if t.text == DESC_BREAK:
+                offset += DESC_BREAK_GAP
+                continue
+            if offset and t.positions:
+                t.pos += offset
+            yield t
+
+def buildmddesc(obj, all=True, inherit=True, cache=None, sep='\n'):
     """Pull out the description from an IFDir or IFFile object, as
     loaded from Master-Index.xml.
 
@@ -30,26 +60,44 @@ def buildmddesc(obj, all=True):
     interesting for either searching or displaying.)
 
     We include all parentdescs, because they may have useful search terms,
-    especially if the local description is empty.
+    especially if the local description is empty. If inherit is False,
+    we leave them out.
 
     If all is False, we only return *one* description: the local one or
-    the first parentdesc found.
+    the first parentdesc found. Otherwise they're joined with sep (for
+    the search index, a DESC_BREAK line).
+
+    The same parentdesc turns up on every file under its directory, so
+    the caller can pass a cache dict, mapping parentdesc directories to
+    (text, stripped text). Then each one is only stripped once.
     """
     alldesc = []
     if obj.description:
-        alldesc.append(obj.description)
-    for desc in obj.parentdescs.values():
-        if alldesc and not all:
-            break
-        if desc:
-            alldesc.append(desc)
+        alldesc.append(stripmdlinks(obj.description))
+    if inherit:
+        for (key, desc) in obj.parentdescs.items():
+            if alldesc and not all:
+                break
+            if desc:
+                alldesc.append(stripparentdesc(key, desc, cache))
         
     if not alldesc:
         return None
 
-    alldesc = [ pat_markdownlink.sub('\\1', val) for val in alldesc ]
-    
-    return '\n'.join(alldesc)
+    return sep.join(alldesc)
+
+def stripparentdesc(key, desc, cache=None):
+    """Strip the links from a parentdesc (which came from directory
+    key), using the cache if there is one. See buildmddesc().
+    """
+    if cache is None:
+        return stripmdlinks(desc)
+    ent = cache.get(key)
+    if ent is not None and ent[0] == desc:
+        return ent[1]
+    stripped = stripmdlinks(desc)
+    cache[key] = (desc, stripped)
+    return stripped
 
 def buildtuids(obj):
     """Pull out the tuid and tuidcomp lists from an object's metadata,
@@ -89,8 +137,102 @@ def search_page_timeout(searcher, query, pagenum, pagelen=10, timeout=1.0, **kwa
     kwargs = dict(kwargs)
     kwargs['limit'] = pagenum * pagelen
     col = searcher.collector(**kwargs)
-    # SIGALRM interacts badly with Apache, so we use the cooperative mode of TimeLimitCollector.
-    col = TimeLimitCollector(col, timeout, use_alarm=False)
+    # SIGALRM interacts badly with Apache, so we can't use TimeLimitCollector's
+    # alarm mode. DeadlineCollector is its cooperative mode, minus the thread
+    # per query.
+    col = DeadlineCollector(col, timeout)
     searcher.search_with_collector(query, col)
     results = col.results()
     return ResultsPage(results, pagenum, pagelen)
+
+class ResultWindow:
+    """The top hits of a search, as a list of (docnum, score) pairs,
+    along with the total number of matches and (if the search asked for
+    them) the facet counts, as a dict mapping facet names to
+    {value: count} dicts.
+
+    We fetch a window of several pages at once, so that paging through
+    the results doesn't re-run the query for every page. A window is
+    immutable once created (it may be cached and shared between threads).
+    """
+    def __init__(self, hits, total, limit, runtime, facets=None):
+        self.hits = hits
+        self.total = total
+        self.limit = limit
+        self.runtime = runtime
+        self.facets = facets
+
+    def __len__(self):
+        return self.total
+
+    def covers(self, pagenum, pagelen):
+        """Whether the given page can be served from this window.
+        """
+        if len(self.hits) >= self.total:
+            # We have every hit.
+            return True
+        return pagenum * pagelen <= self.limit
+
+    def page(self, pagenum, pagelen):
+        """Return the (docnum, score) pairs for the given page. Like
+        whoosh's ResultsPage, a page past the end is treated as the last
+        page.
+        """
+        pagecount = (self.total + pagelen - 1) // pagelen
+        pagenum = max(1, min(pagenum, pagecount))
+        offset = (pagenum - 1) * pagelen
+        return self.hits[ offset : offset+pagelen ]
+
+def search_window_timeout(searcher, query, limit, timeout=1.0, exactcount=False, collector=None, **kwargs):
+    """Run a search and return a ResultWindow of the top limit hits.
+    Limits the query time, like search_page_timeout(). Raises
+    whoosh.searching.TimeLimit.
+
+    Whoosh's collector periodically replaces the matcher with one that
+    skips branches which can't make the top hits. That's fine for the
+    hits, but the total count then misses documents from skipped
+    branches of a large OR. Set exactcount to turn that off.
+
+    If a groupedby argument is passed (see searchlib.facets), the
+    window includes the facet counts. Those cover every match, so set
+    exactcount too.
+
+    If collector is given, it's used in place of the usual top-scores
+    collector (for example, sortmodes.SortedTopCollector). It should
+    already be set up for limit hits.
+    """
+    kwargs = dict(kwargs)
+    groupedby = kwargs.pop('groupedby', None)
+    if collector is None:
+        kwargs['limit'] = limit
+        col = searcher.collector(**kwargs)
+    else:
+        col = collector
+    if exactcount:
+        col.replace = 0
+    if groupedby is not None:
+        # This wraps the collector, so it comes after setting replace.
+        col = FacetCollector(col, groupedby)
+    # SIGALRM interacts badly with Apache, so we can't use TimeLimitCollector's
+    # alarm mode. DeadlineCollector is its cooperative mode, minus the thread
+    # per query.
+    col = DeadlineCollector(col, timeout)
+    searcher.search_with_collector(query, col)
+    results = col.results()
+    facets = None
+    if groupedby is not None:
+        facets = { name: results.groups(name) for name in results.facet_names() }
+    return ResultWindow(list(results.items()), len(results), limit, results.runtime, facets=facets)
+
+def peakrss():
+    """Peak RSS of this process and its (finished) children, in kilobytes.
+    (This is Linux's unit for ru_maxrss. MacOS reports bytes.)
+    """
+    import sys
+    import resource
+    val = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    childval = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        val //= 1024
+        childval //= 1024
+    return { 'peak_rss_kb': val, 'children_peak_rss_kb': childval }
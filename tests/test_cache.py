@@ -0,0 +1,74 @@
+"""Tests for cache: the LRU result cache's size limit, expiry, and
+generation handling.
+
+Run from the top of the repo:
+
+    python3 -m unittest discover tests
+"""
+
+import time
+import unittest
+
+from searchlib.cache import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = LRUCache(maxsize=10, ttl=600)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats(), (1, 1, 1))
+
+    def test_size_limit(self):
+        cache = LRUCache(maxsize=3, ttl=600)
+        for key in 'abc':
+            cache.put(key, key.upper())
+        # Touch "a", so that "b" is the least recently used.
+        self.assertEqual(cache.get('a'), 'A')
+        cache.put('d', 'D')
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get('b'))
+        for key in 'acd':
+            self.assertEqual(cache.get(key), key.upper())
+
+    def test_disabled(self):
+        cache = LRUCache(maxsize=0, ttl=600)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_ttl(self):
+        cache = LRUCache(maxsize=10, ttl=0.05)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_setgeneration(self):
+        cache = LRUCache(maxsize=10, ttl=600)
+        cache.setgeneration(1)
+        cache.put('a', 1, 1)
+        # The same generation keeps the entries.
+        cache.setgeneration(1)
+        self.assertEqual(cache.get('a'), 1)
+        cache.setgeneration(2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_stale_put(self):
+        # A search starts on generation 1, and another thread switches
+        # to generation 2 before it finishes. Its result must not be
+        # stored.
+        cache = LRUCache(maxsize=10, ttl=600)
+        cache.setgeneration(1)
+        cache.setgeneration(2)
+        cache.put((1, 'query'), 'OLD RESULT', 1)
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get((2, 'query')))
+        cache.put((2, 'query'), 'NEW RESULT', 2)
+        self.assertEqual(cache.get((2, 'query')), 'NEW RESULT')
+
+if __name__ == '__main__':
+    unittest.main()
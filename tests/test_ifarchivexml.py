@@ -0,0 +1,128 @@
+"""Tests for ifarchivexml: the etree and SAX backends must build the same
+objects from the same Master-Index.xml.
+
+Run from the top of the repo:
+
+    python3 -m unittest discover tests
+"""
+
+import os.path
+import xml.sax
+import unittest
+
+from searchlib import ifarchivexml
+
+DATADIR = os.path.join(os.path.dirname(__file__), 'data')
+EDGECASES = os.path.join(DATADIR, 'edgecases.xml')
+
+# Fields which hold other objects; we compare those by name.
+LINK_FIELDS = ( 'parentobj', 'directoryobj', 'subdirs', 'files' )
+
+def objfields(obj):
+    """Return the fields of an IFDir or IFFile as a dict, with links to
+    other objects replaced by their names.
+    """
+    res = {}
+    for key in obj.__slots__:
+        val = getattr(obj, key)
+        if key in LINK_FIELDS:
+            if isinstance(val, list):
+                val = [ repr(subobj) for subobj in val ]
+            elif val is not None:
+                val = repr(val)
+        res[key] = val
+    return res
+
+def parse_callback_objects(filename, backend, snapshot=None):
+    """Parse in callback form and return the list of (kind, fields)
+    in the order the callbacks saw them.
+    """
+    res = []
+    ifarchivexml.parse_callback(filename,
+        dirfunc=lambda obj: res.append(('dir', objfields(obj))),
+        filefunc=lambda obj: res.append(('file', objfields(obj))),
+        backend=backend, snapshot=snapshot)
+    return res
+
+def parse_tree_objects(filename, backend, snapshot=None):
+    """Parse in tree form and return (dirs, files) as dicts of fields.
+    """
+    (root, dirs, files) = ifarchivexml.parse(filename, backend=backend, snapshot=snapshot)
+    return (
+        { key: objfields(obj) for (key, obj) in dirs.items() },
+        { key: objfields(obj) for (key, obj) in files.items() },
+    )
+
+class TestBackends(unittest.TestCase):
+
+    def test_callback_equivalence(self):
+        etreeobjs = parse_callback_objects(EDGECASES, 'etree')
+        saxobjs = parse_callback_objects(EDGECASES, 'sax')
+        self.assertEqual(len(etreeobjs), 9)
+        self.assertEqual(etreeobjs, saxobjs)
+
+    def test_tree_equivalence(self):
+        self.assertEqual(parse_tree_objects(EDGECASES, 'etree'), parse_tree_objects(EDGECASES, 'sax'))
+
+    def test_edgecases(self):
+        (root, dirs, files) = ifarchivexml.parse(EDGECASES)
+
+        self.assertIs(root, dirs['if-archive'])
+        self.assertIsNone(root.parent)
+        self.assertIsNone(root.parentobj)
+        self.assertIsNone(root.subdircount)
+        self.assertIsNone(root.filecount)
+        self.assertEqual([ dir.name for dir in root.subdirs ], [ 'if-archive/games' ])
+
+        games = dirs['if-archive/games']
+        self.assertEqual(games.description, 'Games & <interactive> fiction été <all>')
+        self.assertEqual(games.metadata, { 'tuid': [ 'abc123', 'def456' ] })
+
+        zork = files['if-archive/games/zork&co.z5']
+        self.assertEqual(zork.name, 'zork&co.z5')
+        self.assertEqual(zork.size, 92160)
+        self.assertEqual(zork.description, 'Line one.\n\nLine "two" with a [link](http://example.com/?a=1&b=2).')
+        self.assertEqual(zork.parentdescs, { 'if-archive/games': 'Games & more.' })
+        self.assertEqual(zork.metadata, { 'ifwiki': [ 'Zork & Co' ] })
+        self.assertIsNone(zork.symlink)
+        self.assertIs(zork.directoryobj, games)
+
+        latest = files['if-archive/games/latest']
+        self.assertEqual(latest.symlink, 'dir')
+        self.assertEqual(latest.symlinkname, 'if-archive/games/zcode')
+        self.assertIsNone(latest.symlinkpath)
+        self.assertIsNone(latest.size)
+
+        link = files['if-archive/games/zork.z5']
+        self.assertEqual(link.symlink, 'file')
+        self.assertEqual(link.symlinkpath, 'if-archive/games/zork&co.z5')
+        self.assertIsNone(link.symlinkname)
+
+        bare = files['if-archive/games/bare.txt']
+        self.assertEqual(bare.description, 'Only CDATA & no entities')
+        for key in ('size', 'date', 'rawdate', 'md5', 'sha512', 'symlink', 'symlinkname', 'symlinkpath', 'metadata'):
+            self.assertIsNone(getattr(bare, key), key)
+
+        self.assertEqual(files['if-archive/games/zcode/tést.z8'].size, 0)
+        self.assertEqual([ file.orderindex for file in files.values() ], list(range(len(files))))
+
+    def test_ungrabbed_text(self):
+        # A <path> in a directory is ignored, so its end handler never
+        # takes the text. The parser must stop collecting anyway.
+        data = b'''<?xml version="1.0" encoding="UTF-8"?>
+<ifarchive>
+<directory>
+  <name>if-archive</name>
+  <path>if-archive</path>
+</directory>
+</ifarchive>
+'''
+        dirs = []
+        parser = ifarchivexml.IFAParser(callbacks=(dirs.append, None))
+        xml.sax.parseString(data, parser)
+        self.assertEqual([ dir.name for dir in dirs ], [ 'if-archive' ])
+        self.assertFalse(parser.grabbing)
+        self.assertEqual(parser.grabbeddata, [])
+
+if __name__ == '__main__':
+    unittest.main()
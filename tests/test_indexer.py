@@ -0,0 +1,92 @@
+"""Tests for indexer: "inline" and "directory" parentdesc modes must
+find the same items.
+
+Run from the top of the repo:
+
+    python3 -m unittest discover tests
+"""
+
+import os, os.path
+import shutil
+import tempfile
+import unittest
+
+from whoosh.index import open_dir
+
+from searchlib.indexer import build_index, create_queryparser, join_parentdescs
+
+# Each file's description ends with a word which starts a phrase in an
+# inherited parentdesc (and one parentdesc ends with a word which starts
+# a phrase in the next). A phrase shouldn't match across the join.
+PARENTDESC_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<ifarchive>
+<directory>
+  <name>if-archive</name>
+</directory>
+<directory>
+  <name>if-archive/games</name>
+  <parent>if-archive</parent>
+  <description>The text</description>
+</directory>
+<directory>
+  <name>if-archive/games/cave</name>
+  <parent>if-archive/games</parent>
+  <description>Adventure games set in a colossal cave.</description>
+  <parentdesc dir="if-archive/games">The text</parentdesc>
+</directory>
+<file>
+  <name>advent.z5</name>
+  <path>if-archive/games/cave/advent.z5</path>
+  <directory>if-archive/games/cave</directory>
+  <description>The original colossal</description>
+  <parentdesc dir="if-archive/games/cave">Cave treasure hunts.</parentdesc>
+  <parentdesc dir="if-archive/games">The text</parentdesc>
+</file>
+<file>
+  <name>treasure.z5</name>
+  <path>if-archive/games/cave/treasure.z5</path>
+  <directory>if-archive/games/cave</directory>
+  <description>A colossal cave, and cave treasure.</description>
+  <parentdesc dir="if-archive/games/cave">Adventure games set in a colossal cave.</parentdesc>
+</file>
+</ifarchive>
+'''
+
+class TestParentDescModes(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        xmlpath = os.path.join(self.tempdir, 'Master-Index.xml')
+        with open(xmlpath, 'w', encoding='utf-8') as fl:
+            fl.write(PARENTDESC_XML)
+        self.indexes = {}
+        for mode in ('inline', 'directory'):
+            indexdir = os.path.join(self.tempdir, mode)
+            os.mkdir(indexdir)
+            build_index(xmlpath, indexdir, create=True, parentdescmode=mode)
+            self.indexes[mode] = open_dir(indexdir)
+
+    def tearDown(self):
+        for index in self.indexes.values():
+            index.close()
+        shutil.rmtree(self.tempdir)
+
+    def paths(self, mode, querystr):
+        index = self.indexes[mode]
+        query = create_queryparser(index.schema).parse(querystr)
+        with index.searcher() as searcher:
+            if mode == 'directory':
+                query = join_parentdescs(searcher, query)
+            return sorted([ hit['path'] for hit in searcher.search(query, limit=None) ])
+
+    def test_same_results(self):
+        for querystr in ('colossal cave', '"colossal cave"', '"cave treasure"', '"text adventure"', 'original treasure'):
+            self.assertEqual(self.paths('inline', querystr), self.paths('directory', querystr), querystr)
+
+    def test_phrase_across_parentdesc(self):
+        self.assertEqual(self.paths('inline', '"colossal cave"'), [ 'games/cave', 'games/cave/treasure.z5' ])
+        self.assertEqual(self.paths('inline', '"text adventure"'), [])
+        self.assertEqual(self.paths('inline', 'colossal cave'), [ 'games/cave', 'games/cave/advent.z5', 'games/cave/treasure.z5' ])
+
+if __name__ == '__main__':
+    unittest.main()
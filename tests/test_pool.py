@@ -0,0 +1,128 @@
+"""Tests for pool: SearcherPool's reuse, refreshing, and expiry of
+searchers.
+
+Run from the top of the repo:
+
+    python3 -m unittest discover tests
+"""
+
+import time
+import unittest
+
+from searchlib.pool import SearcherPool
+
+class FakeSearcher:
+    """Stands in for a whoosh searcher. refresh() returns a new
+    searcher if the index's generation has changed, as whoosh does.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.generation = index.generation
+        self.closed = False
+
+    def refresh(self):
+        if self.generation == self.index.generation:
+            return self
+        self.close()
+        return self.index.searcher()
+
+    def close(self):
+        self.closed = True
+
+class FakeIndex:
+    def __init__(self):
+        self.generation = 0
+        self.opened = []
+
+    def searcher(self):
+        searcher = FakeSearcher(self)
+        self.opened.append(searcher)
+        return searcher
+
+class TestSearcherPool(unittest.TestCase):
+
+    def test_reuse(self):
+        index = FakeIndex()
+        pool = SearcherPool(index)
+        with pool.searcher() as searcher1:
+            self.assertEqual(pool.stats(), (0, 1))
+        self.assertEqual(pool.stats(), (1, 0))
+        with pool.searcher() as searcher2:
+            pass
+        self.assertIs(searcher1, searcher2)
+        self.assertEqual(len(index.opened), 1)
+        self.assertFalse(searcher1.closed)
+
+    def test_concurrent(self):
+        # Two checkouts at once get two searchers; both go back into
+        # the pool.
+        index = FakeIndex()
+        pool = SearcherPool(index)
+        searcher1 = pool.acquire()
+        searcher2 = pool.acquire()
+        self.assertIsNot(searcher1, searcher2)
+        self.assertEqual(pool.stats(), (0, 2))
+        pool.release(searcher1)
+        pool.release(searcher2)
+        self.assertEqual(pool.stats(), (2, 0))
+
+    def test_refresh(self):
+        index = FakeIndex()
+        pool = SearcherPool(index)
+        with pool.searcher() as searcher1:
+            pass
+        index.generation += 1
+        with pool.searcher() as searcher2:
+            self.assertEqual(searcher2.generation, 1)
+        self.assertIsNot(searcher1, searcher2)
+        self.assertTrue(searcher1.closed)
+        self.assertEqual(pool.stats(), (1, 0))
+
+    def test_expire(self):
+        index = FakeIndex()
+        pool = SearcherPool(index, idletimeout=0.05)
+        with pool.searcher() as searcher1:
+            pass
+        time.sleep(0.1)
+        with pool.searcher() as searcher2:
+            pass
+        self.assertIsNot(searcher1, searcher2)
+        self.assertTrue(searcher1.closed)
+        self.assertFalse(searcher2.closed)
+
+    def test_error(self):
+        # If opening a searcher fails, it doesn't count as checked out.
+        class BrokenIndex:
+            def searcher(self):
+                raise IOError('no index')
+        pool = SearcherPool(BrokenIndex())
+        with self.assertRaises(IOError):
+            pool.acquire()
+        self.assertEqual(pool.stats(), (0, 0))
+
+    def test_close(self):
+        index = FakeIndex()
+        pool = SearcherPool(index)
+        idle = pool.acquire()
+        busy = pool.acquire()
+        pool.release(idle)
+        pool.close()
+        self.assertTrue(idle.closed)
+        self.assertFalse(busy.closed)
+        # Not final, so a released searcher goes back into the pool.
+        pool.release(busy)
+        self.assertFalse(busy.closed)
+        self.assertEqual(pool.stats(), (1, 0))
+
+    def test_close_final(self):
+        index = FakeIndex()
+        pool = SearcherPool(index)
+        busy = pool.acquire()
+        pool.close(final=True)
+        self.assertFalse(busy.closed)
+        pool.release(busy)
+        self.assertTrue(busy.closed)
+        self.assertEqual(pool.stats(), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""Tests for searchapp: a search which is running when a build switches
+to a new index generation must not leave its results in the caches for
+the new generation.
+
+Run from the top of the repo:
+
+    python3 -m unittest discover tests
+"""
+
+import os, os.path
+import shutil
+import tempfile
+import configparser
+import unittest
+
+try:
+    import tinyapp
+except ImportError:
+    tinyapp = None
+
+from searchlib import generations
+from searchlib.indexer import build_generation, build_index
+
+XML_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<ifarchive>
+<directory>
+  <name>if-archive</name>
+</directory>
+<file>
+  <name>%s</name>
+  <path>if-archive/%s</path>
+  <directory>if-archive</directory>
+  <description>A treasure hunt.</description>
+  <size>1024</size>
+  <rawdate>1425496914</rawdate>
+</file>
+</ifarchive>
+'''
+
+@unittest.skipUnless(tinyapp, 'tinyapp is not installed')
+class TestGenerationSwitch(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.searchindexdir = os.path.join(self.tempdir, 'index')
+
+        # The old generation, which is current, and a new one which
+        # isn't yet.
+        xmlpath = self.writexml('old.xml', 'old.z5')
+        build_generation(xmlpath, self.searchindexdir, create=True)
+        self.olddir = generations.current_indexdir(self.searchindexdir)
+        xmlpath = self.writexml('new.xml', 'new.z5')
+        self.newdir = generations.new_generation(self.searchindexdir)
+        build_index(xmlpath, self.newdir, create=True)
+
+        self.config = configparser.ConfigParser()
+        self.config['DEFAULT']['MasterIndexXML'] = xmlpath
+        self.config['Search'] = {
+            'SearchIndexDir': self.searchindexdir,
+            'AppRoot': '/search',
+            'TemplateDir': os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates'),
+            'ResultsPerPage': '10',
+            'QueryTimeout': '5.0',
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def writexml(self, filename, name):
+        path = os.path.join(self.tempdir, filename)
+        with open(path, 'w', encoding='utf-8') as fl:
+            fl.write(XML_TEMPLATE % (name, name,))
+        return path
+
+    def paths(self, results):
+        return [ res.path for res in results.results ]
+
+    def test_switch_during_search(self):
+        from searchlib.searchapp import SearchApp
+
+        test = self
+        class SwitchingApp(SearchApp):
+            # The first search is interrupted after it has run its query
+            # on the old generation but before it caches the results.
+            # The build switches generations and another search runs
+            # on the new one.
+            def correctquery(self, *args, **kwargs):
+                if not test.switched:
+                    test.switched = True
+                    generations.switch_current(test.searchindexdir, test.newdir)
+                    test.midresults = self.search('treasure', 1, 10)
+                return SearchApp.correctquery(self, *args, **kwargs)
+
+        self.switched = False
+        app = SwitchingApp(self.config, [])
+        oldgen = app.currentindex().name
+        self.assertEqual(oldgen, os.path.basename(self.olddir))
+
+        results = app.search('treasure', 1, 10)
+        self.assertTrue(self.switched)
+        self.assertEqual(results.generation[0], oldgen)
+        self.assertEqual(self.paths(results), [ 'old.z5' ])
+        self.assertEqual(self.paths(self.midresults), [ 'new.z5' ])
+
+        # The old search's results weren't cached, so the new generation
+        # still sees its own.
+        newgen = os.path.basename(self.newdir)
+        results = app.search('treasure', 1, 10)
+        self.assertTrue(results.cached)
+        self.assertEqual(results.generation[0], newgen)
+        self.assertEqual(self.paths(results), [ 'new.z5' ])
+        for cache in (app.resultcache, app.windowcache):
+            for key in cache.map:
+                self.assertEqual(key[0][0], newgen)
+        app.currentindex().close()
+
+if __name__ == '__main__':
+    unittest.main()
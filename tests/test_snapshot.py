@@ -0,0 +1,100 @@
+"""Tests for snapshot: a Master-Index.xml read back from its snapshot
+must give the same objects as parsing the XML.
+
+Run from the top of the repo:
+
+    python3 -m unittest discover tests
+"""
+
+import os, os.path
+import shutil
+import tempfile
+import unittest
+
+from searchlib import ifarchivexml
+
+# The root directory has no <parent>, <subdircount>, or <filecount>
+# (as bench.py's generator writes it), and the files have no symlinks.
+SPARSE_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<ifarchive>
+<directory>
+  <name>if-archive</name>
+</directory>
+<file>
+  <name>README</name>
+  <path>if-archive/README</path>
+  <directory>if-archive</directory>
+</file>
+<directory>
+  <name>if-archive/games</name>
+  <parent>if-archive</parent>
+  <description>Games.</description>
+</directory>
+<file>
+  <name>zork.z5</name>
+  <path>if-archive/games/zork.z5</path>
+  <directory>if-archive/games</directory>
+  <size>92160</size>
+  <rawdate>1425496914</rawdate>
+</file>
+</ifarchive>
+'''
+
+# The fields a snapshot records. (The tree links are rebuilt, and
+# orderindex is assigned by the parser.)
+DIR_FIELDS = ( 'name', 'parent', 'subdircount', 'filecount', 'description', 'date', 'rawdate', 'metadata', 'parentdescs' )
+FILE_FIELDS = ( 'name', 'path', 'directory', 'orderindex', 'size', 'date', 'rawdate', 'md5', 'sha512', 'symlink', 'symlinkname', 'symlinkpath', 'metadata', 'description', 'parentdescs' )
+
+def objfields(obj):
+    keys = FILE_FIELDS if isinstance(obj, ifarchivexml.IFFile) else DIR_FIELDS
+    return { key: getattr(obj, key) for key in keys }
+
+def parse_objects(filename, snapshot=None):
+    res = []
+    func = lambda obj: res.append(objfields(obj))
+    ifarchivexml.parse_callback(filename, dirfunc=func, filefunc=func, snapshot=snapshot)
+    return res
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.xmlpath = os.path.join(self.tempdir, 'Master-Index.xml')
+        with open(self.xmlpath, 'w', encoding='utf-8') as fl:
+            fl.write(SPARSE_XML)
+        self.snappath = os.path.join(self.tempdir, 'Master-Index.snap')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_missing_elements(self):
+        expected = parse_objects(self.xmlpath)
+        self.assertEqual(len(expected), 4)
+        root = expected[0]
+        for key in ('parent', 'subdircount', 'filecount'):
+            self.assertIsNone(root[key], key)
+        for key in ('symlink', 'symlinkname', 'symlinkpath'):
+            self.assertIsNone(expected[1][key], key)
+
+        # The first parse with a snapshot writes it; the second reads it.
+        self.assertEqual(parse_objects(self.xmlpath, snapshot=self.snappath), expected)
+        self.assertTrue(os.path.exists(self.snappath))
+        self.assertEqual(parse_objects(self.xmlpath, snapshot=self.snappath), expected)
+
+    def test_tree_from_snapshot(self):
+        ifarchivexml.parse(self.xmlpath, snapshot=self.snappath)
+        (root, dirs, files) = ifarchivexml.parse(self.xmlpath, snapshot=self.snappath)
+        self.assertIsNone(root.parent)
+        self.assertIsNone(root.parentobj)
+        self.assertEqual([ dir.name for dir in root.subdirs ], [ 'if-archive/games' ])
+        self.assertEqual([ file.path for file in dirs['if-archive/games'].files ], [ 'if-archive/games/zork.z5' ])
+
+    def test_count_entries(self):
+        # Without a current snapshot, this counts the XML's <name> tags.
+        self.assertEqual(ifarchivexml.count_entries(self.xmlpath), 4)
+        self.assertEqual(ifarchivexml.count_entries(self.xmlpath, snapshot=self.snappath), 4)
+        parse_objects(self.xmlpath, snapshot=self.snappath)
+        self.assertEqual(ifarchivexml.count_entries(self.xmlpath, snapshot=self.snappath), 4)
+
+if __name__ == '__main__':
+    unittest.main()